@@ -64,10 +64,12 @@ from firedrake.optimizer import *
 from firedrake.parameters import *
 from firedrake.parloops import *
 from firedrake.plot import *
+from firedrake.profiling import *
 from firedrake.projection import *
 from firedrake.slate import *
 from firedrake.slope_limiter import *
 from firedrake.solving import *
+from firedrake.tsfc_interface import *
 from firedrake.ufl_expr import *
 from firedrake.utility_meshes import *
 from firedrake.variational_solver import *
@@ -1,29 +1,42 @@
 import numpy
 import ufl
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from copy import deepcopy
+from functools import reduce
 from itertools import chain
 
+from coffee import base as ast
 from pyop2 import op2
 from pyop2.base import collecting_loops
+from pyop2.datatypes import IntType, as_cstr
 from pyop2.exceptions import MapValueError, SparsityFormatError
 
 from firedrake import assemble_expressions
+from firedrake import colouring
+from firedrake.constant import Constant
+from firedrake import formmanipulation
 from firedrake import tsfc_interface
 from firedrake import function
 from firedrake import matrix
+from firedrake.mesh import unmarked
 from firedrake import parameters
+from firedrake import profiling
 from firedrake import solving
 from firedrake import utils
+from firedrake.petsc import PETSc
 from firedrake.slate import slate
 from firedrake.slate import slac
+from tsfc.parameters import SCALAR_TYPE
 
 
-__all__ = ["assemble"]
+__all__ = ["assemble", "assemble_many", "assemble_functionals",
+           "clear_sparsity_cache"]
 
 
 def assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
              inverse=False, mat_type=None, sub_mat_type=None,
-             appctx={}, options_prefix=None, **kwargs):
+             appctx={}, options_prefix=None, cache_terms=False,
+             diagonal=False, **kwargs):
     """Evaluate f.
 
     :arg f: a :class:`~ufl.classes.Form`, :class:`~ufl.classes.Expr` or
@@ -48,7 +61,12 @@ def assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
          from AIJ in that only the block sparsity rather than the dof
          sparsity is constructed.  This can result in some memory
          savings, but does not work with all PETSc preconditioners.
-         BAIJ matrices only make sense for non-mixed matrices.
+         BAIJ matrices only make sense for non-mixed matrices.  The
+         type 'is' produces an :class:`.UnassembledMatrix` (a PETSc
+         MATIS), in which each process only stores the matrix of its
+         own elements, as needed by domain decomposition
+         preconditioners such as BDDC; this is only supported on
+         non-mixed spaces and non-extruded meshes.
     :arg sub_mat_type: (optional) string indicating the matrix type to
          use *inside* a nested block matrix.  Only makes sense if
          ``mat_type`` is ``nest``.  May be one of 'aij' or 'baij'.  If
@@ -56,6 +74,12 @@ def assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
     :arg appctx: Additional information to hang on the assembled
          matrix if an implicit matrix is requested (mat_type "matfree").
     :arg options_prefix: PETSc options prefix to apply to matrices.
+    :arg cache_terms: (optional) if f is a 2-form which is a sum of
+         terms scaled by :class:`.Constant`\s, assemble the terms
+         once and form the matrix as their linear combination (see
+         below).
+    :arg diagonal: (optional) if f is a 2-form, assemble only the
+         diagonal of the matrix into a :class:`.Function` (see below).
 
     If f is a :class:`~ufl.classes.Form` then this evaluates the corresponding
     integral(s) and returns a :class:`float` for 0-forms, a
@@ -79,6 +103,33 @@ def assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
     will be set to 0 and the diagonal entries to 1. If ``f`` is a
     1-form, the vector entries at boundary nodes are set to the
     boundary condition values.
+
+    When the same form is repeatedly assembled into the same
+    ``tensor``, the parallel loops built on the first call are
+    stashed on the tensor as an :class:`AssemblyPlan` and replayed on
+    subsequent calls, avoiding the Python overhead of rebuilding
+    them.
+
+    If ``cache_terms`` is True and ``f`` can be split into terms whose
+    only dependence on :class:`.Constant`\s is through scalar factors
+    (for example ``(1/dt)*u*v*dx + theta*inner(grad(u), grad(v))*dx``),
+    each term is assembled once into its own matrix, which is stored
+    on the result.  Assembling the same form into that matrix again
+    (for example after changing the value of ``dt``) then only forms
+    the linear combination of the stored term matrices, rather than
+    executing the assembly kernels again.  This assumes that the
+    terms themselves do not change: it is incorrect to use this if
+    they depend on :class:`.Function`\s whose values are later
+    modified.  Forms which can not be split in this way, and matrix
+    types other than "aij" and "baij", are assembled as usual.
+
+    If ``diagonal`` is True, ``f`` must be a 2-form with matching test
+    and trial spaces, and the diagonal of the matrix it defines is
+    assembled into a :class:`.Function` in the test space (or into
+    ``tensor``), without building a sparsity pattern or a
+    :class:`.Matrix`.  Entries at boundary condition nodes in ``bcs``
+    are set to 1, matching the diagonal of the matrix assembled with
+    those boundary conditions.
     """
 
     if "nest" in kwargs:
@@ -94,13 +145,31 @@ def assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
         raise TypeError("Unknown keyword arguments '%s'" % ', '.join(kwargs.keys()))
 
     if isinstance(f, (ufl.form.Form, slate.TensorBase)):
-        return _assemble(f, tensor=tensor, bcs=solving._extract_bcs(bcs),
+        bcs = solving._extract_bcs(bcs)
+        if cache_terms and not (collect_loops or allocate_only or inverse or diagonal):
+            result = _assemble_constant_terms(f, tensor, bcs,
+                                              form_compiler_parameters=form_compiler_parameters,
+                                              mat_type=mat_type,
+                                              sub_mat_type=sub_mat_type,
+                                              options_prefix=options_prefix)
+            if result is not None:
+                return result
+        if tensor is not None and not (collect_loops or allocate_only):
+            result = _assemble_with_plan(f, tensor, bcs,
+                                         form_compiler_parameters=form_compiler_parameters,
+                                         inverse=inverse, mat_type=mat_type,
+                                         sub_mat_type=sub_mat_type,
+                                         diagonal=diagonal)
+            if result is not None:
+                return result
+        return _assemble(f, tensor=tensor, bcs=bcs,
                          form_compiler_parameters=form_compiler_parameters,
                          inverse=inverse, mat_type=mat_type,
                          sub_mat_type=sub_mat_type, appctx=appctx,
                          collect_loops=collect_loops,
                          allocate_only=allocate_only,
-                         options_prefix=options_prefix)
+                         options_prefix=options_prefix,
+                         diagonal=diagonal)
     elif isinstance(f, ufl.core.expr.Expr):
         return assemble_expressions.assemble_expression(f)
     else:
@@ -123,13 +192,22 @@ def allocate_matrix(f, bcs=None, form_compiler_parameters=None,
 
 
 def create_assembly_callable(f, tensor=None, bcs=None, form_compiler_parameters=None,
-                             inverse=False, mat_type=None, sub_mat_type=None):
+                             inverse=False, mat_type=None, sub_mat_type=None,
+                             cache_terms=False):
     """Create a callable object than be used to assemble f into a tensor.
 
     This is really only designed to be used inside residual and
     jacobian callbacks, since it always assembles back into the
     initially provided tensor.  See also :func:`allocate_matrix`.
 
+    If ``cache_terms`` is True, and f can be split into terms scaled
+    by :class:`.Constant`\s (see :func:`assemble`), the callable
+    forms the linear combination of the term matrices, and does
+    nothing at all if the values of the scaling factors have not
+    changed since the last call.  Such a callable has its
+    ``cache_terms`` attribute set to True; if f can not be split, the
+    callable reassembles f on every call, and the attribute is False.
+
     .. warning::
 
        Really do not use this function unless you know what you're doing.
@@ -138,6 +216,16 @@ def create_assembly_callable(f, tensor=None, bcs=None, form_compiler_parameters=
         raise ValueError("Have to provide tensor to write to")
     if mat_type == "matfree":
         return tensor.assemble
+    if cache_terms and not inverse:
+        bcs = solving._extract_bcs(bcs)
+        combine = _assemble_constant_terms(f, tensor, bcs,
+                                           form_compiler_parameters=form_compiler_parameters,
+                                           mat_type=mat_type,
+                                           sub_mat_type=sub_mat_type,
+                                           collect_loops=True)
+        if combine is not None:
+            combine.cache_terms = True
+            return combine
     loops = _assemble(f, tensor=tensor, bcs=bcs,
                       form_compiler_parameters=form_compiler_parameters,
                       inverse=inverse, mat_type=mat_type,
@@ -145,18 +233,856 @@ def create_assembly_callable(f, tensor=None, bcs=None, form_compiler_parameters=
                       collect_loops=True)
 
     def thunk():
+        if isinstance(tensor, matrix.Matrix):
+            # The values are about to change, so any copy without
+            # boundary conditions is stale.
+            tensor._unconstrained = None
         for kernel in loops:
             kernel()
+    thunk.cache_terms = False
     return thunk
 
 
+def assemble_many(forms, tensors=None, form_compiler_parameters=None,
+                  mat_type=None, sub_mat_type=None):
+    """Assemble several forms, visiting each mesh entity only once.
+
+    :arg forms: an iterable of :class:`~ufl.classes.Form`\s, all
+         defined on the same mesh.
+    :arg tensors: (optional) an iterable, with one entry per form, of
+         existing tensors to place the results in.  Use ``None`` for
+         0-forms, and for forms which should be assembled into a new
+         tensor.
+    :arg form_compiler_parameters: (optional) dict of parameters to
+         pass to the form compiler.
+    :arg mat_type: (optional) the matrix type for 2-forms (see
+         :func:`assemble`).  Matrix-free and unassembled ("is")
+         matrices are not supported.
+    :arg sub_mat_type: (optional) the matrix type inside nested
+         matrices (see :func:`assemble`).
+
+    The integrals of all the forms are grouped by integral type and
+    iteration set, and each group is assembled by a single parallel
+    loop whose kernel calls the kernels of all the contributing forms
+    in turn.  The coordinates and any shared coefficients are
+    therefore gathered once per entity, rather than once per form.
+    The values of all the 0-forms are accumulated in a single
+    :class:`~pyop2.op2.Global`, so they are reduced together.
+
+    Returns a list containing a :class:`float` for each 0-form, a
+    :class:`.Function` for each 1-form and a :class:`.Matrix` for
+    each 2-form.
+
+    .. note::
+
+       Boundary conditions are not applied.  They may be applied to
+       the results afterwards, as with :func:`assemble`.
+    """
+    return _assemble_many(forms, tensors=tensors,
+                          form_compiler_parameters=form_compiler_parameters,
+                          mat_type=mat_type, sub_mat_type=sub_mat_type)
+
+
+def assemble_functionals(forms, subdomain_ids=None, form_compiler_parameters=None):
+    """Evaluate several functionals (0-forms) at once.
+
+    :arg forms: an iterable of 0-forms, all defined on the same mesh,
+         or a single 0-form if ``subdomain_ids`` is given.
+    :arg subdomain_ids: (optional) an iterable of subdomain ids.  If
+         given, the single 0-form ``forms``, whose integrals must all
+         have the same integral type, is evaluated on each of these
+         subdomains, so that for example
+         ``assemble_functionals(dot(u, n)*ds, subdomain_ids=(1, 2, 3))``
+         computes the flux through each of the boundaries 1, 2 and 3.
+    :arg form_compiler_parameters: (optional) dict of parameters to
+         pass to the form compiler.
+
+    The functionals are assembled as by :func:`assemble_many`, so that
+    each mesh entity is visited at most once for all the functionals
+    integrated over it: integrals of the same type over different
+    subdomains share a single loop over the union of the subdomains.
+    In addition, the values of all the functionals are held in a
+    single :class:`~pyop2.op2.Global`, so that each parallel loop sums
+    them across processes with one reduction, rather than one
+    reduction per functional.
+
+    Returns a :class:`numpy.ndarray` of the values of the functionals.
+    """
+    if subdomain_ids is not None:
+        form = forms
+        if not isinstance(form, ufl.form.Form):
+            raise TypeError("Expecting a single 0-form with subdomain_ids, not %r" % form)
+        if len(set(integral.integral_type() for integral in form.integrals())) != 1:
+            raise ValueError("Can only evaluate a form on several subdomains if all its integrals have the same integral type")
+        forms = [ufl.form.Form([integral.reconstruct(subdomain_id=subdomain_id)
+                                for integral in form.integrals()])
+                 for subdomain_id in subdomain_ids]
+    forms = tuple(forms)
+    for f in forms:
+        if not isinstance(f, ufl.form.Form) or len(f.arguments()) != 0:
+            raise ValueError("Can only assemble functionals (0-forms), not %r" % f)
+    if not forms:
+        return numpy.zeros(0)
+    comm = forms[0].ufl_domains()[0].comm
+    functionals = op2.Global(len(forms), numpy.zeros(len(forms)), comm=comm)
+    _assemble_many(forms, form_compiler_parameters=form_compiler_parameters,
+                   functionals=functionals)
+    return functionals.data_ro.copy()
+
+
+@utils.known_pyop2_safe
+def _assemble_many(forms, tensors=None, form_compiler_parameters=None,
+                   mat_type=None, sub_mat_type=None, functionals=None):
+    """Assemble several forms, see :func:`assemble_many`.
+
+    :arg functionals: (optional) a :class:`~pyop2.op2.Global` with an
+        entry for each 0-form, into which their values are
+        accumulated.  A new one is created if not provided.
+    """
+    forms = tuple(forms)
+    if tensors is None:
+        tensors = (None, ) * len(forms)
+    else:
+        tensors = tuple(tensors)
+        if len(tensors) != len(forms):
+            raise ValueError("Need one tensor (or None) per form")
+    if not forms:
+        return []
+    if mat_type is None:
+        mat_type = parameters.parameters["default_matrix_type"]
+    if mat_type in ["matfree", "is"]:
+        raise NotImplementedError("Assembly of many forms with mat_type '%s' not supported" % mat_type)
+
+    if form_compiler_parameters:
+        form_compiler_parameters = form_compiler_parameters.copy()
+    else:
+        form_compiler_parameters = {}
+    form_compiler_parameters["assemble_inverse"] = False
+
+    for f in forms:
+        if not isinstance(f, ufl.form.Form):
+            raise TypeError("Can only assemble many UFL forms, not %r" % f)
+    topology = forms[0].ufl_domains()[0].topology
+    for f in forms:
+        for m in f.ufl_domains():
+            m.init()
+            if m.topology != topology:
+                raise NotImplementedError("All forms must share a mesh topology.")
+        for o in chain(f.arguments(), f.coefficients()):
+            domain = o.ufl_domain()
+            if domain is not None and domain.topology != topology:
+                raise NotImplementedError("Assembly with multiple meshes not supported.")
+        if any((coeff.function_space() and coeff.function_space().component is not None)
+               for coeff in f.coefficients()):
+            raise NotImplementedError("Integration of subscripted VFS not yet implemented")
+
+    # Group the kernels of all the forms by what they iterate over.
+    groups = OrderedDict()
+    for n, f in enumerate(forms):
+        kernels = tsfc_interface.compile_form(f, "form", parameters=form_compiler_parameters)
+        all_integer_subdomain_ids = defaultdict(list)
+        for k in kernels:
+            if k.kinfo.subdomain_id != "otherwise":
+                all_integer_subdomain_ids[k.kinfo.integral_type].append(k.kinfo.subdomain_id)
+        for k, v in all_integer_subdomain_ids.items():
+            all_integer_subdomain_ids[k] = tuple(sorted(v))
+        domains = f.ufl_domains()
+        for indices, kinfo in kernels:
+            if kinfo.needs_cell_facets or kinfo.pass_layer_arg:
+                raise NotImplementedError("Fused assembly of kernels needing cell facet or layer arguments not supported")
+            m = domains[kinfo.domain_number]
+            sdata = f.subdomain_data()[m].get(kinfo.integral_type, None)
+            if kinfo.integral_type != "cell" and sdata is not None:
+                raise NotImplementedError("subdomain_data only supported with cell integrals.")
+            setup = _loop_setup(m, kinfo.integral_type, kinfo.subdomain_id,
+                                all_integer_subdomain_ids, sdata)
+            # Kernels over different subdomains of the same measure
+            # share a loop over the union of their subdomains, and
+            # are only called on entities with a matching marker.
+            subdomain_id = kinfo.subdomain_id
+            if subdomain_id == "everywhere" or sdata is not None:
+                guard = None
+            elif subdomain_id == "otherwise":
+                ids = all_integer_subdomain_ids.get(kinfo.integral_type, ())
+                guard = (False, ids) if ids else None
+            else:
+                guard = (True, subdomain_id if isinstance(subdomain_id, tuple) else (subdomain_id, ))
+            key = (id(m), kinfo.integral_type, id(sdata))
+            group = groups.setdefault(key, (m, kinfo.integral_type, setup[1:], []))
+            group[-1].append((n, indices, kinfo, setup[0], guard))
+
+    # The output tensors.  All the 0-forms share a single Global.
+    nfunctionals = sum(len(f.arguments()) == 0 for f in forms)
+    if functionals is None and nfunctionals:
+        functionals = op2.Global(nfunctionals, numpy.zeros(nfunctionals),
+                                 comm=forms[0].ufl_domains()[0].comm)
+    results = []
+    offsets = {}
+    for n, (f, tensor) in enumerate(zip(forms, tensors)):
+        rank = len(f.arguments())
+        if rank == 0:
+            if tensor is not None:
+                raise ValueError("Can't assemble 0-form into existing tensor")
+            offsets[n] = len(offsets)
+            results.append(None)
+        elif rank == 1:
+            if tensor is None:
+                tensor = function.Function(f.arguments()[0].function_space())
+            else:
+                tensor.dat.zero()
+            results.append(tensor)
+        else:
+            if tensor is None:
+                tensor = allocate_matrix(f, form_compiler_parameters=form_compiler_parameters,
+                                         mat_type=mat_type, sub_mat_type=sub_mat_type)
+            elif isinstance(tensor, (matrix.ImplicitMatrix, matrix.UnassembledMatrix)):
+                raise ValueError("Can only assemble many forms into a Matrix")
+            else:
+                tensor.bcs = None
+                tensor._M.zero()
+            results.append(tensor)
+
+    for m, integral_type, (get_map, decoration, extra_args, kwargs), members in groups.values():
+        itspaces = OrderedDict((id(itspace), itspace) for _, _, _, itspace, _ in members)
+        if len(itspaces) == 1:
+            itspace, = itspaces.values()
+            markers = None
+            guards = [None] * len(members)
+        else:
+            guards = [guard for _, _, _, _, guard in members]
+            subdomain_ids = set()
+            for guard in guards:
+                if guard is not None:
+                    subdomain_ids.update(guard[1])
+            itspace, markers = _union_measure_set(m, integral_type, tuple(itspaces.values()),
+                                                  tuple(sorted(subdomain_ids)))
+        # Arguments of the fused kernel, keyed so that data needed by
+        # several of the contributing kernels is only passed once.
+        args = OrderedDict()
+        layout = []
+        for (n, indices, kinfo, _, _), guard in zip(members, guards):
+            f = forms[n]
+            rank = len(f.arguments())
+            kernel_args = []
+            if rank == 0:
+                kernel_args.append((("functionals", ),
+                                    lambda: functionals(op2.INC),
+                                    offsets[n]))
+            elif rank == 1:
+                i, = indices
+                V = f.arguments()[0].function_space()[i]
+                dat = results[n].dat[i]
+                kernel_args.append((("output", n, indices),
+                                    lambda dat=dat, V=V: dat(op2.INC, get_map(V)[op2.i[0]]),
+                                    0))
+            else:
+                i, j = indices
+                test, trial = f.arguments()
+                mat = results[n]._M[i, j]
+                Vtest = test.function_space()[i]
+                Vtrial = trial.function_space()[j]
+
+                def make_mat_arg(mat=mat, Vtest=Vtest, Vtrial=Vtrial):
+                    m_ = get_map(Vtest, None, decoration)
+                    n_ = get_map(Vtrial, None, decoration)
+                    maps = (m_[op2.i[0]] if m_ else None,
+                            n_[op2.i[1 if m_ else 0]] if n_ else None)
+                    return mat(op2.INC, maps)
+                kernel_args.append((("output", n, indices), make_mat_arg, 0))
+            coords = m.coordinates
+            kernel_args.append((("coordinates", ),
+                                lambda: coords.dat(op2.READ, get_map(coords)[op2.i[0]]),
+                                0))
+            if kinfo.oriented:
+                o = m.cell_orientations()
+                kernel_args.append((("orientations", ),
+                                    lambda: o.dat(op2.READ, get_map(o)[op2.i[0]]),
+                                    0))
+            coefficients = f.coefficients()
+            for cn in kinfo.coefficient_map:
+                c = coefficients[cn]
+                for s, c_ in enumerate(c.split()):
+                    def make_coefficient_arg(c_=c_):
+                        m_ = get_map(c_)
+                        return c_.dat(op2.READ, m_ and m_[op2.i[0]])
+                    kernel_args.append((("coefficient", id(c), s), make_coefficient_arg, 0))
+            for e, arg in enumerate(extra_args):
+                kernel_args.append((("extra", e), lambda arg=arg: arg, 0))
+
+            positions = []
+            for key, make_arg, offset in kernel_args:
+                if key not in args:
+                    args[key] = (len(args), make_arg())
+                positions.append((args[key][0], offset))
+            layout.append((kinfo.kernel, tuple(positions), guard))
+
+        functionals_position = args.get(("functionals", ), (None, ))[0]
+        markers_position = None
+        if markers is not None:
+            markers_position = len(args)
+            args[("markers", )] = (markers_position, markers(op2.READ))
+        kernel = _fused_kernel("fused_%s_integral" % integral_type, layout,
+                               functionals_position=functionals_position,
+                               markers_position=markers_position)
+        try:
+            op2.par_loop(kernel, itspace, *(arg for _, arg in args.values()), **kwargs)
+        except MapValueError:
+            raise RuntimeError("Integral measure does not match measure of all coefficients/arguments")
+
+    for n, f in enumerate(forms):
+        rank = len(f.arguments())
+        if rank == 0:
+            results[n] = float(functionals.data_ro[offsets[n]])
+        elif rank == 2:
+            result = results[n]
+            result._M.assemble()
+
+            def reassemble(bcs, f=f, result=result):
+                _assemble(f, tensor=result, bcs=bcs,
+                          form_compiler_parameters=form_compiler_parameters,
+                          mat_type=mat_type, sub_mat_type=sub_mat_type)
+                result._assembly_callback(bcs)
+            result._assembly_callback = reassemble
+            # Already assembled without bcs, so that bcs applied later
+            # are seen as a change requiring an update.
+            result.assembled = True
+            result._bcs_at_point_of_assembly = []
+    return results
+
+
+_fused_kernel_cache = {}
+
+
+def _fused_kernel(name, layout, functionals_position=None, markers_position=None):
+    """Build a kernel which calls several form kernels in turn.
+
+    :arg name: the name of the fused kernel.
+    :arg layout: an iterable of ``(kernel, positions, guard)`` triples
+        giving the :class:`~pyop2.op2.Kernel`\s to call, for each of
+        their arguments a tuple ``(index, offset)`` of the index of
+        the fused kernel argument to pass and an offset into it, and
+        either ``None`` to call the kernel on every entity or a pair
+        ``(match, subdomain_ids)`` to only call it on entities whose
+        marker is (if ``match``) or is not (otherwise) one of
+        ``subdomain_ids``.
+    :arg functionals_position: (optional) the index of the fused
+        kernel argument for the :class:`~pyop2.op2.Global` which
+        accumulates 0-forms.
+    :arg markers_position: (optional) the index of the fused kernel
+        argument holding the marker of the entity, needed if any
+        kernel is guarded.
+
+    :returns: a :class:`~pyop2.op2.Kernel`.
+    """
+    key = (name, tuple((kernel.cache_key, positions, guard) for kernel, positions, guard in layout),
+           functionals_position, markers_position)
+    try:
+        return _fused_kernel_cache[key]
+    except KeyError:
+        pass
+    subkernels = []
+    decls = {}
+    calls = []
+    if markers_position is not None:
+        marker = "arg%d" % markers_position
+        decls[markers_position] = ast.Decl(as_cstr(IntType), ast.Symbol(marker),
+                                           qualifiers=["const"], pointers=[("restrict", )])
+    for n, (kernel, positions, guard) in enumerate(layout):
+        fundecl = deepcopy(kernel._ast)
+        fundecl.name = "%s_%d" % (fundecl.name, n)
+        if len(fundecl.args) != len(positions):
+            raise RuntimeError("Unexpected number of arguments in kernel %s" % kernel.name)
+        call_args = []
+        for decl, (index, offset) in zip(fundecl.args, positions):
+            sym = "arg%d" % index
+            if index not in decls:
+                if index == functionals_position:
+                    decl = ast.Decl(SCALAR_TYPE, ast.Symbol(sym),
+                                    pointers=[("restrict", )])
+                else:
+                    decl = deepcopy(decl)
+                    decl.sym.symbol = sym
+                decls[index] = decl
+            call_args.append(ast.FlatBlock("%s + %d" % (sym, offset) if offset else sym))
+        subkernels.append(fundecl)
+        call = ast.FunCall(fundecl.name, *call_args)
+        if guard is not None:
+            match, subdomain_ids = guard
+            if match:
+                cond = reduce(ast.Or, (ast.Eq(ast.Symbol(marker, (0, )), sid)
+                                       for sid in subdomain_ids))
+            else:
+                cond = reduce(ast.And, (ast.NEq(ast.Symbol(marker, (0, )), sid)
+                                        for sid in subdomain_ids))
+            call = ast.If(cond, (ast.Block([call], open_scope=True), ))
+        calls.append(call)
+    body = ast.Block(calls, open_scope=False)
+    fused = ast.FunDecl("void", name, [decls[i] for i in sorted(decls)], body,
+                        pred=["static", "inline"])
+    kernel = op2.Kernel(ast.Node(subkernels + [fused]), name)
+    return _fused_kernel_cache.setdefault(key, kernel)
+
+
+def _union_measure_set(m, integral_type, itspaces, subdomain_ids):
+    """Return an iteration set covering several measure sets.
+
+    :arg m: the mesh being integrated over.
+    :arg integral_type: the type of the integrals.
+    :arg itspaces: the iteration sets (see
+        :meth:`~.MeshTopology.measure_set`) of the integrals.
+    :arg subdomain_ids: the integer subdomain ids of the integrals.
+
+    :returns: a tuple ``(itspace, markers)`` of the union of the
+        iteration sets and a :class:`~pyop2.op2.Dat` holding, for
+        each entity, whichever of ``subdomain_ids`` it is marked with
+        (or :data:`~.unmarked`).
+    """
+    cache = m.topology._shared_data_cache["union_measure_sets"]
+    key = (integral_type, tuple(id(itspace) for itspace in itspaces), subdomain_ids)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    superset = getattr(itspaces[0], "superset", itspaces[0])
+    if all(isinstance(itspace, op2.Subset) for itspace in itspaces):
+        indices = numpy.unique(numpy.concatenate([itspace.indices for itspace in itspaces]))
+        itspace = op2.Subset(superset, indices)
+    else:
+        itspace = superset
+    values = numpy.full(superset.total_size, unmarked, dtype=IntType)
+    for sid in subdomain_ids:
+        values[m.measure_set(integral_type, sid).indices] = sid
+    markers = op2.Dat(op2.DataSet(superset, 1), values, dtype=IntType,
+                      name="%s_markers" % integral_type)
+    return cache.setdefault(key, (itspace, markers))
+
+
+AssemblyPlan = namedtuple("AssemblyPlan", ["form", "key", "bcs", "loops"])
+AssemblyPlan.__doc__ = """\
+The parallel loops which assemble a form into a particular tensor.
+
+:param form: The form (or Slate expression) the plan assembles.
+:param key: The assembly options the plan was built with.
+:param bcs: The boundary conditions the plan was built with.
+:param loops: The collected loops (see :func:`create_assembly_callable`)
+    which, called in order, carry out the assembly."""
+
+
+def _tuplify(params):
+    return tuple((k, params[k]) for k in sorted(params))
+
+
+def _assemble_with_plan(f, tensor, bcs, form_compiler_parameters=None,
+                        inverse=False, mat_type=None, sub_mat_type=None,
+                        diagonal=False):
+    """Assemble f into an existing tensor by replaying an
+    :class:`AssemblyPlan` cached on the tensor, building the plan
+    first if necessary.
+
+    The plan is only reused if it was built for the same form object
+    with the same assembly options, otherwise it is replaced.
+
+    :returns: the assembled tensor, or ``None`` if this assembly can't
+        be carried out with a plan (in which case the caller should
+        fall back to :func:`_assemble`).
+    """
+    rank = 1 if diagonal else len(f.arguments())
+    if rank == 0 or isinstance(tensor, matrix.ImplicitMatrix):
+        return None
+    if mat_type is None:
+        mat_type = parameters.parameters["default_matrix_type"]
+    if sub_mat_type is None:
+        sub_mat_type = parameters.parameters["default_sub_matrix_type"]
+    if mat_type == "matfree" and not diagonal:
+        return None
+
+    key = (_tuplify(form_compiler_parameters or {}),
+           _tuplify(parameters.parameters["coffee"]),
+           inverse, mat_type, sub_mat_type, diagonal)
+    plan = getattr(tensor, "_assembly_plan", None)
+    if plan is None or plan.form is not f or plan.key != key \
+       or (rank == 2 and plan.bcs != bcs):
+        # Boundary conditions on vectors are not collected into the
+        # loops (they are applied separately below), so only matrix
+        # plans are specific to a set of bcs.
+        loops = _assemble(f, tensor=tensor, bcs=bcs if rank == 2 else (),
+                          form_compiler_parameters=form_compiler_parameters,
+                          inverse=inverse, mat_type=mat_type,
+                          sub_mat_type=sub_mat_type,
+                          collect_loops=True, diagonal=diagonal)
+        plan = AssemblyPlan(f, key, bcs, tuple(loops))
+        tensor._assembly_plan = plan
+
+    if rank == 2:
+        def thunk(bcs):
+            if tuple(bcs) != plan.bcs:
+                # The bcs were changed after the plan was bound (for
+                # example by bc.apply(A)), so it does not apply.
+                _assemble(f, tensor=tensor, bcs=bcs,
+                          form_compiler_parameters=form_compiler_parameters,
+                          inverse=inverse, mat_type=mat_type,
+                          sub_mat_type=sub_mat_type)
+                return tensor._assembly_callback(bcs)
+            for loop in plan.loops:
+                loop()
+        # Replace any bcs on the tensor we passed in and defer the
+        # actual assembly, exactly as _assemble does.
+        tensor.bcs = bcs
+        tensor._assembly_callback = thunk
+        return tensor
+
+    for loop in plan.loops:
+        loop()
+    for bc in bcs:
+        if diagonal:
+            _set_bc_diagonal(bc, tensor)
+        else:
+            bc.apply(tensor)
+    return tensor
+
+
+def _set_bc_diagonal(bc, diagonal):
+    """Set the entries of an assembled matrix diagonal on the nodes
+    of a boundary condition to 1.
+
+    :arg bc: the :class:`.DirichletBC`.
+    :arg diagonal: the :class:`.Function` holding the diagonal.
+    """
+    for idx in bc._indices:
+        diagonal = diagonal.sub(idx)
+    shape = diagonal.ufl_shape
+    one = Constant(numpy.ones(shape) if shape else 1.0)
+    diagonal.assign(one, subset=bc.node_set)
+
+
+ConstantTerms = namedtuple("ConstantTerms", ["form", "key", "scales", "matrices"])
+ConstantTerms.__doc__ = """The assembled terms of a bilinear form which is a sum of
+terms scaled by :class:`.Constant`\s.
+
+:arg form: the form which was split.
+:arg key: the assembly options the terms were assembled with.
+:arg scales: the scaling factor of each term, scalar UFL expressions
+    depending only on :class:`.Constant`\s.
+:arg matrices: the assembled :class:`.Matrix` of each term, without
+    boundary conditions.
+"""
+
+
+def _assemble_constant_terms(f, tensor, bcs, form_compiler_parameters=None,
+                             mat_type=None, sub_mat_type=None,
+                             options_prefix=None, collect_loops=False):
+    """Assemble a bilinear form as the linear combination of its
+    :class:`.Constant`-scaled terms, see :func:`assemble`.
+
+    The assembled terms are cached on the tensor as a
+    :class:`ConstantTerms` and reused if the same form is assembled
+    into it again with the same options.
+
+    :arg collect_loops: if True, return a callable which assembles
+        into ``tensor`` when called, and which does nothing if the
+        values of the scaling factors have not changed since the
+        last time it was called.
+    :returns: the assembled tensor (or the callable), or ``None`` if
+        this form can't be assembled in this way.
+    """
+    if not isinstance(f, ufl.form.Form) or len(f.arguments()) != 2:
+        return None
+    if isinstance(tensor, matrix.ImplicitMatrix):
+        return None
+    if mat_type is None:
+        mat_type = parameters.parameters["default_matrix_type"]
+    if sub_mat_type is None:
+        sub_mat_type = parameters.parameters["default_sub_matrix_type"]
+    if mat_type not in ["aij", "baij"]:
+        return None
+    if any(len(a.function_space()) > 1 for a in f.arguments()):
+        return None
+    terms = formmanipulation.split_constant_terms(f)
+    if terms is None:
+        return None
+
+    if tensor is None:
+        tensor = _assemble(f, bcs=bcs,
+                           form_compiler_parameters=form_compiler_parameters,
+                           mat_type=mat_type, sub_mat_type=sub_mat_type,
+                           options_prefix=options_prefix,
+                           allocate_only=True)
+
+    key = (_tuplify(form_compiler_parameters or {}),
+           _tuplify(parameters.parameters["coffee"]),
+           mat_type, sub_mat_type)
+    cached = getattr(tensor, "_constant_terms", None)
+    if cached is None or cached.form is not f or cached.key != key:
+        matrices = []
+        for _, term in terms:
+            term_matrix = _assemble(term,
+                                    form_compiler_parameters=form_compiler_parameters,
+                                    mat_type=mat_type, sub_mat_type=sub_mat_type)
+            term_matrix.force_evaluation()
+            matrices.append(term_matrix)
+        cached = ConstantTerms(f, key, tuple(scale for scale, _ in terms),
+                               tuple(matrices))
+        tensor._constant_terms = cached
+
+    def thunk(bcs):
+        petscmat = tensor.petscmat
+        # Ensure the (possibly freshly allocated) matrix is assembled
+        # as far as PETSc is concerned before operating on it.
+        petscmat.assemble()
+        petscmat.zeroEntries()
+        for scale, term_matrix in zip(cached.scales, cached.matrices):
+            if term_matrix._M.sparsity is tensor._M.sparsity:
+                structure = PETSc.Mat.Structure.SAME_NONZERO_PATTERN
+            else:
+                structure = PETSc.Mat.Structure.SUBSET_NONZERO_PATTERN
+            petscmat.axpy(float(scale), term_matrix.petscmat, structure=structure)
+        if bcs:
+            V = f.arguments()[0].function_space()
+            rows = matrix._bc_local_rows(bcs, V.dof_dset.cdim)
+            petscmat.zeroRowsColumnsLocal(rows, diag=1.0)
+
+    if collect_loops:
+        state = []
+
+        def combine():
+            current = tuple(float(scale) for scale in cached.scales)
+            if state == [current]:
+                return
+            tensor._unconstrained = None
+            thunk(bcs)
+            state[:] = [current]
+        return combine
+    tensor.bcs = bcs
+    tensor._assembly_callback = thunk
+    return tensor
+
+
+def _unassembled_local_matrix(tensor, map_specs):
+    """Return the process-local matrix of an :class:`.UnassembledMatrix`.
+
+    :arg tensor: the :class:`.UnassembledMatrix`.
+    :arg map_specs: an iterable of ``(test_map, trial_map, domains)``
+        tuples giving the map pairs used to assemble the matrix (see
+        :func:`_get_sparsity`).
+
+    :returns: a tuple ``(local, local_map, owned)`` of the
+        :class:`~pyop2.op2.Mat` on the local (owned and halo) dofs of
+        this process, a function taking one of the maps to the
+        corresponding map to the local dofs, and a function taking an
+        iteration set to the subset of its owned entities.
+
+    The sequential sparsity is built from the maps the first time,
+    and cached on the tensor, so that subsequent assemblies only add
+    into the local matrix.
+    """
+    key = tuple((test_map, trial_map) for test_map, trial_map, _ in map_specs)
+    cached = getattr(tensor, "_local_matrix", None)
+    if cached is not None and cached[0] == key:
+        return cached[1:]
+
+    # The local dofs of the test and trial spaces, as sequential sets.
+    dsets = []
+    names = []
+    for a in tensor.a.arguments():
+        V = a.function_space()
+        node_set = op2.Set(V.node_set.total_size, "%s_local_nodes" % V.name,
+                           comm=PETSc.COMM_SELF)
+        dsets.append(op2.DataSet(node_set, V.dof_dset.cdim))
+        names.append(V.name)
+    maps = {}
+    for map_pair in key:
+        for map_, dset in zip(map_pair, dsets):
+            if map_ not in maps:
+                maps[map_] = op2.Map(map_.iterset, dset.set, map_.arity,
+                                     map_.values_with_halo,
+                                     "%s_local" % map_.name)
+    sparsity = op2.Sparsity(tuple(dsets),
+                            tuple((maps[test_map], maps[trial_map])
+                                  for test_map, trial_map in key),
+                            "%s_%s_local_sparsity" % tuple(names))
+    local = op2.Mat(sparsity, numpy.float64)
+    # Applying boundary conditions must not drop entries the kernels
+    # add into when reassembling.
+    local.handle.setOption(PETSc.Mat.Option.KEEP_NONZERO_PATTERN, True)
+
+    subsets = {}
+
+    def owned(itspace):
+        try:
+            return subsets[itspace]
+        except KeyError:
+            pass
+        if isinstance(itspace, op2.Subset):
+            superset = itspace.superset
+            indices = itspace.indices[itspace.indices < superset.size]
+        else:
+            superset = itspace
+            indices = numpy.arange(superset.size, dtype=IntType)
+        return subsets.setdefault(itspace, op2.Subset(superset, indices))
+
+    tensor._local_matrix = (key, local, maps.__getitem__, owned)
+    return tensor._local_matrix[1:]
+
+
+def _set_unassembled_local_matrix(tensor, local, bcs):
+    """Pass the assembled process-local matrix to an
+    :class:`.UnassembledMatrix`, and apply boundary conditions.
+
+    :arg tensor: the :class:`.UnassembledMatrix`.
+    :arg local: its process-local :class:`~pyop2.op2.Mat` (see
+        :func:`_unassembled_local_matrix`).
+    :arg bcs: the boundary conditions to apply.
+    """
+    local.assemble()
+    petscmat = tensor.petscmat
+    petscmat.setISLocalMat(local.handle)
+    petscmat.assemble()
+    if bcs:
+        row_bs = tensor.a.arguments()[0].function_space().dof_dset.cdim
+        rows = matrix._bc_local_rows(bcs, row_bs)
+        petscmat.zeroRowsColumnsLocal(rows, diag=1.0)
+
+
+def _get_sparsity(topology, dsets, map_specs, name, nest, baij):
+    """Get a (possibly cached) :class:`~pyop2.op2.Sparsity`.
+
+    :arg topology: the mesh topology to cache the sparsity on.
+    :arg dsets: a tuple of the test and trial
+        :class:`~pyop2.op2.DataSet`\s.
+    :arg map_specs: an iterable of ``(test_map, trial_map, domains)``
+        tuples giving the map pairs of the sparsity, and the
+        iteration regions each is used over.
+    :arg name: a name for the sparsity (if it is built).
+    :arg nest: should the sparsity be nested?
+    :arg baij: should the sparsity be block sparse?
+
+    Sparsities are shared between all matrices on the same test and
+    trial :class:`~pyop2.op2.DataSet`\s with the same map pairs, for
+    the lifetime of the mesh or until :func:`clear_sparsity_cache` is
+    called.
+    """
+    cache = topology._shared_data_cache["sparsity_cache"]
+    key = (dsets,
+           tuple((test_map, trial_map, frozenset(domains))
+                 for test_map, trial_map, domains in map_specs),
+           nest, baij)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    # To avoid an extra check for extruded domains, the maps that are being passed in
+    # are DecoratedMaps. For the non-extruded case the DecoratedMaps don't restrict the
+    # space over which we iterate as the domains are dropped at Sparsity construction
+    # time. In the extruded case the cell domains are used to identify the regions of the
+    # mesh which require allocation in the sparsity.
+    map_pairs = tuple((op2.DecoratedMap(test_map, domains),
+                       op2.DecoratedMap(trial_map, domains))
+                      for test_map, trial_map, domains in map_specs)
+    try:
+        sparsity = op2.Sparsity(dsets, map_pairs, name,
+                                nest=nest, block_sparse=baij)
+    except SparsityFormatError:
+        raise ValueError("Monolithic matrix assembly is not supported for systems with R-space blocks.")
+    return cache.setdefault(key, sparsity)
+
+
+def clear_sparsity_cache(mesh):
+    """Evict all the cached sparsity patterns of matrices on a mesh.
+
+    :arg mesh: the mesh whose sparsities should be dropped.
+
+    Matrices which have already been built keep their sparsity, but
+    subsequently allocated matrices get a new one.
+    """
+    mesh.topology._shared_data_cache.pop("sparsity_cache", None)
+
+
+def _loop_setup(m, integral_type, subdomain_id, all_integer_subdomain_ids,
+                sdata=None):
+    """Work out how to iterate over the entities of an integral.
+
+    :arg m: the mesh being integrated over.
+    :arg integral_type: the type of the integral.
+    :arg subdomain_id: the subdomain of the integral.
+    :arg all_integer_subdomain_ids: information to interpret the
+        ``"otherwise"`` subdomain (see :meth:`~.MeshTopology.measure_set`).
+    :arg sdata: (optional) subdomain data for cell integrals.
+
+    :returns: a tuple ``(itspace, get_map, decoration, extra_args,
+        kwargs)`` of the iteration set, a function returning the map
+        for a given function space (optionally masked by bcs and
+        decorated), the decoration for matrix maps in the extruded
+        case, the non-coefficient arguments the kernels need at the
+        end of their argument list and any extra keyword arguments
+        for the :func:`~pyop2.op2.par_loop`.
+    """
+    kwargs = {}
+    # Some integrals require non-coefficient arguments at the
+    # end (facet number information).
+    extra_args = []
+    # Decoration for applying to matrix maps in extruded case
+    decoration = None
+    itspace = m.measure_set(integral_type, subdomain_id,
+                            all_integer_subdomain_ids)
+    if integral_type == "cell":
+        itspace = sdata or itspace
+
+        if subdomain_id not in ["otherwise", "everywhere"] and \
+           sdata is not None:
+            raise ValueError("Cannot use subdomain data and subdomain_id")
+
+        def get_map(x, bcs=None, decoration=None):
+            return x.cell_node_map(bcs)
+
+    elif integral_type in ("exterior_facet", "exterior_facet_vert"):
+        extra_args.append(m.exterior_facets.local_facet_dat(op2.READ))
+
+        def get_map(x, bcs=None, decoration=None):
+            return x.exterior_facet_node_map(bcs)
+
+    elif integral_type in ("exterior_facet_top", "exterior_facet_bottom"):
+        # In the case of extruded meshes with horizontal facet integrals, two
+        # parallel loops will (potentially) get created and called based on the
+        # domain id: interior horizontal, bottom or top.
+        decoration = {"exterior_facet_top": op2.ON_TOP,
+                      "exterior_facet_bottom": op2.ON_BOTTOM}[integral_type]
+        kwargs["iterate"] = decoration
+
+        def get_map(x, bcs=None, decoration=None):
+            map_ = x.cell_node_map(bcs)
+            if decoration is not None:
+                return op2.DecoratedMap(map_, decoration)
+            return map_
+
+    elif integral_type in ("interior_facet", "interior_facet_vert"):
+        extra_args.append(m.interior_facets.local_facet_dat(op2.READ))
+
+        def get_map(x, bcs=None, decoration=None):
+            return x.interior_facet_node_map(bcs)
+
+    elif integral_type == "interior_facet_horiz":
+        decoration = op2.ON_INTERIOR_FACETS
+        kwargs["iterate"] = decoration
+
+        def get_map(x, bcs=None, decoration=None):
+            map_ = x.cell_node_map(bcs)
+            if decoration is not None:
+                return op2.DecoratedMap(map_, decoration)
+            return map_
+
+    else:
+        raise ValueError("Unknown integral type '%s'" % integral_type)
+    return itspace, get_map, decoration, extra_args, kwargs
+
+
 @utils.known_pyop2_safe
 def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
               inverse=False, mat_type=None, sub_mat_type=None,
               appctx={},
               options_prefix=None,
               collect_loops=False,
-              allocate_only=False):
+              allocate_only=False,
+              diagonal=False):
     """Assemble the form or Slate expression f and return a Firedrake object
     representing the result. This will be a :class:`float` for 0-forms/rank-0
     Slate tensors, a :class:`.Function` for 1-forms/rank-1 Slate tensors and
@@ -171,17 +1097,19 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
     :arg inverse: (optional) if f is a 2-form, then assemble the inverse
          of the local matrices.
     :arg mat_type: (optional) type for assembled matrices, one of
-        "nest", "aij", "baij", or "matfree".
+        "nest", "aij", "baij", "is", or "matfree".
     :arg sub_mat_type: (optional) type for assembled sub matrices
         inside a "nest" matrix.  One of "aij" or "baij".
     :arg appctx: Additional information to hang on the assembled
          matrix if an implicit matrix is requested (mat_type "matfree").
     :arg options_prefix: An options prefix for the PETSc matrix
         (ignored if not assembling a bilinear form).
+    :arg diagonal: (optional) if f is a 2-form, then assemble only
+        the diagonal of the matrix into a :class:`.Function`.
     """
     if mat_type is None:
         mat_type = parameters.parameters["default_matrix_type"]
-    if mat_type not in ["matfree", "aij", "baij", "nest"]:
+    if mat_type not in ["matfree", "aij", "baij", "nest", "is"]:
         raise ValueError("Unrecognised matrix type, '%s'" % mat_type)
     if sub_mat_type is None:
         sub_mat_type = parameters.parameters["default_sub_matrix_type"]
@@ -193,6 +1121,12 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
     else:
         form_compiler_parameters = {}
     form_compiler_parameters["assemble_inverse"] = inverse
+    if diagonal:
+        if inverse:
+            raise ValueError("Can't assemble the diagonal of the inverse")
+        if isinstance(f, slate.TensorBase):
+            raise NotImplementedError("Diagonal assembly of Slate tensors not implemented")
+        form_compiler_parameters["assemble_diagonal"] = True
 
     topology = f.ufl_domains()[0].topology
     for m in f.ufl_domains():
@@ -207,8 +1141,21 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
         if domain is not None and domain.topology != topology:
             raise NotImplementedError("Assembly with multiple meshes not supported.")
 
+    # Slate expressions evaluated on batches of cells
+    batched = None
     if isinstance(f, slate.TensorBase):
-        kernels = slac.compile_expression(f, tsfc_parameters=form_compiler_parameters)
+        batch_size = parameters.parameters["slate_batch_size"]
+        if batch_size > 0 and mat_type != "is" and slac.can_batch(f):
+            key = ("batched", str(sorted(form_compiler_parameters.items())), batch_size)
+            cache = f._metakernel_cache
+            try:
+                batched = cache[key]
+            except KeyError:
+                batched = cache.setdefault(key, slac.BatchedExpression(f, form_compiler_parameters,
+                                                                       batch_size))
+            kernels = batched.kernels
+        else:
+            kernels = slac.compile_expression(f, tsfc_parameters=form_compiler_parameters)
         integral_types = [kernel.kinfo.integral_type for kernel in kernels]
     else:
         kernels = tsfc_interface.compile_form(f, "form", parameters=form_compiler_parameters, inverse=inverse)
@@ -216,6 +1163,18 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
 
     rank = len(f.arguments())
 
+    if diagonal:
+        if rank != 2:
+            raise ValueError("Can only assemble the diagonal of a 2-form")
+        test, trial = f.arguments()
+        if test.function_space() != trial.function_space():
+            raise ValueError("Can only assemble the diagonal of a 2-form with matching test and trial spaces")
+        # Only the diagonal blocks contribute, and they are assembled
+        # like a 1-form on the test space.
+        kernels = tuple(tsfc_interface.SplitKernel((i, ), kinfo)
+                        for (i, j), kinfo in kernels if i == j)
+        rank = 1
+
     is_mat = rank == 2
     is_vec = rank == 1
 
@@ -251,11 +1210,26 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             return tensor
         test, trial = f.arguments()
 
-        map_pairs = []
+        unassembled = mat_type == "is"
         cell_domains = []
         exterior_facet_domains = []
         interior_facet_domains = []
-        if tensor is None:
+        if unassembled:
+            if inverse:
+                raise NotImplementedError("Inverse not implemented with mat_type 'is'")
+            if any(len(a.function_space()) > 1 for a in f.arguments()):
+                raise NotImplementedError("mat_type 'is' not implemented for mixed spaces")
+            if any(m.cell_set._extruded for m in f.ufl_domains()):
+                raise NotImplementedError("mat_type 'is' not implemented on extruded meshes")
+            if tensor is None:
+                result_matrix = matrix.UnassembledMatrix(f, bcs,
+                                                         options_prefix=options_prefix)
+            elif not isinstance(tensor, matrix.UnassembledMatrix):
+                raise ValueError("Expecting an UnassembledMatrix with mat_type 'is'")
+            else:
+                result_matrix = tensor
+                result_matrix.bcs = bcs
+        if unassembled or tensor is None:
             # For horizontal facets of extruded meshes, the corresponding domain
             # in the base mesh is the cell domain. Hence all the maps used for top
             # bottom and interior horizontal facets will use the cell to dofs map
@@ -281,42 +1255,41 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
                 else:
                     raise ValueError('Unknown integral type "%s"' % integral_type)
 
-            # To avoid an extra check for extruded domains, the maps that are being passed in
-            # are DecoratedMaps. For the non-extruded case the DecoratedMaps don't restrict the
-            # space over which we iterate as the domains are dropped at Sparsity construction
-            # time. In the extruded case the cell domains are used to identify the regions of the
-            # mesh which require allocation in the sparsity.
+            map_specs = []
             if cell_domains:
-                map_pairs.append((op2.DecoratedMap(test.cell_node_map(), cell_domains),
-                                  op2.DecoratedMap(trial.cell_node_map(), cell_domains)))
+                map_specs.append((test.cell_node_map(), trial.cell_node_map(),
+                                  cell_domains))
             if exterior_facet_domains:
-                map_pairs.append((op2.DecoratedMap(test.exterior_facet_node_map(), exterior_facet_domains),
-                                  op2.DecoratedMap(trial.exterior_facet_node_map(), exterior_facet_domains)))
+                map_specs.append((test.exterior_facet_node_map(),
+                                  trial.exterior_facet_node_map(),
+                                  exterior_facet_domains))
             if interior_facet_domains:
-                map_pairs.append((op2.DecoratedMap(test.interior_facet_node_map(), interior_facet_domains),
-                                  op2.DecoratedMap(trial.interior_facet_node_map(), interior_facet_domains)))
-
-            map_pairs = tuple(map_pairs)
+                map_specs.append((test.interior_facet_node_map(),
+                                  trial.interior_facet_node_map(),
+                                  interior_facet_domains))
+
+        if unassembled:
+            # The kernels add directly into the process-local matrix
+            # (see _unassembled_local_matrix).
+            tensor, local_map, owned = _unassembled_local_matrix(result_matrix, map_specs)
+            zero_tensor = tensor.zero
+        elif tensor is None:
             # Construct OP2 Mat to assemble into
             fs_names = (test.function_space().name, trial.function_space().name)
 
-            try:
-                sparsity = op2.Sparsity((test.function_space().dof_dset,
-                                         trial.function_space().dof_dset),
-                                        map_pairs,
-                                        "%s_%s_sparsity" % fs_names,
-                                        nest=nest,
-                                        block_sparse=baij)
-            except SparsityFormatError:
-                raise ValueError("Monolithic matrix assembly is not supported for systems with R-space blocks.")
-
+            sparsity = _get_sparsity(topology,
+                                     (test.function_space().dof_dset,
+                                      trial.function_space().dof_dset),
+                                     map_specs,
+                                     "%s_%s_sparsity" % fs_names,
+                                     nest=nest, baij=baij)
             result_matrix = matrix.Matrix(f, bcs, sparsity, numpy.float64,
                                           "%s_%s_matrix" % fs_names,
                                           options_prefix=options_prefix)
             tensor = result_matrix._M
         else:
-            if isinstance(tensor, matrix.ImplicitMatrix):
-                raise ValueError("Expecting matfree with implicit matrix")
+            if isinstance(tensor, (matrix.ImplicitMatrix, matrix.UnassembledMatrix)):
+                raise ValueError("Expecting matfree with implicit matrix, or 'is' with unassembled matrix")
 
             result_matrix = tensor
             # Replace any bcs on the tensor we passed in
@@ -328,11 +1301,18 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             raise ValueError("BAIJ matrix type makes no sense for mixed spaces, use 'aij'")
 
         def mat(testmap, trialmap, i, j):
-            m = testmap(test.function_space()[i])
-            n = trialmap(trial.function_space()[j])
+            # Indices of None denote the whole (mixed) matrix
+            if i is None:
+                m = testmap(test.function_space())
+                n = trialmap(trial.function_space())
+                block = tensor
+            else:
+                m = testmap(test.function_space()[i])
+                n = trialmap(trial.function_space()[j])
+                block = tensor[i, j]
             maps = (m[op2.i[0]] if m else None,
                     n[op2.i[1 if m else 0]] if n else None)
-            return tensor[i, j](op2.INC, maps)
+            return block(op2.INC, maps)
         result = lambda: result_matrix
         if allocate_only:
             result_matrix._assembly_callback = None
@@ -348,8 +1328,14 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             zero_tensor = tensor.zero
 
         def vec(testmap, i):
-            _testmap = testmap(test.function_space()[i])
-            return tensor[i](op2.INC, _testmap[op2.i[0]] if _testmap else None)
+            if i is None:
+                # The whole (mixed) vector
+                _testmap = testmap(test.function_space())
+                block = tensor
+            else:
+                _testmap = testmap(test.function_space()[i])
+                block = tensor[i]
+            return block(op2.INC, _testmap[op2.i[0]] if _testmap else None)
         result = lambda: result_function
     else:
         # 0-forms are always scalar
@@ -411,7 +1397,7 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             # Extract block from tensor and test/trial spaces
             # FIXME Ugly variable renaming required because functions are not
             # lexical closures in Python and we're writing to these variables
-            if is_mat and result_matrix.block_shape > (1, 1):
+            if is_mat and result_matrix.block_shape > (1, 1) and i is not None:
                 tsbc = []
                 trbc = []
                 # Unwind ComponentFunctionSpace to check for matching BCs
@@ -427,65 +1413,21 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
                 tsbc, trbc = bcs, bcs
 
             # Now build arguments for the par_loop
-            kwargs = {}
-            # Some integrals require non-coefficient arguments at the
-            # end (facet number information).
-            extra_args = []
-            # Decoration for applying to matrix maps in extruded case
-            decoration = None
-            itspace = m.measure_set(integral_type, subdomain_id,
-                                    all_integer_subdomain_ids)
-            if integral_type == "cell":
-                itspace = sdata or itspace
-
-                if subdomain_id not in ["otherwise", "everywhere"] and \
-                   sdata is not None:
-                    raise ValueError("Cannot use subdomain data and subdomain_id")
-
-                def get_map(x, bcs=None, decoration=None):
-                    return x.cell_node_map(bcs)
-
-            elif integral_type in ("exterior_facet", "exterior_facet_vert"):
-                extra_args.append(m.exterior_facets.local_facet_dat(op2.READ))
-
-                def get_map(x, bcs=None, decoration=None):
-                    return x.exterior_facet_node_map(bcs)
-
-            elif integral_type in ("exterior_facet_top", "exterior_facet_bottom"):
-                # In the case of extruded meshes with horizontal facet integrals, two
-                # parallel loops will (potentially) get created and called based on the
-                # domain id: interior horizontal, bottom or top.
-                decoration = {"exterior_facet_top": op2.ON_TOP,
-                              "exterior_facet_bottom": op2.ON_BOTTOM}[integral_type]
-                kwargs["iterate"] = decoration
-
-                def get_map(x, bcs=None, decoration=None):
-                    map_ = x.cell_node_map(bcs)
-                    if decoration is not None:
-                        return op2.DecoratedMap(map_, decoration)
-                    return map_
-
-            elif integral_type in ("interior_facet", "interior_facet_vert"):
-                extra_args.append(m.interior_facets.local_facet_dat(op2.READ))
-
-                def get_map(x, bcs=None, decoration=None):
-                    return x.interior_facet_node_map(bcs)
-
-            elif integral_type == "interior_facet_horiz":
-                decoration = op2.ON_INTERIOR_FACETS
-                kwargs["iterate"] = decoration
-
-                def get_map(x, bcs=None, decoration=None):
-                    map_ = x.cell_node_map(bcs)
-                    if decoration is not None:
-                        return op2.DecoratedMap(map_, decoration)
-                    return map_
-
-            else:
-                raise ValueError("Unknown integral type '%s'" % integral_type)
+            itspace, get_map, decoration, extra_args, kwargs = \
+                _loop_setup(m, integral_type, subdomain_id,
+                            all_integer_subdomain_ids, sdata)
 
             # Output argument
-            if is_mat:
+            if is_mat and unassembled:
+                # Each entity contributes to the local matrix of the
+                # process owning it, so only owned entities are
+                # visited.  Boundary conditions are applied to the
+                # assembled matrix.
+                itspace = owned(itspace)
+                tensor_arg = mat(lambda s: local_map(get_map(s)),
+                                 lambda s: local_map(get_map(s)),
+                                 i, j)
+            elif is_mat:
                 tensor_arg = mat(lambda s: get_map(s, tsbc, decoration),
                                  lambda s: get_map(s, trbc, decoration),
                                  i, j)
@@ -494,17 +1436,33 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             else:
                 tensor_arg = tensor(op2.INC)
 
-            coords = m.coordinates
-            args = [kernel, itspace, tensor_arg,
-                    coords.dat(op2.READ, get_map(coords)[op2.i[0]])]
-            if needs_orientations:
-                o = m.cell_orientations()
-                args.append(o.dat(op2.READ, get_map(o)[op2.i[0]]))
-            for n in coeff_map:
-                c = coefficients[n]
-                for c_ in c.split():
-                    m_ = get_map(c_)
-                    args.append(c_.dat(op2.READ, m_ and m_[op2.i[0]]))
+            if batched is not None:
+                # The kernel is executed on batches of cells, and adds
+                # the local tensor of each cell of a batch into the
+                # global tensor through the maps from the batches.
+                itspace = batched.iterset
+                positions = range(batched.batch_size)
+                if is_mat:
+                    tensor_args = [mat(lambda s, p=p: batched.map(get_map(s, tsbc, decoration), p),
+                                       lambda s, p=p: batched.map(get_map(s, trbc, decoration), p),
+                                       i, j)
+                                   for p in positions]
+                else:
+                    tensor_args = [vec(lambda s, p=p: batched.map(get_map(s), p), i)
+                                   for p in positions]
+                args = [kernel, itspace] + tensor_args + batched.input_args()
+            else:
+                coords = m.coordinates
+                args = [kernel, itspace, tensor_arg,
+                        coords.dat(op2.READ, get_map(coords)[op2.i[0]])]
+                if needs_orientations:
+                    o = m.cell_orientations()
+                    args.append(o.dat(op2.READ, get_map(o)[op2.i[0]]))
+                for n in coeff_map:
+                    c = coefficients[n]
+                    for c_ in c.split():
+                        m_ = get_map(c_)
+                        args.append(c_.dat(op2.READ, m_ and m_[op2.i[0]]))
             if needs_cell_facets:
                 assert integral_type == "cell"
                 extra_args.append(m.cell_to_facets(op2.READ))
@@ -512,16 +1470,39 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             args.extend(extra_args)
             kwargs["pass_layer_arg"] = pass_layer_arg
 
+            # Linear forms may be executed by several threads over a
+            # coloured iteration set, since their only written
+            # argument is indirectly incremented.
+            nthreads = parameters.parameters["assembly_threads"]
+            colour_map = get_map(test.function_space()[i]) if is_vec and i is not None else None
+            threaded = nthreads > 1 and colour_map is not None \
+                and not m.cell_set._extruded and batched is None
+
+            # While profiling, loops are collected and wrapped so that
+            # their execution is recorded.
+            profile = collect_loops or bool(profiling._profiles)
             try:
-                with collecting_loops(collect_loops):
-                    loops.append(op2.par_loop(*args, **kwargs))
+                with collecting_loops(collect_loops or profile):
+                    if threaded:
+                        cache = topology._shared_data_cache["colourings"]
+                        loop = colouring.coloured_par_loop(args[0], args[1], colour_map,
+                                                           *args[2:], nthreads=nthreads,
+                                                           cache=cache, **kwargs)
+                    else:
+                        loop = op2.par_loop(*args, **kwargs)
+                if profile:
+                    loop = profiling.profiled(loop, kernel, integral_type, subdomain_id,
+                                              itspace, args[2:])
+                    if not collect_loops:
+                        loop()
+                loops.append(loop)
             except MapValueError:
                 raise RuntimeError("Integral measure does not match measure of all coefficients/arguments")
 
         # Must apply bcs outside loop over kernels because we may wish
         # to apply bcs to a block which is otherwise zero, and
         # therefore does not have an associated kernel.
-        if bcs is not None and is_mat:
+        if bcs is not None and is_mat and not unassembled:
             for bc in bcs:
                 fs = bc.function_space()
                 # Evaluate this outwith a "collecting_loops" block,
@@ -559,8 +1540,18 @@ def _assemble(f, tensor=None, bcs=None, form_compiler_parameters=None,
             if len(bcs) > 0 and collect_loops:
                 raise NotImplementedError("Loop collection not handled in this case")
             for bc in bcs:
-                bc.apply(result_function)
-        if is_mat:
+                if diagonal:
+                    _set_bc_diagonal(bc, result_function)
+                else:
+                    bc.apply(result_function)
+        if is_mat and unassembled:
+            def set_local_matrix():
+                _set_unassembled_local_matrix(result_matrix, tensor, bcs)
+            if collect_loops:
+                loops.append(set_local_matrix)
+            else:
+                set_local_matrix()
+        elif is_mat:
             # Queue up matrix assembly (after we've done all the other operations)
             loops.append(tensor.assemble())
         return result()
@@ -0,0 +1,216 @@
+"""Threaded execution of assembly loops over coloured iteration sets.
+
+Entities (cells or facets) are coloured such that no two entities of
+the same colour share a node of the space being incremented.  The
+entities of each colour can then be processed concurrently without
+conflicting writes.  The compiled kernels are called through
+:mod:`ctypes`, which releases the GIL, so the threads run in parallel.
+The threads are taken from a pool which is cached with the colouring,
+rather than created each time a loop is executed, until the cache is
+cleared with :func:`clear_colouring_cache`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from pyop2 import op2
+from pyop2.datatypes import IntType
+from pyop2.profiling import timed_region
+from pyop2.sequential import ParLoop
+
+
+__all__ = ["coloured_par_loop", "clear_colouring_cache"]
+
+
+def _greedy_colouring(nodes):
+    """Colour entities such that no two entities of the same colour
+    share a node.
+
+    :arg nodes: an array of shape ``(nentities, arity)`` giving the
+        nodes of each entity.
+    :returns: an array of the colour of each entity.
+
+    The colouring is computed with the Jones-Plassmann algorithm,
+    vectorised across the entities.  Each entity is given a random
+    weight.  In each round, the uncoloured entities with the largest
+    weight of all the uncoloured entities sharing a node with them
+    form an independent set, and are each given the smallest colour
+    not yet used by an entity sharing a node with them.
+    """
+    nentities = len(nodes)
+    colours = numpy.empty(nentities, dtype=IntType)
+    if nentities == 0:
+        return colours
+    nnodes = nodes.max() + 1
+    # Distinct weights, the same on every run.
+    weights = numpy.random.RandomState(0).permutation(nentities) + 1
+    # used[n, c] is True if an entity touching node n already has
+    # colour c.
+    used = numpy.zeros((nnodes, 8), dtype=bool)
+    uncoloured = numpy.arange(nentities)
+    largest = numpy.zeros(nnodes, dtype=weights.dtype)
+    while len(uncoloured):
+        entity_nodes = nodes[uncoloured]
+        entity_weights = weights[uncoloured]
+        largest[:] = 0
+        numpy.maximum.at(largest, entity_nodes.ravel(),
+                         numpy.repeat(entity_weights, nodes.shape[1]))
+        selected = entity_weights == largest[entity_nodes].max(axis=1)
+        entity_nodes = entity_nodes[selected]
+        forbidden = used[entity_nodes].any(axis=1)
+        while forbidden.all(axis=1).any():
+            used = numpy.concatenate([used, numpy.zeros_like(used)], axis=1)
+            forbidden = used[entity_nodes].any(axis=1)
+        colour = numpy.argmin(forbidden, axis=1)
+        colours[uncoloured[selected]] = colour
+        used[entity_nodes, colour[:, numpy.newaxis]] = True
+        uncoloured = uncoloured[~selected]
+    return colours
+
+
+def colour_iterset(itspace, map_):
+    """Colour an iteration set for threaded execution.
+
+    :arg itspace: the :class:`pyop2.Set` or :class:`pyop2.Subset`
+        to colour.
+    :arg map_: the :class:`pyop2.Map` from the iteration set to the
+        nodes being incremented.
+    :returns: a tuple ``(subset, permutation, boundaries)``.
+        ``subset`` is a :class:`pyop2.Subset` containing the same
+        entities as ``itspace``.  ``permutation`` is an array of the
+        same entities, ordered by colour within each of the core,
+        owned and halo parts of ``subset``, and ``boundaries`` is a
+        sorted array of the offsets into ``permutation`` at which a
+        new colour (or part) starts.
+
+    The colour order is kept separately from ``subset``, since a
+    :class:`pyop2.Subset` sorts its indices.
+    """
+    if isinstance(itspace, op2.Subset):
+        superset = itspace.superset
+        indices = itspace.indices
+        subset = itspace
+    else:
+        superset = itspace
+        indices = numpy.arange(superset.total_size, dtype=IntType)
+        subset = op2.Subset(superset, indices)
+    colours = _greedy_colouring(map_.values_with_halo[indices])
+    ncolours = colours.max() + 1 if len(colours) else 0
+
+    permuted = [numpy.empty(0, dtype=IntType)]
+    boundaries = [0]
+    for lo, hi in [(0, superset.core_size),
+                   (superset.core_size, superset.size),
+                   (superset.size, superset.total_size)]:
+        selected = (indices >= lo) & (indices < hi)
+        part_indices = indices[selected]
+        part_colours = colours[selected]
+        order = numpy.argsort(part_colours, kind="mergesort")
+        permuted.append(part_indices[order])
+        counts = numpy.bincount(part_colours, minlength=ncolours)
+        boundaries.extend(boundaries[-1] + numpy.cumsum(counts))
+    permutation = numpy.ascontiguousarray(numpy.concatenate(permuted), dtype=IntType)
+    return subset, permutation, numpy.unique(boundaries)
+
+
+def _pool(cache, nthreads):
+    """Return the pool of ``nthreads`` threads stored in ``cache``,
+    creating it if necessary."""
+    try:
+        return cache[("pool", nthreads)]
+    except KeyError:
+        return cache.setdefault(("pool", nthreads), ThreadPoolExecutor(max_workers=nthreads))
+
+
+class ColouredParLoop(ParLoop):
+    """A :class:`pyop2.sequential.ParLoop` over a coloured iteration
+    set (see :func:`colour_iterset`), which executes the entities of
+    each colour concurrently in a pool of threads.
+
+    :kwarg permutation: the entities of the iteration set (which must
+        be a :class:`pyop2.Subset`) in colour order.
+    :kwarg boundaries: the offsets at which each colour starts.
+    :kwarg nthreads: the number of threads to use.
+    :kwarg cache: the dict holding the
+        :class:`~concurrent.futures.ThreadPoolExecutor` to execute
+        the entities in (see :func:`_pool`).
+    """
+
+    def __init__(self, kernel, iterset, *args, **kwargs):
+        self._permutation = kwargs.pop("permutation")
+        self._boundaries = kwargs.pop("boundaries")
+        self._nthreads = kwargs.pop("nthreads")
+        self._cache = kwargs.pop("cache")
+        super(ColouredParLoop, self).__init__(kernel, iterset, *args, **kwargs)
+
+    def _compute(self, part, fun, *arglist):
+        start = part.offset
+        end = part.offset + part.size
+        if start == end:
+            return
+        # The first argument of a loop over a subset is its (sorted)
+        # indices, replace them with the entities in colour order.
+        arglist = (self._permutation.ctypes.data, ) + arglist[1:]
+        # Ensure the kernel is compiled before it is called from
+        # several threads, by calling it on an empty range.
+        fun(start, start, *arglist)
+        bounds = self._boundaries
+        bounds = numpy.unique(numpy.concatenate([[start, end],
+                                                 bounds[(bounds > start) & (bounds < end)]]))
+
+        def run(chunk):
+            fun(chunk[0], chunk[1], *arglist)
+
+        # The pool is looked up on each execution, since it is shut
+        # down if the cache is cleared.
+        pool = _pool(self._cache, self._nthreads)
+        with timed_region("ParLoop%s" % self.iterset.name):
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                # Entities of one colour don't conflict, so split
+                # them between the threads.
+                chunks = numpy.linspace(lo, hi, self._nthreads + 1).astype(int)
+                list(pool.map(run, zip(chunks[:-1], chunks[1:])))
+
+
+def coloured_par_loop(kernel, itspace, map_, *args, **kwargs):
+    """Execute a kernel over an iteration set in several threads.
+
+    :arg kernel: the :class:`pyop2.Kernel` to execute.
+    :arg itspace: the iteration set.
+    :arg map_: the map from the iteration set to the nodes of the
+        (single) incremented argument, used to colour the iteration set.
+    :arg args: the arguments to the par_loop.
+    :kwarg nthreads: the number of threads to use.
+    :kwarg cache: an optional dict in which to cache the colouring of
+        ``itspace``, and the pool of threads.
+
+    Other keyword arguments are passed to the :class:`pyop2.ParLoop`.
+    Since concurrent writes are only excluded for the nodes of
+    ``map_``, there must be no other arguments which are written to.
+    """
+    cache = kwargs.pop("cache", {})
+    nthreads = kwargs.pop("nthreads")
+    key = (itspace, map_)
+    try:
+        subset, permutation, boundaries = cache[key]
+    except KeyError:
+        subset, permutation, boundaries = cache.setdefault(key, colour_iterset(itspace, map_))
+    return ColouredParLoop(kernel, subset, *args, permutation=permutation,
+                           boundaries=boundaries, nthreads=nthreads,
+                           cache=cache, **kwargs).enqueue()
+
+
+def clear_colouring_cache(mesh):
+    """Evict the cached colourings of the iteration sets of a mesh,
+    and shut down the pools of threads executing the loops over them.
+
+    :arg mesh: the mesh whose colourings should be dropped.
+    """
+    cache = mesh.topology._shared_data_cache.pop("colourings", {})
+    for value in cache.values():
+        if isinstance(value, ThreadPoolExecutor):
+            value.shutdown()
+    # Loops which were already built (for example in cached assembly
+    # plans) hold on to the cache, and create a new pool if executed
+    # again.
+    cache.clear()
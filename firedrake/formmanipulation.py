@@ -1,9 +1,13 @@
 
 import numpy
 import collections
+import functools
+import operator
 
-from ufl import as_vector
-from ufl.classes import Zero
+from ufl import as_vector, Form
+from ufl.algorithms import expand_derivatives
+from ufl.corealg.traversal import traverse_unique_terminals
+from ufl.classes import ConstantValue, Division, IntValue, Product, Sum, Zero
 from ufl.algorithms.map_integrands import map_integrand_dags
 from ufl.corealg.map_dag import MultiFunction
 
@@ -129,3 +133,72 @@ def split_form(form):
         if len(f.integrals()) > 0:
             forms.append(SplitForm(indices=idx, form=f))
     return tuple(forms)
+
+
+def _is_constant_scalar(expr):
+    """Is ``expr`` a scalar which only depends on :class:`.Constant` objects
+    and literal values?"""
+    from firedrake.constant import Constant
+    if expr.ufl_shape != () or expr.ufl_free_indices:
+        return False
+    return all(isinstance(t, (Constant, ConstantValue))
+               for t in traverse_unique_terminals(expr))
+
+
+def _summands(expr):
+    if isinstance(expr, Sum):
+        return _summands(expr.ufl_operands[0]) + _summands(expr.ufl_operands[1])
+    return [expr]
+
+
+def _factors(expr):
+    if isinstance(expr, Product):
+        a, b = expr.ufl_operands
+        return _factors(a) + _factors(b)
+    if isinstance(expr, Division):
+        num, den = expr.ufl_operands
+        if _is_constant_scalar(den):
+            return _factors(num) + [1/den]
+    return [expr]
+
+
+def split_constant_terms(form):
+    """Split a form into terms scaled by :class:`.Constant` factors.
+
+    :arg form: the form to split.
+
+    Returns a tuple of ``(scale, term)`` pairs such that ``form`` is
+    equal to the sum of ``scale*term``, where each ``scale`` is a
+    scalar UFL expression depending only on :class:`.Constant` objects and
+    literals, and no ``term`` depends on a :class:`.Constant`.  For
+    example
+
+    .. code-block:: python
+
+        a = (1/dt)*u*v*dx + theta*inner(grad(u), grad(v))*dx
+
+    is split into ``((1/dt, u*v*dx), (theta, inner(grad(u), grad(v))*dx))``.
+    Only factors of top-level products are extracted; if some
+    :class:`.Constant` remains inside a term (for example in
+    ``sin(c)*u*v*dx``, ``c`` appears inside a nonlinear function),
+    ``None`` is returned instead.
+    """
+    from firedrake.constant import Constant
+    form = expand_derivatives(form)
+    terms = collections.OrderedDict()
+    for integral in form.integrals():
+        for summand in _summands(integral.integrand()):
+            scale = []
+            rest = []
+            for factor in _factors(summand):
+                (scale if _is_constant_scalar(factor) else rest).append(factor)
+            scale = functools.reduce(operator.mul, scale, IntValue(1))
+            integrand = functools.reduce(operator.mul, rest, IntValue(1))
+            terms.setdefault(scale, []).append(integral.reconstruct(integrand=integrand))
+    result = []
+    for scale, integrals in terms.items():
+        term = Form(integrals)
+        if any(isinstance(c, Constant) for c in term.coefficients()):
+            return None
+        result.append((scale, term))
+    return tuple(result)
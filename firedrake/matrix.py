@@ -1,4 +1,5 @@
 import abc
+import numpy
 
 from pyop2 import op2
 from pyop2.utils import as_tuple, flatten
@@ -6,6 +7,25 @@ from firedrake import utils
 from firedrake.petsc import PETSc
 
 
+def _bc_local_rows(bcs, block_size):
+    """Return the process-local (unblocked) rows of a matrix on a
+    non-mixed space which are constrained by some boundary conditions.
+
+    :arg bcs: an iterable of :class:`.DirichletBC`\s.
+    :arg block_size: the block size of the space the bcs are defined on.
+    """
+    rows = [numpy.empty(0, dtype=PETSc.IntType)]
+    for bc in bcs:
+        fs = bc.function_space()
+        if fs.component is not None:
+            components = (fs.component, )
+        else:
+            components = range(block_size)
+        nodes = bc.nodes
+        rows.extend(nodes*block_size + c for c in components)
+    return numpy.unique(numpy.concatenate(rows)).astype(PETSc.IntType)
+
+
 class MatrixBase(object, metaclass=abc.ABCMeta):
     """A representation of the linear operator associated with a
     bilinear form and bcs.  Explicitly assembled matrices and matrix-free
@@ -70,6 +90,16 @@ class MatrixBase(object, metaclass=abc.ABCMeta):
             :class:`.DirichletBC`), or an iterable of boundary
             conditions.  If bcs is None, erase all boundary conditions
             on the :class:`.MatrixBase`.
+
+        .. note::
+
+           Changing the boundary conditions of an assembled
+           monolithic :class:`.Matrix` on a single space (with the
+           same test and trial space) does not rerun the assembly
+           kernels.  Instead, a copy of the matrix without boundary
+           conditions is kept, from which the new boundary conditions
+           are applied.  This doubles the memory used by the matrix
+           until it is next reassembled.
         """
         self._bcs = []
         if bcs is not None:
@@ -160,6 +190,9 @@ class Matrix(MatrixBase):
         self.petscmat.setOptionsPrefix(options_prefix)
         self._thunk = None
         self.assembled = False
+        # Copy of the matrix without boundary conditions applied, used
+        # to update the boundary conditions without reassembly.
+        self._unconstrained = None
 
     @utils.known_pyop2_safe
     def assemble(self):
@@ -183,12 +216,21 @@ class Matrix(MatrixBase):
 
             will apply boundary conditions from `bc1` in the first
             solve, but both `bc1` and `bc2` in the second solve.
+
+            For monolithic matrices with the same non-mixed test and
+            trial space, such a change of boundary conditions does not rerun the assembly
+            kernels.  Instead, a copy of the matrix without boundary
+            conditions is kept (assembling it once if necessary), and
+            the new boundary conditions are applied to its values
+            with PETSc row and column operations.
         """
         if self._assembly_callback is None:
             self.assembled = True
             return
         if self.assembled:
             if self._needs_reassembly:
+                if self._update_bcs():
+                    return super().assemble()
                 from firedrake.assemble import _assemble
                 _assemble(self.a, tensor=self, bcs=self.bcs)
                 return self.assemble()
@@ -197,6 +239,44 @@ class Matrix(MatrixBase):
         self.assembled = True
         super().assemble()
 
+    def _update_bcs(self):
+        """Apply the current boundary conditions to the assembled
+        values without rerunning the assembly kernels.
+
+        :returns: True if the boundary conditions were applied, False
+            if this is not supported for this matrix (in which case it
+            must be reassembled).
+        """
+        test, trial = self.a.arguments()
+        if self.block_shape != (1, 1) or \
+           test.function_space() != trial.function_space() or \
+           self.petscmat.getType() not in ["seqaij", "mpiaij", "seqbaij", "mpibaij"]:
+            # Rectangular blocks have boundary conditions applied to
+            # the rows and columns separately, with no diagonal.
+            return False
+        bcs = self.bcs
+        if self._unconstrained is None:
+            if self._bcs_at_point_of_assembly:
+                # The contributions to the boundary rows and columns
+                # were dropped during assembly, so we need to assemble
+                # once without boundary conditions.
+                from firedrake.assemble import _assemble
+                _assemble(self.a, tensor=self, bcs=())
+                self.force_evaluation()
+                self.bcs = bcs
+            self._M._force_evaluation()
+            unconstrained = self.petscmat.copy()
+        else:
+            unconstrained = self._unconstrained
+            unconstrained.copy(self.petscmat,
+                               structure=PETSc.Mat.Structure.SAME_NONZERO_PATTERN)
+        if bcs:
+            V = self.a.arguments()[0].function_space()
+            rows = _bc_local_rows(bcs, V.dof_dset.cdim)
+            self.petscmat.zeroRowsColumnsLocal(rows, diag=1.0)
+        self._unconstrained = unconstrained
+        return True
+
     @property
     def _assembly_callback(self):
         """Return the callback for assembling this :class:`Matrix`."""
@@ -214,6 +294,9 @@ class Matrix(MatrixBase):
         to False, necessitating a re-assembly."""
         self._thunk = thunk
         self.assembled = False
+        # The values are about to change, so any copy without
+        # boundary conditions is stale.
+        self._unconstrained = None
 
     @property
     def M(self):
@@ -281,12 +364,84 @@ class ImplicitMatrix(MatrixBase):
         # Bump petsc matrix state by assembling it.
         # Ensures that if the matrix changed, the preconditioner is
         # updated if necessary.
+        ctx = self.petscmat.getPythonContext()
         if self._needs_reassembly:
-            ctx = self.petscmat.getPythonContext()
             ctx.row_bcs = self.bcs
             ctx.col_bcs = self.bcs
+        # The coefficients may have changed
+        ctx.update()
         self.petscmat.assemble()
         self.assembled = True
         super().assemble()
 
     force_evaluation = assemble
+
+
+class UnassembledMatrix(MatrixBase):
+    """A representation of an assembled bilinear form which is stored
+    unassembled, as a PETSc MATIS.  Each process holds the matrix of
+    the elements it owns, over all of its local (owned and halo)
+    degrees of freedom, and the global matrix is their sum.  This is
+    the format required by domain decomposition preconditioners such
+    as BDDC and FETI-DP.
+
+    :arg a: the bilinear form this :class:`UnassembledMatrix` represents.
+
+    :arg bcs: an iterable of boundary conditions to apply to this
+        :class:`UnassembledMatrix`.  May be `None` if there are no
+        boundary conditions to apply.
+
+    :arg options_prefix: an options prefix for the PETSc matrix.
+    """
+    def __init__(self, a, bcs, options_prefix=None):
+        # sets self._a and self._bcs
+        super(UnassembledMatrix, self).__init__(a, bcs)
+        test, trial = a.arguments()
+        row_dset = test.function_space().dof_dset
+        col_dset = trial.function_space().dof_dset
+        self.petscmat = PETSc.Mat().create(comm=self.comm)
+        self.petscmat.setType("is")
+        self.petscmat.setSizes((row_dset.layout_vec.getSizes(),
+                                col_dset.layout_vec.getSizes()),
+                               bsize=(row_dset.cdim, col_dset.cdim))
+        self.petscmat.setLGMap(row_dset.lgmap, col_dset.lgmap)
+        self.petscmat.setOptionsPrefix(options_prefix)
+        self.petscmat.setUp()
+        self._thunk = None
+        self.assembled = False
+
+    @utils.known_pyop2_safe
+    def assemble(self):
+        """Actually assemble this :class:`UnassembledMatrix`.
+
+        This calls the stashed assembly callback or does nothing if
+        the matrix is already assembled with the current boundary
+        conditions.
+        """
+        if self._assembly_callback is None:
+            self.assembled = True
+            return
+        if self.assembled and not self._needs_reassembly:
+            return
+        self._assembly_callback(self.bcs)
+        self.assembled = True
+        super().assemble()
+
+    @property
+    def _assembly_callback(self):
+        """Return the callback for assembling this :class:`UnassembledMatrix`."""
+        return self._thunk
+
+    @_assembly_callback.setter
+    def _assembly_callback(self, thunk):
+        """Set the callback for assembling this :class:`UnassembledMatrix`.
+
+        :arg thunk: the callback, this should take one argument, the
+            boundary conditions to apply.
+
+        Assigning to this property sets the :attr:`assembled` property
+        to False, necessitating a re-assembly."""
+        self._thunk = thunk
+        self.assembled = False
+
+    force_evaluation = assemble
@@ -1,5 +1,9 @@
+import numpy
+import ufl
+
 from firedrake.ufl_expr import adjoint, action
 from firedrake.formmanipulation import ExtractSubBlock
+from firedrake.matrix import _bc_local_rows
 
 from firedrake.petsc import PETSc
 
@@ -46,6 +50,59 @@ def find_sub_block(iset, ises):
     return found
 
 
+def bc_vec_indices(bcs, V):
+    """Determine the process-local indices, in a PETSc Vec on a
+    (possibly mixed) function space, of the owned degrees of freedom
+    constrained by some boundary conditions.
+
+    :arg bcs: an iterable of :class:`.DirichletBC`\s on (subspaces
+        of) ``V``.
+    :arg V: the function space.
+
+    :returns: a sorted array of indices.
+    """
+    offsets = numpy.cumsum([0] + [Vi.dof_dset.size * Vi.dof_dset.cdim
+                                  for Vi in V])
+    indices = [numpy.empty(0, dtype=PETSc.IntType)]
+    for bc in bcs:
+        fs = bc.function_space()
+        index = fs.parent.index if fs.component is not None else fs.index
+        i = index or 0
+        Vi = V[i]
+        rows = _bc_local_rows([bc], Vi.dof_dset.cdim)
+        # Only the owned rows are in the Vec
+        rows = rows[rows < Vi.dof_dset.size * Vi.dof_dset.cdim]
+        indices.append(rows + offsets[i])
+    return numpy.unique(numpy.concatenate(indices)).astype(PETSc.IntType)
+
+
+def action_parameters(a, fc_params):
+    """Determine the form compiler parameters for the matrix-free
+    actions of a bilinear form.
+
+    :arg a: the bilinear form.
+    :arg fc_params: the user supplied form compiler parameters (may
+        be `None`).
+
+    :returns: a `dict` of form compiler parameters.
+
+    On tensor-product cells (quadrilaterals, hexahedra and extruded
+    cells), TSFC's spectral mode is selected, unless a mode is given
+    explicitly.  It sum factorises the evaluation of the coefficient
+    and the integration against the test functions in the action
+    kernels, reducing the cost of each kernel from :math:`O(p^{2d})`
+    to :math:`O(p^{d+1})` for elements of degree :math:`p` in
+    dimension :math:`d`.
+    """
+    params = dict(fc_params or {})
+    cell = a.ufl_domain().ufl_cell()
+    tensor_product = isinstance(cell, ufl.TensorProductCell) \
+        or cell.cellname() in ["quadrilateral", "hexahedron"]
+    if "mode" not in params and tensor_product:
+        params["mode"] = "spectral"
+    return params
+
+
 class ImplicitMatrixContext(object):
     # By default, these matrices will represent diagonal blocks (the
     # (0,0) block of a 1x1 block matrix is on the diagonal).
@@ -90,14 +147,6 @@ class ImplicitMatrixContext(object):
         self._y = function.Function(test_space)
         self._x = function.Function(trial_space)
 
-        # These are temporary storage for holding the BC
-        # values during matvec application.  _xbc is for
-        # the action and ._ybc is for transpose.
-        if len(self.row_bcs) > 0:
-            self._xbc = function.Function(trial_space)
-        if len(self.col_bcs) > 0:
-            self._ybc = function.Function(test_space)
-
         # Get size information from template vecs on test and trial spaces
         trial_vec = trial_space.dof_dset.layout_vec
         test_vec = test_space.dof_dset.layout_vec
@@ -109,12 +158,53 @@ class ImplicitMatrixContext(object):
         self.action = action(self.a, self._x)
         self.actionT = action(self.aT, self._y)
 
+        # Sum factorised actions on tensor-product cells
+        self.action_fc_params = action_parameters(self.a, self.fc_params)
+
         from firedrake.assemble import create_assembly_callable
         self._assemble_action = create_assembly_callable(self.action, tensor=self._y,
-                                                         form_compiler_parameters=self.fc_params)
+                                                         form_compiler_parameters=self.action_fc_params)
 
         self._assemble_actionT = create_assembly_callable(self.actionT, tensor=self._x,
-                                                          form_compiler_parameters=self.fc_params)
+                                                          form_compiler_parameters=self.action_fc_params)
+
+        # Functions into which the diagonal and the diagonal blocks
+        # are reassembled when they are stale
+        self._diagonal_tensors = {}
+
+        # Actions on several vectors at once, by number of vectors
+        self._block_actions = {}
+        # Whether the kernels of the actions on several vectors can be
+        # fused (see assemble_many)
+        self._fuse_block_actions = True
+
+        # Contexts of the submatrices extracted by createSubMatrix, by
+        # the indices of their row and column fields
+        self._submatrices = {}
+
+    # The entries of the (owned parts of the) vectors constrained by
+    # the boundary conditions are set directly on the PETSc Vecs
+    # during matvec application.  Their indices are updated whenever
+    # the boundary conditions are replaced.
+    @property
+    def row_bcs(self):
+        return self._row_bcs
+
+    @row_bcs.setter
+    def row_bcs(self, bcs):
+        self._row_bcs = bcs
+        self._diagonal_cache = {}
+        self._row_bc_indices = bc_vec_indices(bcs, self.a.arguments()[0].function_space())
+
+    @property
+    def col_bcs(self):
+        return self._col_bcs
+
+    @col_bcs.setter
+    def col_bcs(self, bcs):
+        self._col_bcs = bcs
+        self._diagonal_cache = {}
+        self._col_bc_indices = bc_vec_indices(bcs, self.a.arguments()[1].function_space())
 
     def mult(self, mat, X, Y):
         with self._x.dat.vec_wo as v:
@@ -122,9 +212,9 @@ class ImplicitMatrixContext(object):
 
         # if we are a block on the diagonal, then the matrix has an
         # identity block corresponding to the Dirichlet boundary conditions.
-        # our algorithm in this case is to save the BC values, zero them
-        # out before computing the action so that they don't pollute
-        # anything, and then set the values into the result.
+        # our algorithm in this case is to zero the BC values out
+        # before computing the action so that they don't pollute
+        # anything, and then set the values of X into the result.
         # This has the effect of applying
         # [ A_II 0 ; 0 I ] where A_II is the block corresponding only to
         # non-fixed dofs and I is the identity block on the fixed dofs.
@@ -136,22 +226,18 @@ class ImplicitMatrixContext(object):
 
         self._assemble_action()
 
-        # This sets the essential boundary condition values on the
-        # result.
-        if self.on_diag:
-            if len(self.row_bcs) > 0:
-                # TODO, can we avoid the copy?
-                with self._xbc.dat.vec_wo as v:
-                    X.copy(v)
-            for bc in self.row_bcs:
-                bc.set(self._y, self._xbc)
-        else:
-            for bc in self.row_bcs:
-                bc.zero(self._y)
-
         with self._y.dat.vec_ro as v:
             v.copy(Y)
 
+        # This sets the essential boundary condition values on the
+        # result, reading them straight from X.
+        rows = self._row_bc_indices
+        if len(rows) > 0:
+            if self.on_diag:
+                Y.array[rows] = X.array_r[rows]
+            else:
+                Y.array[rows] = 0.0
+
     def multTranspose(self, mat, Y, X):
         # As for mult, just everything swapped round.
         with self._y.dat.vec_wo as v:
@@ -162,20 +248,177 @@ class ImplicitMatrixContext(object):
 
         self._assemble_actionT()
 
-        if self.on_diag:
-            if len(self.col_bcs) > 0:
-                # TODO, can we avoid the copy?
-                with self._ybc.dat.vec_wo as v:
-                    Y.copy(v)
-            for bc in self.col_bcs:
-                bc.set(self._x, self._ybc)
-        else:
-            for bc in self.col_bcs:
-                bc.zero(self._x)
-
         with self._x.dat.vec_ro as v:
             v.copy(X)
 
+        cols = self._col_bc_indices
+        if len(cols) > 0:
+            if self.on_diag:
+                X.array[cols] = Y.array_r[cols]
+            else:
+                X.array[cols] = 0.0
+
+    def _block_action(self, k):
+        """Set up the simultaneous action of the operator on ``k``
+        vectors.
+
+        :returns: a tuple ``(xs, ys, apply)`` of the ``k``
+            :class:`.Function`\s to act on, the ``k`` :class:`.Function`\s
+            receiving the results and a callable computing them.
+
+        Only the set up for the most recently used ``k`` is kept.
+        """
+        try:
+            return self._block_actions[k]
+        except KeyError:
+            self._block_actions.clear()
+        from firedrake import function
+        from firedrake.assemble import assemble_many
+        test_space, trial_space = [arg.function_space() for arg in self.a.arguments()]
+        xs = tuple(function.Function(trial_space) for _ in range(k))
+        ys = tuple(function.Function(test_space) for _ in range(k))
+        forms = tuple(action(self.a, x) for x in xs)
+
+        def apply():
+            # A single traversal of the mesh, gathering the
+            # coordinates and coefficients of the operator once for
+            # all the vectors.
+            assemble_many(forms, tensors=ys,
+                          form_compiler_parameters=self.action_fc_params)
+        return self._block_actions.setdefault(k, (xs, ys, apply))
+
+    def matMult(self, mat, B, C=None):
+        """Compute the product ``C = A B`` of the operator with a
+        dense matrix, acting on all the columns of ``B`` at once.
+
+        :arg mat: the PETSc matrix of this context.
+        :arg B: a dense PETSc matrix, with rows distributed as the
+            columns of the operator.
+        :arg C: an optional dense PETSc matrix for the result, with
+            rows distributed as the rows of the operator.
+        :returns: ``C``.
+
+        The actions on the columns are assembled in a single
+        traversal of the mesh, unless their kernels can not be fused
+        (for example on extruded meshes), in which case the operator
+        is applied to each column in turn.
+
+        .. note::
+
+           PETSc does not call this for ``mat.matMult(B)``, call it on
+           the context directly, as
+           ``mat.getPythonContext().matMult(mat, B)``.
+        """
+        if C is None:
+            C = PETSc.Mat().createDense((mat.getSizes()[0], B.getSizes()[1]),
+                                        comm=mat.comm)
+            C.setUp()
+        Barray = B.getDenseArray()
+        Carray = C.getDenseArray()
+        k = Barray.shape[1]
+        if self._fuse_block_actions:
+            xs, ys, apply = self._block_action(k)
+            for j, x in enumerate(xs):
+                with x.dat.vec_wo as v:
+                    v.array[:] = Barray[:, j]
+                for bc in self.col_bcs:
+                    bc.zero(x)
+            try:
+                apply()
+            except NotImplementedError:
+                self._fuse_block_actions = False
+                self._block_actions.clear()
+            else:
+                # As for mult
+                rows = self._row_bc_indices
+                for j, y in enumerate(ys):
+                    with y.dat.vec_ro as v:
+                        Carray[:, j] = v.array_r
+                    if len(rows) > 0:
+                        Carray[rows, j] = Barray[rows, j] if self.on_diag else 0.0
+                C.assemble()
+                return C
+        X, Y = mat.createVecs()
+        for j in range(k):
+            X.array[:] = Barray[:, j]
+            self.mult(mat, X, Y)
+            Carray[:, j] = Y.array_r
+        C.assemble()
+        return C
+
+    def update(self):
+        """Mark the data computed from the operator, such as its
+        diagonal, as stale, since it must be recomputed when its
+        coefficients change.  This is called whenever the matrix is
+        reassembled."""
+        self._diagonal_cache = {}
+        for submat_ctx, _ in self._submatrices.values():
+            submat_ctx.update()
+
+    def _diagonal(self):
+        """The diagonal of the operator, as a :class:`.Function` in
+        the test space."""
+        try:
+            return self._diagonal_cache["diagonal"]
+        except KeyError:
+            pass
+        from firedrake import assemble, function
+        try:
+            diagonal = self._diagonal_tensors["diagonal"]
+        except KeyError:
+            diagonal = function.Function(self.a.arguments()[0].function_space())
+            self._diagonal_tensors["diagonal"] = diagonal
+        # Only the diagonal kernels are executed.  Rows constrained by
+        # the boundary conditions are the identity on the diagonal and
+        # zero elsewhere.
+        assemble(self.a, tensor=diagonal, bcs=self.row_bcs if self.on_diag else (),
+                 form_compiler_parameters=self.fc_params, diagonal=True)
+        if not self.on_diag:
+            for bc in self.row_bcs:
+                bc.zero(diagonal)
+        return self._diagonal_cache.setdefault("diagonal", diagonal)
+
+    def getDiagonal(self, mat, vec):
+        with self._diagonal().dat.vec_ro as d:
+            d.copy(vec)
+
+    def invertBlockDiagonal(self, mat):
+        try:
+            return self._diagonal_cache["inverse_block_diagonal"]
+        except KeyError:
+            pass
+        if not self.on_diag:
+            raise NotImplementedError("Block diagonal of an off-diagonal block not implemented")
+        V = self.a.arguments()[0].function_space()
+        bs = V.dof_dset.cdim if len(V) == 1 else 1
+        if bs == 1:
+            with self._diagonal().dat.vec_ro as d:
+                inverse = 1.0 / d.array_r
+        else:
+            from firedrake import assemble, function, functionspace
+            try:
+                blocks = self._diagonal_tensors["block_diagonal"]
+            except KeyError:
+                # The blocks of each node, as a tensor-valued function.
+                # This shares the node numbering of V.
+                T = functionspace.TensorFunctionSpace(V.mesh(), V.ufl_element().sub_elements()[0],
+                                                      shape=(bs, bs))
+                blocks = function.Function(T)
+                self._diagonal_tensors["block_diagonal"] = blocks
+            params = dict(self.fc_params or {})
+            params["assemble_block_diagonal"] = bs
+            assemble(self.a, tensor=blocks, form_compiler_parameters=params,
+                     diagonal=True)
+            values = blocks.dat.data_ro[:V.node_set.size].reshape(-1, bs, bs).copy()
+            # Rows and columns constrained by the boundary conditions
+            nodes, components = numpy.divmod(self._row_bc_indices, bs)
+            values[nodes, components, :] = 0
+            values[nodes, :, components] = 0
+            values[nodes, components, components] = 1
+            # PETSc stores the blocks in column major order
+            inverse = numpy.linalg.inv(values).transpose(0, 2, 1).ravel()
+        return self._diagonal_cache.setdefault("inverse_block_diagonal", inverse)
+
     def view(self, mat, viewer=None):
         if viewer is None:
             return
@@ -188,10 +431,8 @@ class ImplicitMatrixContext(object):
     def getInfo(self, mat, info=None):
         from mpi4py import MPI
         memory = self._x.dat.nbytes + self._y.dat.nbytes
-        if hasattr(self, "_xbc"):
-            memory += self._xbc.dat.nbytes
-        if hasattr(self, "_ybc"):
-            memory += self._ybc.dat.nbytes
+        for xs, ys, _ in self._block_actions.values():
+            memory += sum(f.dat.nbytes for f in xs + ys)
         if info is None:
             info = PETSc.Mat.InfoType.GLOBAL_SUM
         if info == PETSc.Mat.InfoType.LOCAL:
@@ -215,7 +456,6 @@ class ImplicitMatrixContext(object):
             # actually assemble in here.
             target.assemble()
             return target
-        from firedrake import DirichletBC
 
         # These are the sets of ISes of which the the row and column
         # space consist.
@@ -228,8 +468,53 @@ class ImplicitMatrixContext(object):
         else:
             col_inds = find_sub_block(col_is, col_ises)
 
-        asub = ExtractSubBlock().split(self.a,
-                                       argument_indices=(row_inds, col_inds))
+        # The contexts of submatrices are cached by the blocks they
+        # extract, and updated in place when requested again.  Each
+        # call returns a new PETSc Mat wrapping the context, so that
+        # callers (for example nested fieldsplits) can set their own
+        # options prefix on it.
+        key = (tuple(row_inds), tuple(col_inds))
+        bcs_key = (tuple(self.row_bcs), tuple(self.col_bcs))
+        try:
+            submat_ctx, submat_bcs_key = self._submatrices[key]
+        except KeyError:
+            asub = ExtractSubBlock().split(self.a,
+                                           argument_indices=(row_inds, col_inds))
+            row_bcs, col_bcs = self._sub_bcs(asub, row_inds, col_inds)
+            submat_ctx = ImplicitMatrixContext(asub,
+                                               row_bcs=row_bcs,
+                                               col_bcs=col_bcs,
+                                               fc_params=self.fc_params,
+                                               appctx=self.appctx)
+        else:
+            if submat_bcs_key != bcs_key:
+                submat_ctx.row_bcs, submat_ctx.col_bcs = \
+                    self._sub_bcs(submat_ctx.a, row_inds, col_inds)
+            submat_ctx.update()
+        self._submatrices[key] = (submat_ctx, bcs_key)
+        submat_ctx.on_diag = self.on_diag and row_inds == col_inds
+
+        submat = PETSc.Mat().create(comm=mat.comm)
+        submat.setType("python")
+        submat.setSizes((submat_ctx.row_sizes, submat_ctx.col_sizes),
+                        bsize=submat_ctx.block_size)
+        submat.setPythonContext(submat_ctx)
+        submat.setUp()
+
+        return submat
+
+    def _sub_bcs(self, asub, row_inds, col_inds):
+        """Restrict the boundary conditions to a block of the operator.
+
+        :arg asub: the bilinear form of the block.
+        :arg row_inds: the indices of the row fields of the block.
+        :arg col_inds: the indices of the column fields of the block.
+
+        :returns: a tuple of the row and column boundary conditions of
+            the block.
+        """
+        from firedrake import DirichletBC
+
         Wrow = asub.arguments()[0].function_space()
         Wcol = asub.arguments()[1].function_space()
 
@@ -254,17 +539,4 @@ class ImplicitMatrixContext(object):
                                                    bc.function_arg,
                                                    bc.sub_domain,
                                                    method=bc.method))
-        submat_ctx = ImplicitMatrixContext(asub,
-                                           row_bcs=row_bcs,
-                                           col_bcs=col_bcs,
-                                           fc_params=self.fc_params,
-                                           appctx=self.appctx)
-        submat_ctx.on_diag = self.on_diag and row_inds == col_inds
-        submat = PETSc.Mat().create(comm=mat.comm)
-        submat.setType("python")
-        submat.setSizes((submat_ctx.row_sizes, submat_ctx.col_sizes),
-                        bsize=submat_ctx.block_size)
-        submat.setPythonContext(submat_ctx)
-        submat.setUp()
-
-        return submat
+        return row_bcs, col_bcs
@@ -84,6 +84,24 @@ parameters["default_sub_matrix_type"] = "baij"
 
 parameters["type_check_safe_par_loops"] = False
 
+# Number of threads used to execute the kernels assembling linear
+# forms within each process.  If more than one, cells and facets are
+# coloured so that the threads never increment the same node.
+parameters["assembly_threads"] = 1
+
+# Number of processes used to run the form compiler concurrently on
+# the blocks of mixed forms (see also tsfc_interface.precompile).  The
+# processes are forked, which is not safe after MPI initialisation
+# with some interconnects, so this is opt-in.
+parameters["compilation_processes"] = 1
+
+# Number of cells on which the dense linear algebra of Slate
+# expressions is evaluated together, vectorised across the cells.  If
+# zero, a kernel evaluating the expression cell by cell is generated.
+# The local tensors of a batch live on the stack of the kernel, so
+# the batch size should be kept small for large local tensors.
+parameters["slate_batch_size"] = 0
+
 
 def disable_performance_optimisations():
     """Switches off performance optimisations in Firedrake.
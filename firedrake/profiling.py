@@ -0,0 +1,139 @@
+"""Instrumentation of the parallel loops generated by assembly."""
+import json
+import time
+from contextlib import contextmanager
+
+from pyop2 import op2
+from pyop2.base import _trace
+
+
+__all__ = ["assembly_profile", "AssemblyProfile"]
+
+
+# Stack of the currently active profiles
+_profiles = []
+
+
+class AssemblyProfile(object):
+    """A log of the parallel loops executed during assembly.
+
+    Each entry of :attr:`records` is a dict with the keys
+
+    ``"kernel"``
+        the name of the kernel.
+    ``"integral_type"``
+        the integral type, e.g. ``"cell"`` or ``"exterior_facet"``.
+    ``"subdomain_id"``
+        the subdomain the kernel was executed on.
+    ``"iterset_size"``
+        the number of (owned) entities iterated over.
+    ``"time"``
+        the wall time, in seconds, of executing the loop.
+    ``"flops"``
+        the estimated number of floating point operations.
+    ``"bytes_gathered"``, ``"bytes_scattered"``
+        the estimated number of bytes read from and written to global
+        data structures.
+
+    The records are local to each process.  Create one with
+    :func:`assembly_profile`.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def to_json(self, **kwargs):
+        """Return the records as a JSON string.
+
+        Keyword arguments are passed to :func:`json.dumps`."""
+        return json.dumps(self.records, **kwargs)
+
+    def dump(self, filename, **kwargs):
+        """Write the records to a file as JSON.
+
+        :arg filename: the name of the file to write.
+
+        Keyword arguments are passed to :func:`json.dump`."""
+        with open(filename, "w") as f:
+            json.dump(self.records, f, **kwargs)
+
+
+@contextmanager
+def assembly_profile():
+    """Record the parallel loops executed by :func:`.assemble` in an
+    :class:`AssemblyProfile`.
+
+    For example:
+
+    .. code-block:: python
+
+        with assembly_profile() as prof:
+            assemble(a)
+        prof.dump("assembly.json")
+
+    While profiling, the loops are executed eagerly rather than
+    lazily, so that they may be timed individually.
+    """
+    profile = AssemblyProfile()
+    _profiles.append(profile)
+    try:
+        yield profile
+    finally:
+        _profiles.remove(profile)
+
+
+def _arg_bytes(arg):
+    """Estimate the number of bytes moved per iteration entity by a
+    :class:`pyop2.base.Arg`."""
+    itemsize = arg.data.dtype.itemsize
+    if arg._is_mat:
+        rmap, cmap = arg.map
+        rdim, cdim = arg.data.dims[0][0]
+        return rmap.arity*rdim*cmap.arity*cdim*itemsize
+    if arg._is_global:
+        return 0
+    arity = arg.map.arity if arg.map is not None else 1
+    return arity*arg.data.cdim*itemsize
+
+
+def profiled(loop, kernel, integral_type, subdomain_id, itspace, args):
+    """Wrap a collected parallel loop so that its execution is recorded
+    in any active :class:`AssemblyProfile`.
+
+    :arg loop: the collected loop (a callable).
+    :arg kernel: the :class:`pyop2.Kernel` it executes.
+    :arg integral_type: the integral type.
+    :arg subdomain_id: the subdomain id.
+    :arg itspace: the iteration set.
+    :arg args: the :class:`pyop2.base.Arg`\s of the loop.
+    """
+    def profiled_loop():
+        if not _profiles:
+            return loop()
+        # Flush pending computations so they are not attributed to
+        # this loop.
+        _trace.evaluate_all()
+        start = time.time()
+        loop()
+        _trace.evaluate_all()
+        elapsed = time.time() - start
+        size = itspace.size
+        gathered = 0
+        scattered = 0
+        for arg in args:
+            nbytes = _arg_bytes(arg)*size
+            if arg.access in [op2.READ, op2.RW]:
+                gathered += nbytes
+            if arg.access in [op2.WRITE, op2.RW, op2.INC]:
+                scattered += nbytes
+        record = {"kernel": kernel.name,
+                  "integral_type": integral_type,
+                  "subdomain_id": subdomain_id,
+                  "iterset_size": size,
+                  "time": elapsed,
+                  "flops": int(kernel.num_flops)*size,
+                  "bytes_gathered": gathered,
+                  "bytes_scattered": scattered}
+        for profile in _profiles:
+            profile.records.append(record)
+    return profiled_loop
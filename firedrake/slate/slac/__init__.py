@@ -1 +1,3 @@
 from firedrake.slate.slac.compiler import *  # noqa: F401
+from firedrake.slate.slac.batched import *  # noqa: F401
+from firedrake.slate.slac.optimise import *  # noqa: F401
@@ -0,0 +1,481 @@
+"""Evaluation of Slate expressions on batches of cells.
+
+Rather than generating a kernel which evaluates the whole expression
+one cell at a time, a kernel is generated which is executed on
+batches of cells.  It computes the local tensors of the terminal
+tensors for every cell of the batch, and then carries out the dense
+linear algebra on the whole batch in structure-of-arrays layout (the
+cell index varies fastest), so that the innermost loops of every
+operation, including the LU factorisations and triangular solves, run
+across the cells of the batch and can be vectorised.  Finally, the
+local result of each cell is added into the global tensor.  This pays
+off for expressions dominated by many small dense factorisations,
+such as those arising in hybridisation.
+
+The kernel is executed by a single parallel loop over the batches:
+the local tensors only live on the stack of the kernel for the cells
+of one batch.  Each cell of a batch is reached through maps from the
+batches, built from the usual cell maps.
+"""
+import numpy
+
+from pyop2.datatypes import IntType, as_cstr
+from pyop2.utils import as_tuple
+
+from pyop2 import op2
+
+import firedrake.slate.slate as slate
+from firedrake.slate.slac.compiler import cell_to_facets_dtype, compile_expression
+from firedrake.slate.slac.optimise import optimise
+from firedrake.slate.slac.utils import traverse_dags
+from firedrake.tsfc_interface import KernelInfo, SplitKernel
+from tsfc.parameters import SCALAR_TYPE
+
+
+__all__ = ['BatchedExpression', 'can_batch']
+
+
+_terminals = (slate.Tensor, slate.AssembledVector)
+
+_supported = _terminals + (slate.Add, slate.Mul, slate.Negative,
+                           slate.Transpose, slate.Inverse,
+                           slate.Factorization, slate.Solve, slate.Block)
+
+
+def can_batch(expr):
+    """Returns `True` if the Slate expression `expr` can be evaluated
+    by a :class:`BatchedExpression`.
+
+    This requires a non-scalar expression on a single, non-extruded
+    mesh.  Mixed tensors, and blocks of them, are supported: the
+    local tensor of a mixed tensor is the whole mixed local tensor,
+    ordered by the subspaces.
+
+    :arg expr: a :class:`TensorBase` expression.
+    """
+    if expr.rank == 0 or len(expr.ufl_domains()) != 1:
+        return False
+    if expr.ufl_domain().cell_set._extruded:
+        return False
+    return all(isinstance(op, _supported) for op in traverse_dags([expr]))
+
+
+class BatchedExpression(object):
+    """A Slate expression evaluated on batches of cells.
+
+    :arg expr: a :class:`TensorBase` expression (see :func:`can_batch`).
+    :arg tsfc_parameters: a `dict` of form compiler parameters.
+    :arg batch_size: the number of cells in each batch.
+
+    The attribute :attr:`kernels` contains a "TSFC-like" `SplitKernel`
+    evaluating the expression on a batch of cells.  It is executed
+    over :attr:`iterset`, the set of batches, with one output
+    argument for each cell of a batch, reached through the maps
+    returned by :meth:`map`, followed by the arguments returned by
+    :meth:`input_args`.
+    """
+
+    def __init__(self, expr, tsfc_parameters, batch_size):
+        self.expr = optimise(expr)
+        self.batch_size = batch_size
+        self.mesh = expr.ufl_domain()
+        self.coefficients = expr.coefficients()
+
+        self.terminals = []
+        for op in traverse_dags([expr]):
+            if isinstance(op, _terminals):
+                kernel, = compile_expression(op, tsfc_parameters=tsfc_parameters,
+                                             flat_result=True)
+                self.terminals.append((op, kernel.kinfo))
+        self.oriented = any(kinfo.oriented for _, kinfo in self.terminals)
+        self.needs_cell_facets = any(kinfo.needs_cell_facets for _, kinfo in self.terminals)
+
+        self.iterset, self.cells, counts = _batches(self.mesh.cell_set, batch_size)
+        self.counts = op2.Dat(op2.DataSet(self.iterset, 1), counts, dtype=IntType)
+        cell_set = self.mesh.cell_set
+        self.identity = op2.Map(cell_set, cell_set, 1,
+                                numpy.arange(cell_set.total_size, dtype=IntType),
+                                "identity")
+        self._maps = {}
+
+        kinfo = KernelInfo(kernel=self._kernel(),
+                           integral_type="cell",
+                           oriented=False,
+                           subdomain_id="otherwise",
+                           domain_number=0,
+                           coefficient_map=(),
+                           needs_cell_facets=False,
+                           pass_layer_arg=False)
+        # As for the unbatched kernels, the result of a mixed
+        # expression is added into the whole mixed global tensor.
+        index = None if expr.is_mixed else 0
+        self.kernels = (SplitKernel(tuple([index]*expr.rank), kinfo),)
+
+    def map(self, map_, position):
+        """Returns a map from the batches to the entities a cell map
+        maps the cell at a given position of each batch to.
+
+        :arg map_: a (possibly mixed or decorated) map from the
+            cells, or ``None``.
+        :arg position: the position of the cell in the batches.
+        """
+        if map_ is None:
+            return None
+        if isinstance(map_, op2.MixedMap):
+            return op2.MixedMap([self.map(m, position) for m in map_.split])
+        if isinstance(map_, op2.DecoratedMap):
+            return op2.DecoratedMap(self.map(map_.map, position),
+                                    iteration_region=map_.iteration_region,
+                                    implicit_bcs=map_.implicit_bcs,
+                                    vector_index=map_.vector_index)
+        key = (id(map_), position)
+        try:
+            return self._maps[key][1]
+        except KeyError:
+            pass
+        # The parent makes the batched map usable with sparsities
+        # built from the cell map.
+        batched = op2.Map(self.iterset, map_.toset, map_.arity,
+                          map_.values_with_halo[self.cells[:, position]],
+                          "%s_batch%d" % (map_.name, position),
+                          parent=map_)
+        return self._maps.setdefault(key, (map_, batched))[1]
+
+    def input_args(self):
+        """Returns the arguments of the kernel following the outputs."""
+        m = self.mesh
+        args = [self.counts(op2.READ)]
+        positions = range(self.batch_size)
+        coords = m.coordinates
+        args.extend(coords.dat(op2.READ, self.map(coords.cell_node_map(), p)[op2.i[0]])
+                    for p in positions)
+        if self.oriented:
+            o = m.cell_orientations()
+            args.extend(o.dat(op2.READ, self.map(o.cell_node_map(), p)[op2.i[0]])
+                        for p in positions)
+        for c in self.coefficients:
+            for c_ in c.split():
+                map_ = c_.cell_node_map()
+                args.extend(c_.dat(op2.READ, map_ and self.map(map_, p)[op2.i[0]])
+                            for p in positions)
+        if self.needs_cell_facets:
+            args.extend(m.cell_to_facets(op2.READ, self.map(self.identity, p)[op2.i[0]])
+                        for p in positions)
+        return args
+
+    def _kernel(self):
+        """Generates the :class:`pyop2.Kernel` evaluating the
+        expression on a batch of cells."""
+        batch_size = self.batch_size
+        code = []
+        include_dirs = []
+        headers = ["#include <math.h>"]
+        # Each terminal kernel goes in its own namespace, so that
+        # their subkernels do not clash.
+        for n, (_, kinfo) in enumerate(self.terminals):
+            code.append("namespace slate_terminal_%d {\n%s\n}\n" % (n, kinfo.kernel._ast.gencode()))
+            include_dirs.extend(d for d in kinfo.kernel._include_dirs if d not in include_dirs)
+            headers.extend(h for h in kinfo.kernel._headers if h not in headers)
+
+        # Arguments, one per cell of the batch, gathered into arrays
+        # of pointers.
+        args = []
+        pointers = []
+
+        def declare(typ, name):
+            names = ["%s%d" % (name, p) for p in range(batch_size)]
+            args.extend("const %s *restrict %s" % (typ, n) for n in names)
+            pointers.append("const %s *%s[%d] = {%s};" % (typ, name, batch_size,
+                                                          ", ".join(names)))
+
+        # The local tensors of the outputs, declared as in the
+        # unbatched kernels.
+        outputs = ["out%d" % p for p in range(batch_size)]
+        shape = "".join("[%d]" % extent for extent in self.expr.shape)
+        args.extend("%s %s%s" % (SCALAR_TYPE, out, shape) for out in outputs)
+        first = "[0]"*len(self.expr.shape)
+        pointers.append("%s *out[%d] = {%s};" % (SCALAR_TYPE, batch_size,
+                                                 ", ".join("&%s%s" % (out, first) for out in outputs)))
+        args.append("const %s *restrict count" % as_cstr(IntType))
+        declare(SCALAR_TYPE, "coords")
+        call_args = {"coords": "coords[p]"}
+        if self.oriented:
+            declare("int", "orientations")
+            call_args["orientations"] = "orientations[p]"
+        coefficients = {}
+        for i, c in enumerate(self.coefficients):
+            coefficients[c] = []
+            for j, _ in enumerate(c.split()):
+                name = "w_%d_%d" % (i, j)
+                declare(SCALAR_TYPE, name)
+                coefficients[c].append("%s[p]" % name)
+        if self.needs_cell_facets:
+            declare(as_cstr(cell_to_facets_dtype), "facets")
+
+        builder = _BatchBuilder(batch_size)
+        for n, (op, kinfo) in enumerate(self.terminals):
+            rows, cols = _dims(op.shape)
+            sym = builder.temporary(rows*cols)
+            kernel_args = [call_args["coords"]]
+            if kinfo.oriented:
+                kernel_args.append(call_args["orientations"])
+            for c in op.coefficients():
+                kernel_args.extend(coefficients[c])
+            if kinfo.needs_cell_facets:
+                kernel_args.append("facets[p]")
+            builder.statements.append("""
+for (int p = 0; p < %(batch)d; p++) {
+    %(scalar)s buf[%(size)d];
+    for (int i = 0; i < %(size)d; i++) buf[i] = 0.0;
+    slate_terminal_%(n)d::%(name)s(buf, %(args)s);
+    for (int i = 0; i < %(size)d; i++) %(sym)s[i][p] = buf[i];
+}""" % {"batch": batch_size, "scalar": SCALAR_TYPE, "size": rows*cols, "n": n,
+                "name": kinfo.kernel.name, "args": ", ".join(kernel_args), "sym": sym})
+            builder.values[op] = sym
+
+        result = builder.evaluate(self.expr)
+        rows, cols = _dims(self.expr.shape)
+        # Only the cells actually in the batch contribute, the others
+        # repeat the last cell of the batch.
+        builder.statements.append("""
+for (int p = 0; p < count[0]; p++)
+    for (int i = 0; i < %(size)d; i++)
+        out[p][i] += %(result)s[i][p];""" % {"size": rows*cols, "result": result})
+
+        body = "\n".join(pointers + builder.declarations + builder.statements)
+        code.append("""
+static inline void slate_batched(%s)
+{
+    %s
+}
+""" % (", ".join(args), body.replace("\n", "\n    ")))
+        return op2.Kernel("\n".join(code), "slate_batched", cpp=True,
+                          include_dirs=include_dirs, headers=headers)
+
+
+class _BatchBuilder(object):
+    """Generates the C code evaluating a Slate expression on a batch
+    of cells.
+
+    Every matrix (or vector, treated as a single column matrix) is
+    held in a temporary ``double t[rows*cols][batch_size]``, so that
+    the entries of a batch are contiguous.
+
+    :arg batch_size: the number of cells in a batch.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.declarations = []
+        self.statements = []
+        self.values = {}
+
+    def temporary(self, size, typ=SCALAR_TYPE):
+        """Declares a temporary with ``size`` entries per cell and
+        returns its name."""
+        name = "t%d" % len(self.declarations)
+        self.declarations.append("%s %s[%d][%d];" % (typ, name, size, self.batch_size))
+        return name
+
+    def loop(self, body, **extents):
+        """Appends a statement executing ``body`` for every cell of
+        the batch, nested inside loops over the given extents."""
+        code = "for (int c = 0; c < %d; c++) %s" % (self.batch_size, body)
+        for index, extent in reversed(list(extents.items())):
+            code = "for (int %s = %s; %s < %s; %s++)\n    %s" % (
+                index, extent[0], index, extent[1], index, code.replace("\n", "\n    "))
+        self.statements.append(code)
+
+    def evaluate(self, expr):
+        """Generates code evaluating a subexpression, and returns the
+        name of the temporary holding its value.
+
+        A :class:`Factorization` evaluates to a pair of the names of
+        its LU factors and row permutation.  All decompositions are
+        computed as LU with partial pivoting.
+        """
+        try:
+            return self.values[expr]
+        except KeyError:
+            pass
+        operands = [self.evaluate(op) for op in expr.operands]
+        rows, cols = _dims(expr.shape)
+        if isinstance(expr, slate.Factorization):
+            A, = operands
+            result = self.factorise(A, rows)
+        elif isinstance(expr, (slate.Inverse, slate.Solve)):
+            A = operands[0]
+            if not isinstance(expr.operands[0], slate.Factorization):
+                A = self.factorise(A, _dims(expr.operands[0].shape)[0])
+            B = operands[1] if isinstance(expr, slate.Solve) else None
+            result = self.solve(A, B, rows, cols)
+        else:
+            result = self.temporary(rows*cols)
+            if isinstance(expr, slate.Add):
+                A, B = operands
+                self.loop("%s[i][c] = %s[i][c] + %s[i][c];" % (result, A, B),
+                          i=(0, rows*cols))
+            elif isinstance(expr, slate.Negative):
+                A, = operands
+                self.loop("%s[i][c] = -%s[i][c];" % (result, A),
+                          i=(0, rows*cols))
+            elif isinstance(expr, slate.Transpose):
+                A, = operands
+                self.loop("%s[i*%d + j][c] = %s[j*%d + i][c];" % (result, cols, A, rows),
+                          i=(0, rows), j=(0, cols))
+            elif isinstance(expr, slate.Mul):
+                A, B = operands
+                inner = _dims(expr.operands[0].shape)[1]
+                self.loop("%s[i][c] = 0.0;" % result, i=(0, rows*cols))
+                self.loop("%s[i*%d + j][c] += %s[i*%d + k][c] * %s[k*%d + j][c];"
+                          % (result, cols, A, inner, B, cols),
+                          i=(0, rows), k=(0, inner), j=(0, cols))
+            elif isinstance(expr, slate.Block):
+                A, = operands
+                tensor, = expr.operands
+                indices = [_block_indices(tensor.shapes[i], idx)
+                           for i, idx in enumerate(expr._indices)]
+                row_indices = indices[0]
+                col_indices = indices[1] if len(indices) > 1 else [0]
+                tensor_cols = _dims(tensor.shape)[1]
+                self.statements.append("static const int %s_rows[%d] = {%s};"
+                                       % (result, rows, ", ".join(map(str, row_indices))))
+                self.statements.append("static const int %s_cols[%d] = {%s};"
+                                       % (result, cols, ", ".join(map(str, col_indices))))
+                self.loop("%s[i*%d + j][c] = %s[%s_rows[i]*%d + %s_cols[j]][c];"
+                          % (result, cols, A, result, tensor_cols, result),
+                          i=(0, rows), j=(0, cols))
+            else:
+                raise NotImplementedError("Type %s not supported." % type(expr))
+        self.values[expr] = result
+        return result
+
+    def factorise(self, A, n):
+        """Generates the LU factorisations, with partial pivoting, of
+        a batch of ``n`` by ``n`` matrices.
+
+        :returns: a pair of the names of the factors and of the row
+            permutations.
+        """
+        LU = self.temporary(n*n)
+        perm = self.temporary(n, typ="int")
+        self.loop("%s[i][c] = %s[i][c];" % (LU, A), i=(0, n*n))
+        self.loop("%s[i][c] = i;" % perm, i=(0, n))
+        # The pivot search and row swaps differ between the cells of
+        # the batch, but are still done with the cell index innermost.
+        self.statements.append("""
+for (int k = 0; k < %(n)d; k++) {
+    %(scalar)s best[%(batch)d];
+    int pivot[%(batch)d];
+    for (int c = 0; c < %(batch)d; c++) {
+        best[c] = fabs(%(LU)s[k*%(n)d + k][c]);
+        pivot[c] = k;
+    }
+    for (int i = k + 1; i < %(n)d; i++)
+        for (int c = 0; c < %(batch)d; c++)
+            if (fabs(%(LU)s[i*%(n)d + k][c]) > best[c]) {
+                best[c] = fabs(%(LU)s[i*%(n)d + k][c]);
+                pivot[c] = i;
+            }
+    for (int j = 0; j < %(n)d; j++)
+        for (int c = 0; c < %(batch)d; c++) {
+            %(scalar)s tmp = %(LU)s[k*%(n)d + j][c];
+            %(LU)s[k*%(n)d + j][c] = %(LU)s[pivot[c]*%(n)d + j][c];
+            %(LU)s[pivot[c]*%(n)d + j][c] = tmp;
+        }
+    for (int c = 0; c < %(batch)d; c++) {
+        int tmp = %(perm)s[k][c];
+        %(perm)s[k][c] = %(perm)s[pivot[c]][c];
+        %(perm)s[pivot[c]][c] = tmp;
+    }
+    for (int i = k + 1; i < %(n)d; i++) {
+        for (int c = 0; c < %(batch)d; c++)
+            %(LU)s[i*%(n)d + k][c] /= %(LU)s[k*%(n)d + k][c];
+        for (int j = k + 1; j < %(n)d; j++)
+            for (int c = 0; c < %(batch)d; c++)
+                %(LU)s[i*%(n)d + j][c] -= %(LU)s[i*%(n)d + k][c] * %(LU)s[k*%(n)d + j][c];
+    }
+}""" % {"n": n, "batch": self.batch_size, "scalar": SCALAR_TYPE, "LU": LU, "perm": perm})
+        return LU, perm
+
+    def solve(self, lu, B, n, m):
+        """Generates the solution of a batch of linear systems given
+        the LU factorisations of the matrices (see :meth:`factorise`).
+
+        :arg lu: the names of the factors and row permutations.
+        :arg B: the name of the ``n`` by ``m`` right hand sides, or
+            ``None`` for the identity (to compute the inverses).
+        :returns: the name of the solutions.
+        """
+        LU, perm = lu
+        X = self.temporary(n*m)
+        if B is None:
+            self.loop("%s[i*%d + j][c] = %s[i][c] == j ? 1.0 : 0.0;" % (X, m, perm),
+                      i=(0, n), j=(0, m))
+        else:
+            self.loop("%s[i*%d + j][c] = %s[%s[i][c]*%d + j][c];" % (X, m, B, perm, m),
+                      i=(0, n), j=(0, m))
+        self.loop("%s[i*%d + j][c] -= %s[i*%d + k][c] * %s[k*%d + j][c];"
+                  % (X, m, LU, n, X, m),
+                  i=(1, n), k=(0, "i"), j=(0, m))
+        self.statements.append("""
+for (int i = %(n)d - 1; i >= 0; i--) {
+    for (int k = i + 1; k < %(n)d; k++)
+        for (int j = 0; j < %(m)d; j++)
+            for (int c = 0; c < %(batch)d; c++)
+                %(X)s[i*%(m)d + j][c] -= %(LU)s[i*%(n)d + k][c] * %(X)s[k*%(m)d + j][c];
+    for (int j = 0; j < %(m)d; j++)
+        for (int c = 0; c < %(batch)d; c++)
+            %(X)s[i*%(m)d + j][c] /= %(LU)s[i*%(n)d + i][c];
+}""" % {"n": n, "m": m, "batch": self.batch_size, "X": X, "LU": LU})
+        return X
+
+
+def _batches(cell_set, batch_size):
+    """Splits a set of cells into batches.
+
+    The owned cells and the halo cells are batched separately, so that
+    the batches inherit the core, owned and halo partition of the
+    cells.  The last batch of each partition is padded with copies of
+    its last cell.
+
+    :returns: a tuple ``(batches, cells, counts)`` of the
+        :class:`pyop2.Set` of batches, an array of shape ``(nbatches,
+        batch_size)`` of the cells in each batch, and an array of the
+        number of cells in each batch.
+    """
+    cells = []
+    counts = []
+    sizes = []
+    start = 0
+    for end in (cell_set.core_size, cell_set.size, cell_set.total_size):
+        for first in range(start, end, batch_size):
+            count = min(batch_size, end - first)
+            batch = numpy.arange(first, first + batch_size, dtype=IntType)
+            batch[count:] = first + count - 1
+            cells.append(batch)
+            counts.append(count)
+        sizes.append(len(cells))
+        start = end
+    cells = numpy.array(cells, dtype=IntType).reshape(-1, batch_size)
+    batches = op2.Set(tuple(sizes), "%s_batches" % cell_set.name, comm=cell_set.comm)
+    return batches, cells, numpy.array(counts, dtype=IntType)
+
+
+def _dims(shape):
+    """Returns the number of rows and columns of a local tensor of the
+    given shape.  Vectors are treated as single column matrices."""
+    return (tuple(shape) + (1, 1))[:2]
+
+
+def _block_indices(shapes, indices):
+    """Returns the local indices of some subspaces of a (mixed) local
+    tensor.
+
+    :arg shapes: the size of the local tensor in each subspace.
+    :arg indices: the index, or a tuple of the indices, of the
+        subspaces.
+    """
+    offsets = numpy.cumsum((0, ) + tuple(shapes))
+    return numpy.concatenate([numpy.arange(offsets[i], offsets[i + 1])
+                              for i in as_tuple(indices)])
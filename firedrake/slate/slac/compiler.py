@@ -20,8 +20,9 @@ import time
 from hashlib import md5
 
 from firedrake_citations import Citations
-from firedrake.tsfc_interface import SplitKernel, KernelInfo, TSFCKernel
+from firedrake.tsfc_interface import SplitKernel, KernelInfo, TSFCKernel, _compiling, _statistics
 from firedrake.slate.slac.kernel_builder import LocalKernelBuilder
+from firedrake.slate.slac.optimise import optimise
 from firedrake.slate.slac.utils import topological_sort
 from firedrake import op2
 from firedrake.logging import logger
@@ -50,26 +51,34 @@ cell_to_facets_dtype = np.dtype(np.int8)
 
 class SlateKernel(TSFCKernel):
     @classmethod
-    def _cache_key(cls, expr, tsfc_parameters):
+    def _cache_key(cls, expr, tsfc_parameters, flat_result=False):
         return md5((expr.expression_hash +
-                    str(sorted(tsfc_parameters.items()))).encode()).hexdigest(), expr.ufl_domains()[0].comm
+                    str(sorted(tsfc_parameters.items())) +
+                    str(flat_result)).encode()).hexdigest(), expr.ufl_domains()[0].comm
 
-    def __init__(self, expr, tsfc_parameters):
+    def __init__(self, expr, tsfc_parameters, flat_result=False):
         if self._initialized:
             return
-        self.split_kernel = generate_kernel(expr, tsfc_parameters)
+        with _compiling(type(self)):
+            self.split_kernel = generate_kernel(expr, tsfc_parameters,
+                                                flat_result=flat_result)
         self._initialized = True
 
 
-def compile_expression(slate_expr, tsfc_parameters=None):
+def compile_expression(slate_expr, tsfc_parameters=None, flat_result=False):
     """Takes a Slate expression `slate_expr` and returns the appropriate
     :class:`firedrake.op2.Kernel` object representing the Slate expression.
 
     :arg slate_expr: a :class:'TensorBase' expression.
     :arg tsfc_parameters: an optional `dict` of form compiler parameters to
         be passed to TSFC during the compilation of ufl forms.
+    :arg flat_result: If `True`, the kernel writes its result through a
+        flat pointer, rather than a (multi-dimensional) array, so that
+        it may write directly into a :class:`pyop2.Dat`.
 
-    Returns: A `tuple` containing a `SplitKernel(idx, kinfo)`
+    Returns: A `tuple` containing a `SplitKernel(idx, kinfo)`.  For
+    mixed expressions, the indices are all `None`: the kernel computes
+    the whole mixed local tensor.
     """
     if not isinstance(slate_expr, slate.TensorBase):
         raise ValueError("Expecting a `TensorBase` object, not %s" % type(slate_expr))
@@ -79,26 +88,27 @@ def compile_expression(slate_expr, tsfc_parameters=None):
     cache = slate_expr._metakernel_cache
     if tsfc_parameters is None:
         tsfc_parameters = parameters["form_compiler"]
-    key = str(sorted(tsfc_parameters.items()))
+    key = str(sorted(tsfc_parameters.items())) + str(flat_result)
+    stats = _statistics[SlateKernel.__name__]
     try:
-        return cache[key]
+        kernel = cache[key]
+        stats["form_hits"] += 1
+        return kernel
     except KeyError:
-        kernel = SlateKernel(slate_expr, tsfc_parameters).split_kernel
+        stats["form_misses"] += 1
+        kernel = SlateKernel(slate_expr, tsfc_parameters,
+                             flat_result=flat_result).split_kernel
         return cache.setdefault(key, kernel)
 
 
-def generate_kernel(slate_expr, tsfc_parameters=None):
+def generate_kernel(slate_expr, tsfc_parameters=None, flat_result=False):
     cpu_time = time.time()
-    # TODO: Get PyOP2 to write into mixed dats
-    if slate_expr.is_mixed:
-        raise NotImplementedError("Compiling mixed slate expressions")
-
     if len(slate_expr.ufl_domains()) > 1:
         raise NotImplementedError("Multiple domains not implemented.")
 
     Citations().register("Gibson2018")
-    # Create a builder for the Slate expression
-    builder = LocalKernelBuilder(expression=slate_expr,
+    # Create a builder for the (optimised) Slate expression
+    builder = LocalKernelBuilder(expression=optimise(slate_expr),
                                  tsfc_parameters=tsfc_parameters)
 
     # Keep track of declared temporaries
@@ -122,15 +132,25 @@ def generate_kernel(slate_expr, tsfc_parameters=None):
     statements.extend(auxiliary_expressions(builder, declared_temps))
 
     # Generate the kernel information with complete AST
-    kinfo = generate_kernel_ast(builder, statements, declared_temps)
-
-    # Cache the resulting kernel
-    idx = tuple([0]*slate_expr.rank)
+    # The coefficients are passed in the order of the original expression
+    kinfo = generate_kernel_ast(builder, statements, declared_temps,
+                                flat_result=flat_result,
+                                coefficients=slate_expr.coefficients())
+
+    # Cache the resulting kernel.  The local tensor of a mixed
+    # expression is the whole mixed tensor (ordered by the subspaces),
+    # which is written directly into the mixed global tensor: this is
+    # indicated by indices of None.
+    if slate_expr.is_mixed:
+        idx = tuple([None]*slate_expr.rank)
+    else:
+        idx = tuple([0]*slate_expr.rank)
     logger.info(GREEN % "compile_slate_expression finished in %g seconds.", time.time() - cpu_time)
     return (SplitKernel(idx, kinfo),)
 
 
-def generate_kernel_ast(builder, statements, declared_temps):
+def generate_kernel_ast(builder, statements, declared_temps, flat_result=False,
+                        coefficients=None):
     """Glues together the complete AST for the Slate expression
     contained in the :class:`LocalKernelBuilder`.
 
@@ -140,6 +160,11 @@ def generate_kernel_ast(builder, statements, declared_temps):
         assembly calls and temporary declarations.
     :arg declared_temps: A `dict` containing all previously
         declared temporaries.
+    :arg flat_result: If `True`, declare the result argument as a
+        flat pointer.
+    :arg coefficients: The coefficients of the kernel, in the order
+        of its arguments.  Defaults to the coefficients of the
+        builder's expression.
 
     Return: A `KernelInfo` object describing the complete AST.
     """
@@ -156,7 +181,11 @@ def generate_kernel_ast(builder, statements, declared_temps):
     result_sym = ast.Symbol("T%d" % len(declared_temps))
     result_data_sym = ast.Symbol("A%d" % len(declared_temps))
     result_type = "Eigen::Map<%s >" % eigen_matrixbase_type(shape)
-    result = ast.Decl(SCALAR_TYPE, ast.Symbol(result_data_sym, shape))
+    if flat_result:
+        result = ast.Decl(SCALAR_TYPE, result_data_sym,
+                          pointers=[("restrict",)])
+    else:
+        result = ast.Decl(SCALAR_TYPE, ast.Symbol(result_data_sym, shape))
     result_statement = ast.FlatBlock("%s %s((%s *)%s);\n" % (result_type,
                                                              result_sym,
                                                              SCALAR_TYPE,
@@ -181,7 +210,9 @@ def generate_kernel_ast(builder, statements, declared_temps):
                              qualifiers=["const"]))
 
     # Coefficient information
-    expr_coeffs = slate_expr.coefficients()
+    if coefficients is None:
+        coefficients = slate_expr.coefficients()
+    expr_coeffs = coefficients
     for c in expr_coeffs:
         args.extend([ast.Decl(SCALAR_TYPE, csym,
                               pointers=[("restrict",)],
@@ -252,15 +283,23 @@ def auxiliary_expressions(builder, declared_temps):
         auxiliary expressions are assigned temporaries.
     """
 
-    # These are either already declared terminals or expressions
-    # which do not require an extra temporary/expression
-    terminals = (slate.Tensor, slate.AssembledVector,
-                 slate.Negative, slate.Transpose)
+    # These are already declared terminals
+    terminals = (slate.Tensor, slate.AssembledVector)
     statements = []
 
+    def needs_temporary(exp):
+        if isinstance(exp, slate.Factorization):
+            return True
+        if builder.ref_counter[exp] <= 1 or isinstance(exp, terminals):
+            return False
+        if isinstance(exp, (slate.Negative, slate.Transpose)):
+            # Only free if the operand is not recomputed each time
+            operand, = exp.operands
+            return not (isinstance(operand, terminals) or needs_temporary(operand))
+        return True
+
     sorted_exprs = [exp for exp in topological_sort(builder.expression_dag)
-                    if ((builder.ref_counter[exp] > 1 and not isinstance(exp, terminals))
-                        or isinstance(exp, slate.Factorization))]
+                    if needs_temporary(exp)]
 
     for exp in sorted_exprs:
         if exp not in declared_temps:
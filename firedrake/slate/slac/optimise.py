@@ -0,0 +1,115 @@
+"""Algebraic rewriting of Slate expressions before code generation.
+
+The rewrites are:
+
+* products with an inverse, ``A.inv * B``, become local solves,
+  ``A.solve(B)``, which do not form the inverse explicitly;
+* transposes are pushed through sums, products and negations down
+  towards the terminal tensors, and double transposes cancel;
+* negations are pushed into the left operand of products, and double
+  negations cancel;
+* structurally identical subexpressions are replaced by a single
+  node, so that the code generator computes them only once.
+"""
+import firedrake.slate.slate as slate
+
+
+__all__ = ['optimise']
+
+
+def optimise(expr):
+    """Rewrites a Slate expression into an equivalent one which is
+    cheaper to evaluate.
+
+    :arg expr: a :class:`TensorBase` expression.
+
+    Returns: the rewritten expression.
+    """
+    return _optimise(expr, {})
+
+
+def _unique(expr, memo):
+    """Returns the unique node equal to `expr`."""
+    return memo.setdefault(expr, expr)
+
+
+def _optimise(expr, memo):
+    try:
+        return memo[expr]
+    except KeyError:
+        pass
+    operands = [_optimise(op, memo) for op in expr.operands]
+
+    if isinstance(expr, (slate.Tensor, slate.AssembledVector)):
+        result = expr
+    elif isinstance(expr, slate.Transpose):
+        result = _transpose(operands[0], memo)
+    elif isinstance(expr, slate.Negative):
+        result = _negate(operands[0], memo)
+    elif isinstance(expr, slate.Mul):
+        result = _multiply(operands[0], operands[1], memo)
+    elif isinstance(expr, slate.Add):
+        result = slate.Add(*operands)
+    elif isinstance(expr, slate.Inverse):
+        result = slate.Inverse(*operands)
+    elif isinstance(expr, slate.Factorization):
+        result = slate.Factorization(operands[0], decomposition=expr.decomposition)
+    elif isinstance(expr, slate.Solve):
+        A, B = operands
+        result = slate.Solve(A.operands[0], B, decomposition=A.decomposition)
+    elif isinstance(expr, slate.Block):
+        result = slate.Block(operands[0], expr._indices)
+    else:
+        raise NotImplementedError("Type %s not supported." % type(expr))
+
+    result = _unique(result, memo)
+    memo[expr] = result
+    return result
+
+
+def _transpose(A, memo):
+    """Returns the transpose of an (optimised) expression."""
+    if isinstance(A, slate.Transpose):
+        result, = A.operands
+    elif isinstance(A, slate.Negative):
+        B, = A.operands
+        result = slate.Negative(_transpose(B, memo))
+    elif isinstance(A, slate.Add):
+        B, C = A.operands
+        result = slate.Add(_transpose(B, memo), _transpose(C, memo))
+    elif isinstance(A, slate.Mul):
+        B, C = A.operands
+        result = _multiply(_transpose(C, memo), _transpose(B, memo), memo)
+    else:
+        # The transposes of inverses and solves are left alone, so
+        # that they share their factorization with the untransposed
+        # expression.
+        result = slate.Transpose(A)
+    return _unique(result, memo)
+
+
+def _negate(A, memo):
+    """Returns the negation of an (optimised) expression."""
+    if isinstance(A, slate.Negative):
+        result, = A.operands
+    elif isinstance(A, slate.Mul):
+        B, C = A.operands
+        result = slate.Mul(_negate(B, memo), C)
+    else:
+        result = slate.Negative(A)
+    return _unique(result, memo)
+
+
+def _multiply(A, B, memo):
+    """Returns the product of two (optimised) expressions."""
+    if isinstance(A, slate.Inverse):
+        C, = A.operands
+        if isinstance(C, slate.Factorization):
+            result = slate.Solve(C.operands[0], B, decomposition=C.decomposition)
+        else:
+            # Small matrices are inverted exactly (Solve returns the
+            # product again).
+            result = slate.Solve(C, B)
+    else:
+        result = slate.Mul(A, B)
+    return _unique(result, memo)
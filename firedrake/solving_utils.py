@@ -303,7 +303,8 @@ class _SNESContext(object):
                                                       tensor=self._jac,
                                                       bcs=problem.bcs,
                                                       form_compiler_parameters=fcp,
-                                                      mat_type=mat_type)
+                                                      mat_type=mat_type,
+                                                      cache_terms=problem._cache_jacobian_terms)
 
         self.is_mixed = self._jac.block_shape != (1, 1)
 
@@ -324,12 +325,19 @@ class _SNESContext(object):
                                                            tensor=self._pjac,
                                                            bcs=problem.bcs,
                                                            form_compiler_parameters=fcp,
-                                                           mat_type=pmat_type)
+                                                           mat_type=pmat_type,
+                                                           cache_terms=problem._cache_jacobian_terms)
         else:
             # pmat_type == mat_type and Jp is None
             self.Jp = None
             self._pjac = self._jac
 
+        # If the Jacobian can not be split into terms scaled by
+        # Constants, fall back to assembling a constant Jacobian once.
+        self._cache_jacobian_terms = getattr(self._assemble_jac, "cache_terms", False)
+        if self.Jp is not None:
+            self._cache_jacobian_terms &= getattr(self._assemble_pjac, "cache_terms", False)
+
         self._F = function.Function(self.F.arguments()[0].function_space())
         self._assemble_residual = create_assembly_callable(self.F,
                                                            tensor=self._F,
@@ -402,6 +410,7 @@ class _SNESContext(object):
             new_problem = NLVP(F, subu, bcs=bcs, J=J, Jp=None,
                                form_compiler_parameters=problem.form_compiler_parameters)
             new_problem._constant_jacobian = problem._constant_jacobian
+            new_problem._cache_jacobian_terms = problem._cache_jacobian_terms
             splits.append(type(self)(new_problem, mat_type=self.mat_type, pmat_type=self.pmat_type,
                                      appctx=self.appctx))
         return self._splits.setdefault(tuple(fields), splits)
@@ -450,9 +459,12 @@ class _SNESContext(object):
         problem = ctx._problem
 
         assert J.handle == ctx._jac.petscmat.handle
-        if problem._constant_jacobian and ctx._jacobian_assembled:
+        if problem._constant_jacobian and ctx._jacobian_assembled \
+           and not ctx._cache_jacobian_terms:
             # Don't need to do any work with a constant jacobian
-            # that's already assembled
+            # that's already assembled (if the jacobian terms are
+            # cached, the assembly callable itself checks whether
+            # anything changed).
             return
         ctx._jacobian_assembled = True
 
@@ -485,9 +497,12 @@ class _SNESContext(object):
         problem = ctx._problem
 
         assert J.handle == ctx._jac.petscmat.handle
-        if problem._constant_jacobian and ctx._jacobian_assembled:
+        if problem._constant_jacobian and ctx._jacobian_assembled \
+           and not ctx._cache_jacobian_terms:
             # Don't need to do any work with a constant jacobian
-            # that's already assembled
+            # that's already assembled (if the jacobian terms are
+            # cached, the assembly callable itself checks whether
+            # anything changed).
             return
         ctx._jacobian_assembled = True
 
@@ -2,31 +2,47 @@
 generated code in order to make it suitable for passing to the backends."""
 import pickle
 
+from contextlib import contextmanager
+from copy import deepcopy
 from hashlib import md5
 from os import path, environ, getuid, makedirs
+import atexit
+import fcntl
 import gzip
+import json
+import multiprocessing
+import numbers
 import os
+import re
+import time
 import zlib
 import tempfile
 import collections
 
+import numpy
 import ufl
 from ufl import Form
+from ufl.classes import FixedIndex, MultiIndex
+from ufl.corealg.traversal import unique_post_traversal
 from .ufl_expr import TestFunction
 
 from tsfc import compile_form as tsfc_compile_form
 
 from pyop2.caching import Cached
 from pyop2.op2 import Kernel
-from pyop2.mpi import COMM_WORLD
+from pyop2.mpi import COMM_WORLD, MPI
 
-from coffee.base import Invert
+from coffee.base import Decl, FlatBlock, Invert, Symbol
+from coffee.visitor import Visitor
 
 from firedrake.formmanipulation import split_form
 
 from firedrake.parameters import parameters as default_parameters
 
 
+__all__ = ["precompile", "cache_statistics", "reset_cache_statistics"]
+
+
 KernelInfo = collections.namedtuple("KernelInfo",
                                     ["kernel",
                                      "integral_type",
@@ -38,31 +54,175 @@ KernelInfo = collections.namedtuple("KernelInfo",
                                      "pass_layer_arg"])
 
 
-class TSFCKernel(Cached):
+def _parse_size(size):
+    """Parse a size in bytes, optionally with a suffix K, M or G.
+
+    :arg size: the size, e.g. ``"500M"``, or ``None``.
+    :returns: the size in bytes, or ``None`` if size is ``None`` or empty.
+    """
+    if not size:
+        return None
+    size = size.strip().upper()
+    scale = {"K": 2**10, "M": 2**20, "G": 2**30}.get(size[-1])
+    if scale is None:
+        return int(size)
+    return int(float(size[:-1])*scale)
+
+
+# Compression of the disk cache: "none", "fast" or "gzip".  Files are
+# read whatever their compression.
+_compression = environ.get('FIREDRAKE_TSFC_KERNEL_CACHE_COMPRESSION', 'fast')
+_compression_levels = {"none": None, "fast": 1, "gzip": 9}
+if _compression not in _compression_levels:
+    raise ValueError("Unknown FIREDRAKE_TSFC_KERNEL_CACHE_COMPRESSION '%s', expected one of %s"
+                     % (_compression, ", ".join(sorted(_compression_levels))))
+_gzip_magic = b"\x1f\x8b"
+
+
+_node_comm_keyval = MPI.Comm.Create_keyval(delete_fn=lambda comm, keyval, node: node.Free())
+
+
+def _node_comm(comm):
+    """Return the communicator of the processes of ``comm`` which share
+    a node with this one.
+
+    :arg comm: the communicator.
+
+    The node communicator is created once and stored as an attribute
+    of ``comm``.
+    """
+    node = comm.Get_attr(_node_comm_keyval)
+    if node is None:
+        node = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        comm.Set_attr(_node_comm_keyval, node)
+    return node
+
+
+_statistics_fields = ("form_hits", "form_misses",
+                      "memory_hits", "memory_misses",
+                      "disk_hits", "disk_misses",
+                      "disk_read_time", "disk_bytes_read", "disk_bytes_written",
+                      "compile_time", "memo_hits", "memo_misses")
+_statistics = collections.defaultdict(lambda: dict.fromkeys(_statistics_fields, 0))
+
+
+def cache_statistics():
+    """Return statistics of the kernel caches of this process.
+
+    :returns: a dict mapping the kind of cached object
+        (``"TSFCKernel"``, ``"TSFCOutput"`` or ``"SlateKernel"``) to a
+        dict with the keys
+
+        ``"form_hits"``, ``"form_misses"``
+            lookups of the kernels stashed on forms and Slate
+            expressions.
+        ``"memory_hits"``, ``"memory_misses"``
+            lookups of the in-memory cache.
+        ``"disk_hits"``, ``"disk_misses"``
+            lookups of the disk cache.
+        ``"disk_read_time"``
+            the time, in seconds, spent reading the disk cache.
+        ``"disk_bytes_read"``, ``"disk_bytes_written"``
+            the amount of data read from and written to the disk cache.
+        ``"compile_time"``
+            the time, in seconds, spent compiling after a miss.  This
+            includes the time to compile the :class:`TSFCOutput`
+            needed by a :class:`TSFCKernel`.
+        ``"memo_hits"``, ``"memo_misses"``
+            lookups of kernels compiled for structurally identical
+            forms.
+
+    Set the environment variable ``FIREDRAKE_TSFC_KERNEL_CACHE_STATS``
+    to print a summary at exit.
+    """
+    return dict((kind, dict(stats)) for kind, stats in _statistics.items())
+
+
+def reset_cache_statistics():
+    """Reset the statistics returned by :func:`cache_statistics`."""
+    _statistics.clear()
+
+
+def _print_cache_statistics():
+    if COMM_WORLD.rank != 0:
+        return
+    print("Kernel cache statistics (rank 0):")
+    for kind, stats in sorted(cache_statistics().items()):
+        print("  %s" % kind)
+        for field in _statistics_fields:
+            print("    %-20s %g" % (field, stats[field]))
 
-    _cache = {}
+
+if environ.get('FIREDRAKE_TSFC_KERNEL_CACHE_STATS'):
+    atexit.register(_print_cache_statistics)
+
+
+@contextmanager
+def _compiling(cls):
+    """Record the time spent in this context as compile time of ``cls``."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        _statistics[cls.__name__]["compile_time"] += time.time() - start
+
+
+class _DiskCached(Cached):
+    """Base class for objects cached both in memory and on disk.
+
+    Subclasses must provide their own ``_cache`` dict and a
+    ``_cache_key`` returning a pair ``(key, comm)``, where ``key`` is
+    suitable for use as a file name.
+    """
 
     _cachedir = environ.get('FIREDRAKE_TSFC_KERNEL_CACHE_DIR',
                             path.join(tempfile.gettempdir(),
                                       'firedrake-tsfc-kernel-cache-uid%d' % getuid()))
 
+    # Maximum size in bytes of the disk cache (unbounded if None).
+    # When exceeded, the least recently used kernels are removed.
+    _cache_max_size = _parse_size(environ.get('FIREDRAKE_TSFC_KERNEL_CACHE_SIZE'))
+
     @classmethod
     def _cache_lookup(cls, key):
         key, comm = key
-        return cls._cache.get(key) or cls._read_from_disk(key, comm)
+        stats = _statistics[cls.__name__]
+        val = cls._cache.get(key)
+        if val is not None:
+            stats["memory_hits"] += 1
+            return val
+        stats["memory_misses"] += 1
+        start = time.time()
+        try:
+            val = cls._read_from_disk(key, comm)
+        except KeyError:
+            stats["disk_misses"] += 1
+            raise
+        finally:
+            stats["disk_read_time"] += time.time() - start
+        stats["disk_hits"] += 1
+        return val
 
     @classmethod
     def _read_from_disk(cls, key, comm):
+        # Only one process per node reads the file.
+        comm = _node_comm(comm)
         if comm.rank == 0:
             cache = cls._cachedir
             filepath = os.path.join(cache, key)
             val = None
             if os.path.exists(filepath):
                 try:
-                    with gzip.open(filepath, 'rb') as f:
+                    with open(filepath, 'rb') as f:
                         val = f.read()
-                except zlib.error:
-                    pass
+                    if val[:2] == _gzip_magic:
+                        val = gzip.decompress(val)
+                    if cls._cache_max_size is not None:
+                        # Record the access for LRU eviction.
+                        os.utime(filepath)
+                except (zlib.error, OSError, EOFError):
+                    # Corrupt, or evicted by another process.
+                    val = None
 
             comm.bcast(val, root=0)
         else:
@@ -70,6 +230,7 @@ class TSFCKernel(Cached):
 
         if val is None:
             raise KeyError("Object with key %s not found" % key)
+        _statistics[cls.__name__]["disk_bytes_read"] += len(val)
         return cls._cache.setdefault(key, pickle.loads(val))
 
     @classmethod
@@ -81,18 +242,151 @@ class TSFCKernel(Cached):
             val._key = key
             filepath = os.path.join(cls._cachedir, key)
             tempfile = os.path.join(cls._cachedir, "%s_p%d.tmp" % (key, os.getpid()))
-            # No need for a barrier after this, since non root
-            # processes will never race on this file.
-            with gzip.open(tempfile, 'wb') as f:
-                pickle.dump(val, f, 0)
+            data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+            level = _compression_levels[_compression]
+            if level is not None:
+                data = gzip.compress(data, compresslevel=level)
+            with open(tempfile, 'wb') as f:
+                f.write(data)
+            _statistics[cls.__name__]["disk_bytes_written"] += len(data)
+            # The rename is atomic, so other processes either see the
+            # complete file or none at all, and there is no need for
+            # a barrier.
             os.rename(tempfile, filepath)
-        comm.barrier()
+            if cls._cache_max_size is not None:
+                with _locked_index(cls._cachedir) as index:
+                    index[key] = [os.path.getsize(filepath), time.time()]
+                    _evict(cls._cachedir, index, cls._cache_max_size)
+
+
+GeneratedKernel = collections.namedtuple("GeneratedKernel",
+                                         ["ast",
+                                          "integral_type",
+                                          "oriented",
+                                          "subdomain_id",
+                                          "domain_number",
+                                          "coefficient_numbers"])
+
+
+class TSFCOutput(_DiskCached):
+    """The kernels generated by TSFC for a :class:`~ufl.classes.Form`,
+    before any COFFEE optimisations are applied.
+
+    These do not depend on the COFFEE parameters, so that changing
+    those only regenerates the kernel code (see :class:`TSFCKernel`)
+    rather than rerunning the form compiler.
+    """
+
+    _cache = {}
+
+    @classmethod
+    def _cache_key(cls, form, name, parameters, kernels=None):
+        return md5((form.signature() + name
+                    + str(sorted(parameters.items()))).encode()).hexdigest(), form.ufl_domains()[0].comm
+
+    def __init__(self, form, name, parameters, kernels=None):
+        """
+        :arg form: the :class:`~ufl.classes.Form` to compile.
+        :arg name: a prefix to be applied to the compiled kernel names.
+        :arg parameters: a dict of parameters to pass to the form compiler.
+        :arg kernels: optional tuple of :class:`GeneratedKernel`\s
+            already generated for this form (for example by another
+            process), in which case TSFC is not called.
+        """
+        if self._initialized:
+            return
+        if kernels is None:
+            with _compiling(type(self)):
+                kernels = _generate_kernels(form, name, parameters)
+        self.kernels = kernels
+        self._initialized = True
+
+
+def _generate_kernels(form, name, parameters):
+    """Run TSFC on a form.
+
+    :returns: a tuple of :class:`GeneratedKernel`\s.
+    """
+    tree = tsfc_compile_form(form, prefix=name, parameters=parameters)
+    return tuple(GeneratedKernel(ast=kernel.ast,
+                                 integral_type=kernel.integral_type,
+                                 oriented=kernel.oriented,
+                                 subdomain_id=kernel.subdomain_id,
+                                 domain_number=kernel.domain_number,
+                                 coefficient_numbers=kernel.coefficient_numbers)
+                 for kernel in tree)
+
+
+# The forms being compiled by a pool of worker processes.  Forms are
+# not picklable, so the (forked) workers inherit them from here.
+_pending = []
+
+
+def _generate_pending(i):
+    return _generate_kernels(*_pending[i])
+
+
+def _generate_concurrently(blocks, nprocs):
+    """Run TSFC concurrently on several forms in a pool of processes,
+    filling the :class:`TSFCOutput` caches.
+
+    :arg blocks: a list of ``(form, name, parameters)`` tuples.  Every
+        process of the forms' communicators must pass the same list.
+    :arg nprocs: the number of worker processes.
+
+    On each communicator, rank 0 generates the kernels and
+    broadcasts them to the other ranks.  The workers are forked (see
+    :func:`precompile`), so this is only used if more than one process
+    is requested.
+    """
+    missing = []
+    seen = set()
+    for block in blocks:
+        key = TSFCOutput._cache_key(*block)
+        if key[0] in seen:
+            continue
+        seen.add(key[0])
+        try:
+            TSFCOutput._cache_lookup(key)
+            found = True
+        except KeyError:
+            found = False
+        # Each node reads the disk cache separately, so agree on what
+        # is missing.
+        comm = key[1]
+        if not comm.allreduce(found, op=MPI.LAND):
+            missing.append((block, comm))
+    if nprocs < 2 or len(missing) < 2:
+        # Nothing to gain, TSFCOutput generates them as needed.
+        return
+    local = [block for block, comm in missing if comm.rank == 0]
+    results = []
+    if local:
+        _pending[:] = local
+        try:
+            # Workers are forked, and never call MPI.
+            pool = multiprocessing.get_context("fork").Pool(min(nprocs, len(local)))
+            try:
+                results = pool.map(_generate_pending, range(len(local)))
+            finally:
+                pool.terminate()
+        finally:
+            _pending[:] = []
+    results = iter(results)
+    for block, comm in missing:
+        kernels = comm.bcast(next(results) if comm.rank == 0 else None, root=0)
+        TSFCOutput(*block, kernels=kernels)
+
+
+class TSFCKernel(_DiskCached):
+
+    _cache = {}
 
     @classmethod
     def _cache_key(cls, form, name, parameters, number_map):
-        # FIXME Making the COFFEE parameters part of the cache key causes
-        # unnecessary repeated calls to TSFC when actually only the kernel code
-        # needs to be regenerated
+        # The TSFC output is cached separately (see TSFCOutput), so
+        # the COFFEE parameters only cause the kernel code to be
+        # regenerated.
         return md5((form.signature() + name
                     + str(sorted(default_parameters["coffee"].items()))
                     + str(sorted(parameters.items()))
@@ -109,13 +403,23 @@ class TSFCKernel(Cached):
         if self._initialized:
             return
 
-        tree = tsfc_compile_form(form, prefix=name, parameters=parameters)
+        with _compiling(type(self)):
+            self.kernels = self._compile(form, name, parameters, number_map)
+        self._initialized = True
+
+    @staticmethod
+    def _compile(form, name, parameters, number_map):
+        output = TSFCOutput(form, name, parameters)
         kernels = []
-        for kernel in tree:
+        for kernel in output.kernels:
             # Set optimization options
             opts = default_parameters["coffee"]
-            ast = kernel.ast
+            # COFFEE transforms the AST in place, so work on a copy to
+            # leave the cached TSFC output untouched.
+            ast = deepcopy(kernel.ast)
             ast = ast if not parameters.get("assemble_inverse", False) else _inverse(ast)
+            ast = ast if not parameters.get("assemble_diagonal", False) else \
+                _diagonal(ast, block=parameters.get("assemble_block_diagonal", 1))
             # Unwind coefficient numbering
             numbers = tuple(number_map[c] for c in kernel.coefficient_numbers)
             kernels.append(KernelInfo(kernel=Kernel(ast, ast.name, opts=opts),
@@ -126,8 +430,7 @@ class TSFCKernel(Cached):
                                       coefficient_map=numbers,
                                       needs_cell_facets=False,
                                       pass_layer_arg=False))
-        self.kernels = tuple(kernels)
-        self._initialized = True
+        return tuple(kernels)
 
 
 SplitKernel = collections.namedtuple("SplitKernel", ["indices",
@@ -178,12 +481,100 @@ def compile_form(form, name, parameters=None, inverse=False, split=True):
         return tuple((k, params[k]) for k in sorted(params))
 
     key = (tuplify(default_parameters["coffee"]), name, tuplify(parameters), split)
+    stats = _statistics[TSFCKernel.__name__]
     try:
-        return cache[key]
+        kernels = cache[key]
+        stats["form_hits"] += 1
+        return kernels
     except KeyError:
-        pass
+        stats["form_misses"] += 1
+
+    # A structurally identical form may have been compiled before,
+    # which avoids computing the signature and splitting the form.
+    memo_key = (_structural_key(form), ) + key
+    try:
+        kernels = _form_memo[memo_key]
+        _form_memo.move_to_end(memo_key)
+        stats["memo_hits"] += 1
+        return cache.setdefault(key, kernels)
+    except KeyError:
+        stats["memo_misses"] += 1
 
     kernels = []
+    blocks = _split_blocks(form, name, split)
+    nprocs = default_parameters["compilation_processes"]
+    if nprocs > 1 and len(blocks) > 1:
+        _generate_concurrently([(f, kname, parameters) for _, f, kname, _ in blocks],
+                               nprocs)
+    for idx, f, kname, number_map in blocks:
+        kinfos = TSFCKernel(f, kname, parameters, number_map).kernels
+        for kinfo in kinfos:
+            kernels.append(SplitKernel(idx, kinfo))
+    kernels = tuple(kernels)
+    _form_memo[memo_key] = kernels
+    while len(_form_memo) > _form_memo_size:
+        _form_memo.popitem(last=False)
+    return cache.setdefault(key, kernels)
+
+
+# Kernels compiled by compile_form, keyed on the structure of the form
+# (see _structural_key).  The least recently used entries are dropped
+# beyond _form_memo_size.
+_form_memo = collections.OrderedDict()
+_form_memo_size = 256
+
+
+def _structural_key(form):
+    """Return a fingerprint of the structure of a form.
+
+    Coefficients are identified by their number in the form and free
+    indices by the order in which they appear, so that rebuilding the
+    same form from the same (or equivalent) coefficients gives the same
+    fingerprint.  This is much cheaper than computing the form
+    signature, since the form is traversed only once and not rebuilt.
+
+    :arg form: the :class:`~ufl.classes.Form`.
+    :returns: a string.
+    """
+    coefficients = dict((c, n) for n, c in enumerate(form.coefficients()))
+    indices = {}
+    ids = {}
+    visited = set()
+    fingerprint = md5()
+    for integral in form.integrals():
+        for node in unique_post_traversal(integral.integrand(), visited):
+            if node._ufl_is_terminal_:
+                if isinstance(node, ufl.Coefficient):
+                    data = ("Coefficient", coefficients[node], repr(node.ufl_function_space()))
+                elif isinstance(node, MultiIndex):
+                    data = tuple(int(i) if isinstance(i, FixedIndex)
+                                 else indices.setdefault(i.count(), -1 - len(indices))
+                                 for i in node)
+                else:
+                    data = repr(node)
+            else:
+                data = (node._ufl_typecode_, ) + tuple(ids[o] for o in node.ufl_operands)
+            ids[node] = len(ids)
+            fingerprint.update((repr(data) + ";").encode())
+        fingerprint.update(repr((integral.integral_type(),
+                                 integral.subdomain_id(),
+                                 sorted(integral.metadata().items()),
+                                 integral.ufl_domain(),
+                                 ids[integral.integrand()])).encode())
+    return fingerprint.hexdigest()
+
+
+def _split_blocks(form, name, split=True):
+    """Split a form into the blocks which are compiled separately.
+
+    :arg form: the :class:`~ufl.classes.Form` to split.
+    :arg name: a prefix for the generated kernel functions.
+    :arg split: If ``False``, then don't split mixed forms.
+    :returns: a list of tuples ``(index, form, name, number_map)``,
+        where ``number_map`` maps the coefficient numbers of the
+        block to those of ``form``.
+    """
+    blocks = []
     # A map from all form coefficients to their number.
     coefficient_numbers = dict((c, n)
                                for (n, c) in enumerate(form.coefficients()))
@@ -197,12 +588,63 @@ def compile_form(form, name, parameters=None, inverse=False, split=True):
         # compiler) to the global coefficient numbers
         number_map = dict((n, coefficient_numbers[c])
                           for (n, c) in enumerate(f.coefficients()))
-        kinfos = TSFCKernel(f, name + "".join(map(str, idx)), parameters,
-                            number_map).kernels
-        for kinfo in kinfos:
-            kernels.append(SplitKernel(idx, kinfo))
-    kernels = tuple(kernels)
-    return cache.setdefault(key, kernels)
+        blocks.append((idx, f, name + "".join(map(str, idx)), number_map))
+    return blocks
+
+
+def precompile(forms, parameters=None, name="form", nprocs=None):
+    """Compile several forms ahead of assembly.
+
+    The form compiler is run concurrently, in a pool of processes, on
+    the forms and on the blocks of mixed forms.  The resulting kernels
+    are placed in the in-memory and disk caches, so that assembling
+    the forms later does not compile anything.  For example, to
+    compile the residual and Jacobian of a problem:
+
+    .. code-block:: python
+
+        precompile([F, derivative(F, u)])
+
+    :arg forms: an iterable of :class:`~ufl.classes.Form`\s.
+    :arg parameters: optional dict of parameters to pass to the form
+         compiler, as for :func:`compile_form`.  These must match the
+         parameters used for assembly.
+    :arg name: a prefix for the generated kernel functions.  The
+         default is the prefix used by :func:`.assemble`.
+    :arg nprocs: the number of processes to use.  Defaults to
+         ``parameters["compilation_processes"]``.
+
+    This is collective over the communicators of the forms, and every
+    process must pass the same forms in the same order.  The form
+    compiler runs on rank 0 of each communicator, so ``nprocs`` should
+    not exceed the number of cores not already running MPI processes.
+
+    .. warning::
+
+       The worker processes are forked, which is not safe after MPI
+       has been initialised with some interconnects.  Concurrent
+       compilation is therefore opt-in: with the default of a single
+       process, the forms are compiled one after another.
+    """
+    forms = tuple(forms)
+    for form in forms:
+        if not isinstance(form, Form):
+            raise TypeError("Can only precompile UFL forms, not %r" % (form, ))
+    if parameters is None:
+        parameters = default_parameters["form_compiler"].copy()
+    else:
+        _ = parameters
+        parameters = default_parameters["form_compiler"].copy()
+        parameters.update(_)
+    if nprocs is None:
+        nprocs = default_parameters["compilation_processes"]
+    blocks = []
+    for form in forms:
+        blocks.extend((f, kname, parameters)
+                      for _, f, kname, _ in _split_blocks(form, name))
+    _generate_concurrently(blocks, nprocs)
+    for form in forms:
+        compile_form(form, name, parameters=parameters)
 
 
 def _real_mangle(form):
@@ -238,6 +680,75 @@ def _ensure_cachedir(comm=None):
         makedirs(TSFCKernel._cachedir, exist_ok=True)
 
 
+_index_name = "index.json"
+_lock_name = "index.lock"
+
+
+@contextmanager
+def _locked_index(cachedir):
+    """Lock and load the index of the disk cache, and write it back
+    on exit.
+
+    The index maps each cache key to a list ``[size, access_time]``,
+    so that eviction does not need to read the cached kernels.  If
+    there is no index (or it is corrupt), it is rebuilt from the
+    directory listing.
+
+    :arg cachedir: the cache directory.
+    """
+    with open(os.path.join(cachedir, _lock_name), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            filepath = os.path.join(cachedir, _index_name)
+            try:
+                with open(filepath) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+                for key in os.listdir(cachedir):
+                    if key in [_index_name, _lock_name] or key.endswith(".tmp"):
+                        continue
+                    stat = os.stat(os.path.join(cachedir, key))
+                    index[key] = [stat.st_size, stat.st_mtime]
+            yield index
+            tmp = os.path.join(cachedir, "%s_p%d.tmp" % (_index_name, os.getpid()))
+            with open(tmp, "w") as f:
+                json.dump(index, f)
+            os.rename(tmp, filepath)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _evict(cachedir, index, max_size):
+    """Remove least recently used entries from the disk cache until
+    it is no larger than ``max_size``.
+
+    :arg cachedir: the cache directory.
+    :arg index: the (locked) cache index, which is updated.
+    :arg max_size: the maximum size in bytes.
+    """
+    if sum(size for size, _ in index.values()) <= max_size:
+        return
+    # Reads only touch the files, so refresh the access times from
+    # the modification times before choosing what to evict.
+    for key, (size, atime) in list(index.items()):
+        try:
+            mtime = os.stat(os.path.join(cachedir, key)).st_mtime
+        except OSError:
+            del index[key]
+            continue
+        index[key] = [size, max(atime, mtime)]
+    total = sum(size for size, _ in index.values())
+    for key in sorted(index, key=lambda k: index[k][1]):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cachedir, key))
+        except OSError:
+            pass
+        total -= index.pop(key)[0]
+
+
 def _inverse(kernel):
     """Modify ``kernel`` so to assemble the inverse of the local tensor."""
 
@@ -252,3 +763,252 @@ def _inverse(kernel):
     kernel.children[0].children.append(Invert(name, size))
 
     return kernel
+
+
+def _diagonal(kernel, block=1):
+    """Modify ``kernel`` so to assemble only the diagonal of the local tensor.
+
+    The kernel instead takes an output argument of the shape of the
+    test space, which is incremented with the diagonal of the local
+    tensor.
+
+    If ``block`` is greater than 1, it is the number of degrees of
+    freedom at each node of the test space, and the output instead
+    has a (flattened) ``block`` by ``block`` square for each node,
+    which is incremented with the corresponding diagonal block of the
+    local tensor.
+
+    Where possible, the loops over the trial basis functions are
+    contracted with those over the test basis functions (see
+    :class:`_ContractArguments`), so that the local tensor is never
+    formed.  Otherwise, the local tensor becomes a zero-initialised
+    temporary, of which the diagonal is extracted.
+    """
+
+    local_tensor = kernel.args[0]
+    shape = tuple(local_tensor.size)
+    rank = len(shape) // 2
+
+    if len(shape) % 2 != 0 or shape[:rank] != shape[rank:]:
+        raise ValueError("Can only assemble the diagonal of a square 2-form")
+
+    name = local_tensor.sym.symbol
+    typ = local_tensor.typ
+    size = int(numpy.prod(shape[:rank], dtype=int))
+    diagonal = "%s_diagonal" % name
+    bs = block
+    if size % bs != 0:
+        raise ValueError("Local tensor of size %d does not have blocks of size %d" % (size, bs))
+
+    # The trailing indices of the basis functions which span the
+    # block at each node are not contracted.
+    ncontract = next((n for n in reversed(range(rank + 1))
+                      if numpy.prod(shape[n:rank], dtype=int) == bs), None)
+    if ncontract is not None:
+        try:
+            body = _ContractArguments(name, diagonal, rank, ncontract).contract(kernel.children[0])
+        except _NotContractible:
+            pass
+        else:
+            kernel.children[0] = body
+            kernel.args[0] = Decl(typ, Symbol(diagonal, shape[:rank] + shape[rank + ncontract:]))
+            return kernel
+
+    kernel.args[0] = Decl(typ, Symbol(diagonal, (size*bs, )))
+    body = kernel.children[0].children
+    body.insert(0, Decl(typ, Symbol(name, shape), "{0}"))
+    if bs > 1:
+        body.append(FlatBlock("for (int i = 0; i < %(nodes)d; ++i)\n"
+                              "    for (int j = 0; j < %(bs)d; ++j)\n"
+                              "        for (int k = 0; k < %(bs)d; ++k)\n"
+                              "            %(diagonal)s[(i*%(bs)d + j)*%(bs)d + k] += "
+                              "((%(typ)s *)%(name)s)[(i*%(bs)d + j)*%(size)d + i*%(bs)d + k];\n"
+                              % {"nodes": size // bs, "bs": bs, "size": size,
+                                 "diagonal": diagonal, "typ": typ, "name": name}))
+    else:
+        body.append(FlatBlock("for (int i = 0; i < %(size)d; ++i) %(diagonal)s[i] += ((%(typ)s *)%(name)s)[i*%(stride)d];\n"
+                              % {"size": size, "diagonal": diagonal, "typ": typ,
+                                 "name": name, "stride": size + 1}))
+
+    return kernel
+
+
+class _NotContractible(Exception):
+    """Raised if the loops over the trial basis functions of a kernel
+    can not be contracted with those over the test basis functions."""
+
+
+class _Splice(list):
+    """Statements replacing a single statement in a list of statements."""
+
+
+class _Rewriter(Visitor):
+    """Base class for COFFEE transformations rebuilding only the
+    nodes which change."""
+
+    def visit_object(self, o, *args, **kwargs):
+        return o
+
+    def visit_list(self, o, *args, **kwargs):
+        newlist = []
+        for e in o:
+            new = self.visit(e, *args, **kwargs)
+            if isinstance(new, _Splice):
+                newlist.extend(new)
+            else:
+                newlist.append(new)
+        if len(newlist) == len(o) and all(new is e for new, e in zip(newlist, o)):
+            return o
+        return newlist
+
+    visit_Node = Visitor.maybe_reconstruct
+
+
+class _Rename(_Rewriter):
+    """Rename the loop indices in a COFFEE AST.
+
+    :arg names: a dict mapping old index names to new ones.
+    """
+
+    def __init__(self, names):
+        super(_Rename, self).__init__()
+        self.names = names
+        self.pattern = re.compile(r"\b(%s)\b" % "|".join(map(re.escape, names)))
+
+    def rename(self, index):
+        if isinstance(index, str):
+            return self.pattern.sub(lambda m: self.names[m.group(0)], index)
+        return index
+
+    def visit_Symbol(self, o, *args, **kwargs):
+        symbol = self.names.get(o.symbol, o.symbol) if isinstance(o.symbol, str) else o.symbol
+        rank = tuple(self.rename(i) for i in o.rank or ())
+        if symbol == o.symbol and rank == tuple(o.rank or ()):
+            return o
+        return Symbol(symbol, rank, o.offset)
+
+
+def _linear_index(index, offset):
+    """Parse an index of a COFFEE symbol.
+
+    :arg index: the index, an integer or a string such as
+        ``"j0 * 3 + j1"``.
+    :arg offset: the ``(stride, offset)`` pair of the index.
+    :returns: a pair of the constant part of the index and a dict
+        mapping loop indices to their coefficients.
+    """
+    stride, constant = offset
+    coefficients = {}
+    if isinstance(index, numbers.Integral):
+        return constant + stride*index, coefficients
+    if not isinstance(index, str):
+        raise _NotContractible("Can not parse index %s" % index)
+    for term in index.split("+"):
+        factors = [f.strip() for f in term.split("*")]
+        names = [f for f in factors if not f.isdigit()]
+        if len(names) > 1 or not all(re.match(r"^\w+$", f) for f in factors):
+            raise _NotContractible("Can not parse index %s" % index)
+        value = stride*int(numpy.prod([int(f) for f in factors if f.isdigit()], dtype=int))
+        if names:
+            coefficients[names[0]] = coefficients.get(names[0], 0) + value
+        else:
+            constant += value
+    return constant, coefficients
+
+
+class _ContractArguments(_Rewriter):
+    """Contract the indices of the trial basis functions with those
+    of the test basis functions in a TSFC kernel body.
+
+    Each increment ``A[j][k] += ...`` of the local tensor ``A`` is
+    replaced by an increment ``A_diagonal[j] += ...`` in which the
+    trial index ``k`` is renamed to ``j``, and the loop over ``k``
+    enclosing it is removed, so the kernel evaluates only the
+    diagonal entries, without ever forming the local tensor.
+    Increments of blocks of the local tensor off the diagonal (for
+    example the blocks coupling the two cells of an interior facet)
+    are dropped.
+
+    :arg name: the name of the local tensor.
+    :arg diagonal: the name of the output.
+    :arg rank: the number of indices of each basis function.
+    :arg ncontract: the number of leading indices to contract; the
+        output keeps the remaining indices of the trial basis
+        functions.
+    """
+
+    def __init__(self, name, diagonal, rank, ncontract):
+        super(_ContractArguments, self).__init__()
+        self.name = name
+        self.diagonal = diagonal
+        self.rank = rank
+        self.ncontract = ncontract
+        # Map from trial indices to test indices
+        self.indices = {}
+        self.contracted = set()
+        self.nwritten = 0
+
+    def contract(self, body):
+        """Contract a kernel body.
+
+        :raises _NotContractible: if the body does not have the
+            expected structure.
+        """
+        body = self.visit(body, loops=())
+        if set(self.indices) != self.contracted:
+            raise _NotContractible("Not all trial loops were contracted")
+        return body
+
+    def visit_Symbol(self, o, *args, **kwargs):
+        if o.symbol == self.name:
+            raise _NotContractible("Unexpected use of the local tensor")
+        return o
+
+    def visit_FlatBlock(self, o, *args, **kwargs):
+        raise _NotContractible("Can not inspect code blocks")
+
+    def visit_Assign(self, o, *args, **kwargs):
+        ops, okwargs = o.operands()
+        lhs, rhs = ops[:2]
+        if not (isinstance(lhs, Symbol) and lhs.symbol == self.name):
+            return self.visit_Node(o, *args, **kwargs)
+        rank = self.rank
+        nc = self.ncontract
+        indices = tuple(lhs.rank)
+        offsets = tuple(lhs.offset or ((1, 0), )*len(indices))
+        if len(indices) != 2*rank:
+            raise _NotContractible("Local tensor has unexpected rank")
+        for test, trial in zip(range(nc), range(rank, rank + nc)):
+            i, I = _linear_index(indices[test], offsets[test])
+            j, J = _linear_index(indices[trial], offsets[trial])
+            if sorted(I.values()) != sorted(J.values()) \
+               or len(set(I.values())) != len(I):
+                raise _NotContractible("Test and trial indices do not match")
+            if i != j:
+                # Off the diagonal (if the indices are loop indices,
+                # they run over different blocks).
+                return _Splice()
+            by_coefficient = {c: t for t, c in I.items()}
+            for t, c in J.items():
+                if self.indices.setdefault(t, by_coefficient[c]) != by_coefficient[c]:
+                    raise _NotContractible("Inconsistent trial indices")
+        self.nwritten += 1
+        lhs = Symbol(self.diagonal, indices[:rank] + indices[rank + nc:],
+                     offsets[:rank] + offsets[rank + nc:] if lhs.offset else ())
+        rhs = self.visit(rhs, *args, **kwargs)
+        return o.reconstruct(lhs, rhs, *ops[2:], **okwargs)
+
+    visit_Incr = visit_Assign
+
+    def visit_For(self, o, *args, **kwargs):
+        loops = kwargs.pop("loops")
+        nwritten = self.nwritten
+        new = self.visit_Node(o, *args, loops=loops + (o.dim, ), **kwargs)
+        if self.nwritten == nwritten or o.dim not in self.indices:
+            return new
+        test = self.indices[o.dim]
+        if test not in loops:
+            raise _NotContractible("Trial loop %s is not inside test loop %s" % (o.dim, test))
+        self.contracted.add(o.dim)
+        rename = _Rename({o.dim: test})
+        return _Splice(rename.visit(statement) for statement in new.body)
@@ -63,6 +63,7 @@ class NonlinearVariationalProblem(object):
         # Store form compiler parameters
         self.form_compiler_parameters = form_compiler_parameters
         self._constant_jacobian = False
+        self._cache_jacobian_terms = False
 
     @utils.cached_property
     def dm(self):
@@ -247,7 +248,7 @@ class LinearVariationalProblem(NonlinearVariationalProblem):
 
     def __init__(self, a, L, u, bcs=None, aP=None,
                  form_compiler_parameters=None,
-                 constant_jacobian=True):
+                 constant_jacobian=True, cache_jacobian_terms=False):
         """
         :param a: the bilinear form
         :param L: the linear form
@@ -262,6 +263,16 @@ class LinearVariationalProblem(NonlinearVariationalProblem):
                  Jacobian is constant (i.e. does not depend on
                  varying fields).  If your Jacobian can change, set
                  this flag to ``False``.
+        :param cache_jacobian_terms: (optional) flag indicating that
+                 the Jacobian only changes through the values of
+                 :class:`.Constant`\s scaling its terms, for example
+                 a timestep ``dt`` which is adapted.  If set, each
+                 term is assembled once, and the Jacobian is formed
+                 as their linear combination whenever the values of
+                 those :class:`.Constant`\s change.  See also the
+                 ``cache_terms`` argument to :func:`.assemble`.  If
+                 the Jacobian can not be split in this way, this
+                 flag is ignored.
         """
         # In the linear case, the Jacobian is the equation LHS.
         J = a
@@ -276,6 +287,7 @@ class LinearVariationalProblem(NonlinearVariationalProblem):
         super(LinearVariationalProblem, self).__init__(F, u, bcs, J, aP,
                                                        form_compiler_parameters=form_compiler_parameters)
         self._constant_jacobian = constant_jacobian
+        self._cache_jacobian_terms = cache_jacobian_terms
 
 
 class LinearVariationalSolver(NonlinearVariationalSolver):
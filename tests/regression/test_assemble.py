@@ -105,6 +105,41 @@ def test_assemble_mat_with_tensor(mesh):
     assert np.allclose(M.M.values, 2*assemble(a).M.values, rtol=1e-14)
 
 
+def test_assemble_with_tensor_reuses_plan(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    v = TestFunction(V)
+    c = Function(V)
+    L = c*v*dx
+    f = Function(V)
+    c.assign(1)
+    assemble(L, tensor=f)
+    plan = f._assembly_plan
+    c.assign(2)
+    assemble(L, tensor=f)
+    # Same form into the same tensor replays the plan...
+    assert f._assembly_plan is plan
+    # ...and picks up the new coefficient values
+    assert np.allclose(f.dat.data, 2*assemble(v*dx).dat.data, rtol=1e-14)
+
+
+def test_assemble_mat_with_tensor_plan_bcs(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = u*v*dx
+    bc = DirichletBC(V, 0, 1)
+    M = assemble(a)
+    assemble(a, tensor=M, bcs=bc)
+    assemble(a, tensor=M, bcs=bc)
+    assert np.allclose(M.M.values, assemble(a, bcs=bc).M.values, rtol=1e-14)
+    # Changing the bcs after assembly must not replay a stale plan
+    assemble(a, tensor=M)
+    DirichletBC(V, 0, 2).apply(M)
+    assert np.allclose(M.M.values,
+                       assemble(a, bcs=DirichletBC(V, 0, 2)).M.values,
+                       rtol=1e-14)
+
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,70 @@
+from firedrake import *
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return UnitSquareMesh(5, 5)
+
+
+@pytest.fixture(params=["scalar", "vector"])
+def V(request, mesh):
+    if request.param == "scalar":
+        return FunctionSpace(mesh, "CG", 2)
+    else:
+        return VectorFunctionSpace(mesh, "CG", 1)
+
+
+def test_assemble_diagonal(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = inner(grad(u), grad(v))*dx + inner(u, v)*ds
+    bc = DirichletBC(V, zero(V.ufl_element().value_shape()), 1)
+
+    diag = assemble(a, bcs=bc, diagonal=True)
+    assert isinstance(diag, Function)
+    A = assemble(a, bcs=bc, mat_type="aij")
+    with diag.dat.vec_ro as d:
+        assert np.allclose(d.array_r, A.petscmat.getDiagonal().array_r)
+
+
+def test_assemble_diagonal_interior_facets(mesh):
+    V = FunctionSpace(mesh, "DG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = u*v*dx + jump(u)*jump(v)*dS
+
+    diag = Function(V)
+    assemble(a, tensor=diag, diagonal=True)
+    A = assemble(a, mat_type="aij")
+    with diag.dat.vec_ro as d:
+        assert np.allclose(d.array_r, A.petscmat.getDiagonal().array_r)
+
+
+def test_assemble_diagonal_mixed(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    W = V*V
+    u, p = TrialFunctions(W)
+    v, q = TestFunctions(W)
+    a = inner(grad(u), grad(v))*dx + p*v*dx + u*q*dx + 2*p*q*dx
+
+    diag = assemble(a, diagonal=True)
+    A = assemble(a, mat_type="aij")
+    with diag.dat.vec_ro as d:
+        assert np.allclose(d.array_r, A.petscmat.getDiagonal().array_r)
+
+
+def test_assemble_diagonal_bad_forms(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    Q = FunctionSpace(mesh, "DG", 0)
+    v = TestFunction(V)
+    with pytest.raises(ValueError):
+        assemble(v*dx, diagonal=True)
+    with pytest.raises(ValueError):
+        assemble(TrialFunction(Q)*v*dx, diagonal=True)
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
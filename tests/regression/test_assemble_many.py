@@ -0,0 +1,157 @@
+import pytest
+import numpy as np
+from firedrake import *
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return UnitSquareMesh(5, 5)
+
+
+@pytest.fixture(scope='module')
+def V(mesh):
+    return FunctionSpace(mesh, "CG", 1)
+
+
+def test_assemble_many_matches_assemble(mesh, V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    f = Function(V).interpolate(Expression("x[0]"))
+    g = Function(V).interpolate(Expression("x[1]"))
+    forms = [f*v*dx,
+             f*g*v*dx + g*v*ds(1),
+             f*dx,
+             f*g*ds,
+             inner(grad(u), grad(v))*dx]
+    results = assemble_many(forms, mat_type="aij")
+    expected = [assemble(form, mat_type="aij") for form in forms]
+    for result, exp in zip(results, expected):
+        if isinstance(exp, float):
+            assert np.allclose(result, exp)
+        elif isinstance(exp, Function):
+            assert np.allclose(result.dat.data_ro, exp.dat.data_ro)
+        else:
+            assert np.allclose(result.M.values, exp.M.values)
+
+
+def test_assemble_many_into_tensors(V):
+    v = TestFunction(V)
+    f = Function(V).interpolate(Expression("x[0]"))
+    outputs = [Function(V), Function(V)]
+    for _ in range(2):
+        # Assembling again must not accumulate
+        assemble_many([f*v*dx, 2*f*v*dx], tensors=outputs)
+    expected = assemble(f*v*dx)
+    assert np.allclose(outputs[0].dat.data_ro, expected.dat.data_ro)
+    assert np.allclose(outputs[1].dat.data_ro, 2*expected.dat.data_ro)
+
+
+def test_assemble_many_mixed(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    Q = FunctionSpace(mesh, "DG", 0)
+    W = V*Q
+    v, q = TestFunctions(W)
+    f = Function(V).interpolate(Expression("x[0]"))
+    forms = [f*v*dx + f*q*dx, f('+')*v('+')*dS]
+    results = assemble_many(forms)
+    for result, form in zip(results, forms):
+        assert np.allclose(result.dat.data_ro[0], assemble(form).dat.data_ro[0])
+        assert np.allclose(result.dat.data_ro[1], assemble(form).dat.data_ro[1])
+
+
+def test_assemble_many_bcs_applied_afterwards(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = u*v*dx
+    bc = DirichletBC(V, 0, 1)
+    A, = assemble_many([a], mat_type="aij")
+    bc.apply(A)
+    assert np.allclose(A.M.values, assemble(a, bcs=bc, mat_type="aij").M.values)
+
+
+@pytest.mark.parametrize("mat_type", ["aij", "nest"])
+def test_assemble_many_solve_with_bcs_applied_afterwards(mesh, mat_type):
+    V = FunctionSpace(mesh, "CG", 1)
+    W = V*V
+    u, p = TrialFunctions(W)
+    v, q = TestFunctions(W)
+    a = inner(grad(u), grad(v))*dx + inner(grad(p), grad(q))*dx + u*q*dx
+    L = v*dx + q*dx
+    bcs = [DirichletBC(W.sub(0), 0, 1), DirichletBC(W.sub(1), 1, 2)]
+    A, b = assemble_many([a, L], mat_type=mat_type)
+    for bc in bcs:
+        bc.apply(A)
+        bc.apply(b)
+    # Block lower triangular, so solved exactly by the fieldsplit.
+    parameters = {"ksp_type": "preonly",
+                  "pc_type": "fieldsplit",
+                  "pc_fieldsplit_type": "multiplicative",
+                  "fieldsplit_ksp_type": "preonly",
+                  "fieldsplit_pc_type": "lu"}
+    w = Function(W)
+    solve(A, w, b, solver_parameters=parameters)
+    expect = Function(W)
+    solve(a == L, expect, bcs=bcs, solver_parameters=parameters)
+    assert np.allclose(w.dat.data_ro[0], expect.dat.data_ro[0])
+    assert np.allclose(w.dat.data_ro[1], expect.dat.data_ro[1])
+
+
+def test_assemble_functionals(mesh, V):
+    f = Function(V).interpolate(Expression("x[0]"))
+    forms = [f*dx, f*f*dx, f*ds(1), f*dS]
+    values = assemble_functionals(forms)
+    assert isinstance(values, np.ndarray)
+    assert np.allclose(values, [assemble(form) for form in forms])
+
+
+def test_assemble_functionals_subdomains(mesh, V):
+    f = Function(V).interpolate(Expression("x[0] + x[1]"))
+    values = assemble_functionals(f*ds, subdomain_ids=(1, 2, 3, 4))
+    assert np.allclose(values, [assemble(f*ds(i)) for i in (1, 2, 3, 4)])
+    assert np.allclose(values.sum(), assemble(f*ds))
+
+
+def test_assemble_functionals_subdomains_single_loop(mesh, V, monkeypatch):
+    f = Function(V).interpolate(Expression("x[0] + x[1]"))
+    loops = []
+    par_loop = op2.par_loop
+
+    def counting_par_loop(*args, **kwargs):
+        loops.append(args[1])
+        return par_loop(*args, **kwargs)
+    monkeypatch.setattr(op2, "par_loop", counting_par_loop)
+    values = assemble_functionals(f*ds, subdomain_ids=(1, 2, 3, 4))
+    assert len(loops) == 1
+    monkeypatch.undo()
+    assert np.allclose(values, [assemble(f*ds(i)) for i in (1, 2, 3, 4)])
+
+
+def test_assemble_functionals_overlapping_subdomains(mesh, V):
+    f = Function(V).interpolate(Expression("x[0] + x[1]"))
+    forms = [f*ds, f*ds(1), f*ds((1, 2)), f*ds(2) + 2*f*ds, f*dx + f*dx(1)]
+    values = assemble_functionals(forms)
+    assert np.allclose(values, [assemble(form) for form in forms])
+
+
+def test_assemble_functionals_subdomains_mixed_integral_types(mesh, V):
+    f = Function(V).interpolate(Expression("x[0]"))
+    with pytest.raises(ValueError):
+        assemble_functionals(f*dx + f*ds, subdomain_ids=(1, 2))
+
+
+@pytest.mark.parallel(nprocs=2)
+def test_assemble_functionals_parallel():
+    mesh = UnitSquareMesh(5, 5)
+    V = FunctionSpace(mesh, "CG", 1)
+    f = Function(V).interpolate(Expression("x[0]"))
+    forms = [f*dx, f*ds(2), Constant(1, domain=mesh)*dx, f('+')*dS]
+    values = assemble_functionals(forms)
+    assert np.allclose(values[:3], [0.5, 1.0, 1.0])
+    assert np.allclose(values, [assemble(form) for form in forms])
+    values = assemble_functionals(f*ds, subdomain_ids=(1, 2, 3, 4))
+    assert np.allclose(values, [assemble(f*ds(i)) for i in (1, 2, 3, 4)])
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,126 @@
+from firedrake import *
+from firedrake import matrix
+import numpy as np
+import pytest
+
+
+def check_matis(a, bcs=None):
+    A = assemble(a, bcs=bcs, mat_type="is")
+    assert isinstance(A, matrix.UnassembledMatrix)
+    A.force_evaluation()
+    assert A.petscmat.getType() == "is"
+    expect = assemble(a, bcs=bcs, mat_type="aij")
+    expect.force_evaluation()
+    converted = A.petscmat.convert("aij")
+    converted.axpy(-1, expect.petscmat)
+    assert np.allclose(converted.norm(), 0)
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return UnitSquareMesh(6, 6)
+
+
+def test_assemble_matis_cell(mesh):
+    V = FunctionSpace(mesh, "CG", 2)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    check_matis(inner(grad(u), grad(v))*dx + u*v*ds(1),
+                bcs=DirichletBC(V, 0, 3))
+
+
+def test_assemble_matis_vector(mesh):
+    V = VectorFunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    check_matis(inner(grad(u), grad(v))*dx,
+                bcs=DirichletBC(V.sub(0), 0, 1))
+
+
+def test_assemble_matis_interior_facet(mesh):
+    V = FunctionSpace(mesh, "DG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    check_matis(u*v*dx + jump(u)*jump(v)*dS)
+
+
+@pytest.mark.parallel(nprocs=3)
+def test_assemble_matis_parallel(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    check_matis(inner(grad(u), grad(v))*dx + u*v*ds,
+                bcs=DirichletBC(V, 0, 1))
+
+
+def test_reassemble_matis(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    f = Function(V).assign(1)
+    a = f*inner(grad(u), grad(v))*dx + u*v*dx
+    bcs = DirichletBC(V, 0, 1)
+    A = assemble(a, bcs=bcs, mat_type="is")
+    for value in [2, 3]:
+        f.assign(value)
+        assemble(a, tensor=A, bcs=bcs, mat_type="is")
+        A.force_evaluation()
+        expect = assemble(a, bcs=bcs, mat_type="aij")
+        expect.force_evaluation()
+        converted = A.petscmat.convert("aij")
+        converted.axpy(-1, expect.petscmat)
+        assert np.allclose(converted.norm(), 0)
+
+
+def test_reassemble_matis_without_bcs(mesh):
+    V = FunctionSpace(mesh, "CG", 2)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = inner(grad(u), grad(v))*dx + u*v*ds(2)
+    A = assemble(a, bcs=DirichletBC(V, 0, (1, 2)), mat_type="is")
+    A.force_evaluation()
+    # The boundary condition rows must be reassembled into
+    assemble(a, tensor=A, mat_type="is")
+    A.force_evaluation()
+    expect = assemble(a, mat_type="aij")
+    expect.force_evaluation()
+    converted = A.petscmat.convert("aij")
+    converted.axpy(-1, expect.petscmat)
+    assert np.allclose(converted.norm(), 0)
+
+
+def test_solve_matis(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    u = Function(V)
+    v = TestFunction(V)
+    x = SpatialCoordinate(mesh)
+    F = inner(grad(u), grad(v))*dx + u**3*v*dx - sin(x[0])*v*dx
+    bcs = DirichletBC(V, 0, 1)
+    expect = Function(V)
+    solve(replace(F, {u: expect}) == 0, expect, bcs=bcs,
+          solver_parameters={"ksp_type": "preonly",
+                             "pc_type": "lu"})
+    # Newton reassembles the Jacobian into the same matrix at each
+    # iteration.
+    solve(F == 0, u, bcs=bcs,
+          solver_parameters={"mat_type": "is",
+                             "snes_type": "newtonls",
+                             "snes_rtol": 1e-12,
+                             "ksp_type": "cg",
+                             "ksp_rtol": 1e-12,
+                             "pc_type": "none"})
+    assert np.allclose(u.dat.data_ro, expect.dat.data_ro)
+
+
+def test_assemble_matis_mixed_fails(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    W = V*V
+    u, p = TrialFunctions(W)
+    v, q = TestFunctions(W)
+    with pytest.raises(NotImplementedError):
+        assemble(u*v*dx + p*q*dx, mat_type="is")
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,68 @@
+from firedrake import *
+from firedrake.colouring import colour_iterset, clear_colouring_cache
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def threads():
+    old = parameters["assembly_threads"]
+    parameters["assembly_threads"] = 4
+    yield
+    parameters["assembly_threads"] = old
+
+
+@pytest.fixture(scope='module', params=[1, 2])
+def V(request):
+    mesh = UnitSquareMesh(10, 10)
+    return FunctionSpace(mesh, "CG", request.param)
+
+
+def test_colouring_is_valid(V):
+    mesh = V.mesh()
+    cmap = V.cell_node_map()
+    subset, permutation, boundaries = colour_iterset(mesh.cell_set, cmap)
+    assert sorted(permutation) == list(range(mesh.cell_set.total_size))
+    assert sorted(subset.indices) == list(range(mesh.cell_set.total_size))
+    # Neighbouring cells share nodes, so there must be several colours.
+    assert len(boundaries) > 2
+    for lo, hi in zip(boundaries[:-1], boundaries[1:]):
+        nodes = cmap.values_with_halo[permutation[lo:hi]].ravel()
+        assert len(np.unique(nodes)) == len(nodes)
+
+
+def test_threaded_assembly(V, threads):
+    f = Function(V).interpolate(SpatialCoordinate(V.mesh())[0])
+    v = TestFunction(V)
+    L = f*v*dx + f*v*ds + avg(f)*avg(v)*dS
+
+    threaded = assemble(L)
+    # Replays the loops, executing them in the same pool of threads.
+    for _ in range(3):
+        assemble(L, tensor=threaded)
+    parameters["assembly_threads"] = 1
+    serial = assemble(L)
+    assert np.allclose(threaded.dat.data_ro, serial.dat.data_ro)
+
+
+def test_clear_colouring_cache(V, threads):
+    v = TestFunction(V)
+    L = v*dx
+    threaded = Function(V)
+    expect = assemble(L, tensor=threaded).copy(deepcopy=True)
+    cache = V.mesh().topology._shared_data_cache["colourings"]
+    pool = cache[("pool", 4)]
+    clear_colouring_cache(V.mesh())
+    assert "colourings" not in V.mesh().topology._shared_data_cache
+    assert pool._shutdown
+    # Replaying the loops, and new loops, use a new pool
+    assemble(L, tensor=threaded)
+    assert np.allclose(threaded.dat.data_ro, expect.dat.data_ro)
+    actual = assemble(L)
+    assert V.mesh().topology._shared_data_cache["colourings"][("pool", 4)] is not pool
+    assert np.allclose(actual.dat.data_ro, expect.dat.data_ro)
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,31 @@
+from firedrake import *
+import json
+import pytest
+
+
+def test_assembly_profile():
+    mesh = UnitSquareMesh(4, 4)
+    V = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = u*v*dx + u*v*ds(1)
+    with assembly_profile() as prof:
+        assemble(a, mat_type="aij").force_evaluation()
+        assemble(v*dx)
+    assemble(v*dx)
+
+    records = prof.records
+    assert len(records) == 3
+    assert [r["integral_type"] for r in records] == ["cell", "exterior_facet", "cell"]
+    assert records[0]["iterset_size"] == mesh.cell_set.size
+    assert records[1]["subdomain_id"] == 1
+    for r in records:
+        assert r["time"] >= 0
+        assert r["bytes_gathered"] > 0
+        assert r["bytes_scattered"] > 0
+    assert json.loads(prof.to_json()) == records
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
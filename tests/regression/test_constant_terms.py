@@ -0,0 +1,102 @@
+from firedrake import *
+from firedrake.formmanipulation import split_constant_terms
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def V():
+    mesh = UnitSquareMesh(4, 4)
+    return FunctionSpace(mesh, "CG", 1)
+
+
+@pytest.fixture(params=["aij", "baij"])
+def mat_type(request):
+    return request.param
+
+
+def test_split_constant_terms(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    dt = Constant(0.1)
+    theta = Constant(0.5)
+    a = (1/dt)*u*v*dx + theta*inner(grad(u), grad(v))*dx + u*v*ds
+    terms = split_constant_terms(a)
+    assert len(terms) == 3
+    assert sorted(float(scale) for scale, _ in terms) == [0.5, 1, 10]
+
+
+def test_split_constant_terms_nonlinear(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    c = Constant(1)
+    assert split_constant_terms(sin(c)*u*v*dx) is None
+
+
+def test_assemble_cache_terms(V, mat_type):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    dt = Constant(0.1)
+    theta = Constant(0.5)
+    bc = DirichletBC(V, 0, 1)
+    a = (1/dt)*u*v*dx + theta*inner(grad(u), grad(v))*dx
+
+    A = assemble(a, bcs=bc, mat_type=mat_type, cache_terms=True)
+    expect = assemble(a, bcs=bc, mat_type=mat_type)
+    assert np.allclose(A.M.values, expect.M.values)
+
+    terms = A._constant_terms
+    dt.assign(0.01)
+    assemble(a, tensor=A, bcs=bc, mat_type=mat_type, cache_terms=True)
+    assert A._constant_terms is terms
+    expect = assemble(a, bcs=bc, mat_type=mat_type)
+    assert np.allclose(A.M.values, expect.M.values)
+
+
+def test_solver_cache_jacobian_terms(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    dt = Constant(0.1)
+    x, y = SpatialCoordinate(V.mesh())
+    f = Function(V).interpolate(x*y)
+    a = (1/dt)*u*v*dx + inner(grad(u), grad(v))*dx
+    L = f*v*dx
+    bc = DirichletBC(V, 0, 1)
+    uh = Function(V)
+    problem = LinearVariationalProblem(a, L, uh, bcs=bc,
+                                       cache_jacobian_terms=True)
+    solver = LinearVariationalSolver(problem,
+                                     solver_parameters={"ksp_type": "preonly",
+                                                        "pc_type": "lu"})
+    for value in [0.1, 0.1, 0.05]:
+        dt.assign(value)
+        solver.solve()
+        expect = Function(V)
+        solve(a == L, expect, bcs=bc)
+        assert np.allclose(uh.dat.data_ro, expect.dat.data_ro)
+
+
+def test_solver_cache_jacobian_terms_fallback(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    c = Constant(1)
+    a = sin(c)*u*v*dx + inner(grad(u), grad(v))*dx
+    L = v*dx
+    uh = Function(V)
+    problem = LinearVariationalProblem(a, L, uh, cache_jacobian_terms=True)
+    solver = LinearVariationalSolver(problem,
+                                     solver_parameters={"ksp_type": "preonly",
+                                                        "pc_type": "lu"})
+    solver.solve()
+    expect = assemble(a, mat_type="aij").M.values
+    # The Jacobian can not be split, so it is constant, as if
+    # cache_jacobian_terms were not set.
+    c.assign(2)
+    solver.solve()
+    assert not solver._ctx._cache_jacobian_terms
+    assert np.allclose(solver._ctx._jac.M.values, expect)
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
@@ -1,5 +1,6 @@
 from firedrake import *
 from firedrake import matrix
+import numpy as np
 import pytest
 
 
@@ -136,6 +137,80 @@ def test_assemble_with_bcs_multiple_subdomains(a, V, mat_type):
     assert not A._needs_reassembly
 
 
+def test_matrices_share_sparsity(a, V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    A = assemble(a, mat_type="aij")
+    B = assemble(inner(grad(u), grad(v))*dx, mat_type="aij")
+    assert A._M.sparsity is B._M.sparsity
+    C = assemble(u*v*dx + u('+')*v('+')*dS, mat_type="aij")
+    assert C._M.sparsity is not A._M.sparsity
+
+
+def test_clear_sparsity_cache(a, V):
+    mesh = V.mesh()
+    assemble(a, mat_type="aij")
+    assert mesh.topology._shared_data_cache["sparsity_cache"]
+    clear_sparsity_cache(mesh)
+    assert not mesh.topology._shared_data_cache["sparsity_cache"]
+
+
+def test_toggle_bcs_without_reassembly(V):
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = inner(grad(u), grad(v))*dx + u*v*dx
+    bc1 = DirichletBC(V, 0, 1)
+    bc2 = DirichletBC(V, 0, 2)
+    A = assemble(a, bcs=[bc1], mat_type="aij")
+    A.force_evaluation()
+    for bcs in [[bc2], [bc1, bc2], [], [bc1]]:
+        A.bcs = bcs
+        A.force_evaluation()
+        assert A._unconstrained is not None
+        expect = assemble(a, bcs=bcs, mat_type="aij")
+        assert np.allclose(A.M.values, expect.M.values)
+
+
+def test_toggle_bcs_rectangular(V):
+    Q = FunctionSpace(V.mesh(), "CG", 2)
+    u = TrialFunction(V)
+    q = TestFunction(Q)
+    a = inner(grad(u), grad(q))*dx + u*q*dx
+    bc1 = DirichletBC(Q, 0, 1)
+    bc2 = DirichletBC(Q, 0, 2)
+    A = assemble(a, bcs=[bc1], mat_type="aij")
+    A.force_evaluation()
+    for bcs in [[bc2], [bc1, bc2], []]:
+        A.bcs = bcs
+        A.force_evaluation()
+        # Reassembled, since rows and columns are in different spaces
+        assert A._unconstrained is None
+        expect = assemble(a, bcs=bcs, mat_type="aij")
+        assert np.allclose(A.M.values, expect.M.values)
+
+
+def test_toggle_bcs_after_assembly_callable(V):
+    from firedrake.assemble import create_assembly_callable
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    f = Function(V).assign(1)
+    a = inner(grad(u), grad(v))*dx + f*u*v*dx
+    bc1 = DirichletBC(V, 0, 1)
+    bc2 = DirichletBC(V, 0, 2)
+    A = assemble(a, bcs=[bc2], mat_type="aij")
+    A.force_evaluation()
+    A.bcs = [bc1]
+    A.force_evaluation()
+    assemble_A = create_assembly_callable(a, tensor=A, bcs=[bc1], mat_type="aij")
+    f.assign(2)
+    assemble_A()
+    # Must not restore the values assembled with the old f
+    A.bcs = [bc2]
+    A.force_evaluation()
+    expect = assemble(a, bcs=[bc2], mat_type="aij")
+    assert np.allclose(A.M.values, expect.M.values)
+
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
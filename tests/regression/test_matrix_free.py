@@ -2,6 +2,7 @@ from firedrake import *
 import pytest
 import numpy as np
 from mpi4py import MPI
+from firedrake.petsc import PETSc
 
 
 @pytest.fixture
@@ -127,6 +128,274 @@ def test_matrixfree_action(a, V, bcs):
     assert np.allclose(expect.dat.data_ro, actual.dat.data_ro)
 
 
+@pytest.mark.parametrize("bcs", [False, True],
+                         ids=["no bcs", "bcs"])
+def test_matrixfree_diagonal(a, V, bcs):
+    if bcs:
+        bcs = DirichletBC(V, zero(V.shape), (1, 2))
+    else:
+        bcs = None
+    A = assemble(a, bcs=bcs)
+    A.force_evaluation()
+    Amf = assemble(a, mat_type="matfree", bcs=bcs)
+    Amf.force_evaluation()
+
+    assert np.allclose(A.petscmat.getDiagonal().array_r,
+                       Amf.petscmat.getDiagonal().array_r)
+    assert np.allclose(A.petscmat.invertBlockDiagonal(),
+                       Amf.petscmat.invertBlockDiagonal())
+
+
+@pytest.mark.parametrize("bcs", [False, True],
+                         ids=["no bcs", "bcs"])
+def test_matrixfree_block_diagonal_coupled(mesh, bcs):
+    V = VectorFunctionSpace(mesh, "CG", 2)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    # The components are coupled, so the nodal blocks are not diagonal.
+    a = inner(grad(u), grad(v))*dx + div(u)*div(v)*dx + inner(u, v)*dx
+    if bcs:
+        bcs = DirichletBC(V.sub(0), 0, 1)
+    else:
+        bcs = None
+    A = assemble(a, bcs=bcs)
+    A.force_evaluation()
+    Amf = assemble(a, mat_type="matfree", bcs=bcs)
+    Amf.force_evaluation()
+
+    assert Amf.petscmat.getBlockSize() == 2
+    expect = A.petscmat.invertBlockDiagonal()
+    actual = Amf.petscmat.invertBlockDiagonal()
+    assert expect.shape == actual.shape == (V.node_set.size*4, )
+    assert not np.allclose(expect.reshape(-1, 2, 2)[:, 0, 1], 0)
+    assert np.allclose(expect, actual)
+
+
+def test_matrixfree_diagonal_update(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    c = Function(V).assign(1)
+    Amf = assemble(c*u*v*dx, mat_type="matfree")
+    Amf.force_evaluation()
+    d1 = Amf.petscmat.getDiagonal().array_r.copy()
+    diagonal = Amf.petscmat.getPythonContext()._diagonal_tensors["diagonal"]
+
+    c.assign(2)
+    Amf.force_evaluation()
+    d2 = Amf.petscmat.getDiagonal().array_r.copy()
+    assert np.allclose(d2, 2*d1)
+    # Reassembled into the same Function
+    assert Amf.petscmat.getPythonContext()._diagonal_tensors["diagonal"] is diagonal
+
+
+@pytest.mark.parametrize("pc_type", ["jacobi", "pbjacobi"])
+def test_matrixfree_point_jacobi(V, a, L, bcs, tmpdir, pc_type):
+    u = Function(V)
+
+    assembled = str(tmpdir.join("assembled"))
+    matrixfree = str(tmpdir.join("matrixfree"))
+    parameters = {"ksp_type": "cg",
+                  "pc_type": pc_type}
+
+    solve(a == L, u, bcs=bcs,
+          solver_parameters=dict(parameters,
+                                 ksp_monitor_short="ascii:%s:" % assembled))
+    u.assign(0)
+    solve(a == L, u, bcs=bcs,
+          solver_parameters=dict(parameters, mat_type="matfree",
+                                 ksp_monitor_short="ascii:%s:" % matrixfree))
+
+    with open(assembled, "r") as f:
+        f.readline()            # Skip over header
+        expect = f.read()
+
+    with open(matrixfree, "r") as f:
+        f.readline()            # Skip over header
+        actual = f.read()
+
+    assert expect == actual
+
+
+@pytest.mark.parametrize("cell", ["triangle", "quadrilateral", "hexahedron"])
+def test_matrixfree_action_tensor_product(cell):
+    if cell == "hexahedron":
+        mesh = ExtrudedMesh(UnitSquareMesh(2, 2, quadrilateral=True), 2)
+        V = FunctionSpace(mesh, "Q", 4)
+    else:
+        mesh = UnitSquareMesh(2, 2, quadrilateral=(cell == "quadrilateral"))
+        V = FunctionSpace(mesh, "CG", 4)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    x = SpatialCoordinate(mesh)
+    c = Function(V).interpolate(1 + x[0]*x[1])
+    a = c*inner(grad(u), grad(v))*dx + u*v*dx
+
+    A = assemble(a)
+    A.force_evaluation()
+    Amf = assemble(a, mat_type="matfree")
+    Amf.force_evaluation()
+    ctx = Amf.petscmat.getPythonContext()
+    assert (ctx.action_fc_params.get("mode") == "spectral") == (cell != "triangle")
+
+    f = Function(V).interpolate(sin(x[0])*x[1])
+    expect = Function(V)
+    actual = Function(V)
+    with f.dat.vec_ro as x:
+        with expect.dat.vec as y:
+            A.petscmat.mult(x, y)
+        with actual.dat.vec as y:
+            Amf.petscmat.mult(x, y)
+    assert np.allclose(expect.dat.data_ro, actual.dat.data_ro)
+
+
+@pytest.mark.parametrize("bcs", [False, True],
+                         ids=["no bcs", "bcs"])
+def test_matrixfree_matmult(a, V, bcs):
+    if bcs:
+        bcs = DirichletBC(V, zero(V.shape), (1, 2))
+    else:
+        bcs = None
+    A = assemble(a, bcs=bcs)
+    A.force_evaluation()
+    Amf = assemble(a, mat_type="matfree", bcs=bcs)
+    Amf.force_evaluation()
+
+    k = 3
+    (n, N), _ = A.petscmat.getSizes()
+    B = PETSc.Mat().createDense(((n, N), (None, k)), comm=A.comm)
+    B.setUp()
+    B.getDenseArray()[:] = np.random.RandomState(0).rand(n, k)
+    B.assemble()
+
+    expect = A.petscmat.matMult(B)
+    ctx = Amf.petscmat.getPythonContext()
+    actual = ctx.matMult(Amf.petscmat, B)
+    # The columns were acted on together
+    assert list(ctx._block_actions) == [k]
+    assert np.allclose(actual.getDenseArray(), expect.getDenseArray())
+
+    # Acting on the columns in turn
+    ctx._fuse_block_actions = False
+    actual = ctx.matMult(Amf.petscmat, B)
+    assert np.allclose(actual.getDenseArray(), expect.getDenseArray())
+
+
+def test_matrixfree_matmult_extruded():
+    mesh = ExtrudedMesh(UnitSquareMesh(2, 2), 2)
+    V = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    a = inner(grad(u), grad(v))*dx + u*v*ds_t
+    A = assemble(a)
+    A.force_evaluation()
+    Amf = assemble(a, mat_type="matfree")
+    Amf.force_evaluation()
+
+    k = 2
+    (n, N), _ = A.petscmat.getSizes()
+    B = PETSc.Mat().createDense(((n, N), (None, k)), comm=A.comm)
+    B.setUp()
+    B.getDenseArray()[:] = np.random.RandomState(0).rand(n, k)
+    B.assemble()
+
+    expect = A.petscmat.matMult(B)
+    ctx = Amf.petscmat.getPythonContext()
+    actual = ctx.matMult(Amf.petscmat, B)
+    assert np.allclose(actual.getDenseArray(), expect.getDenseArray())
+
+
+def test_matrixfree_submatrix_cache(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    W = V*V
+    u, p = TrialFunctions(W)
+    v, q = TestFunctions(W)
+    c = Function(V).assign(1)
+    a = c*inner(grad(u), grad(v))*dx + u*q*dx + c*p*q*dx
+    Amf = assemble(a, mat_type="matfree")
+    Amf.force_evaluation()
+
+    isets = W.dof_dset.field_ises
+    A11 = Amf.petscmat.createSubMatrix(isets[1], isets[1])
+    d1 = A11.getDiagonal().array_r.copy()
+    B11 = Amf.petscmat.createSubMatrix(isets[1], isets[1])
+    assert B11.getPythonContext() is A11.getPythonContext()
+    assert B11.handle != A11.handle
+    A10 = Amf.petscmat.createSubMatrix(isets[1], isets[0])
+    assert A10.getPythonContext() is not A11.getPythonContext()
+    assert not A10.getPythonContext().on_diag
+
+    # The cached submatrix reflects changes to the coefficients
+    c.assign(3)
+    Amf.force_evaluation()
+    A11 = Amf.petscmat.createSubMatrix(isets[1], isets[1])
+    assert np.allclose(A11.getDiagonal().array_r, 3*d1)
+
+
+def test_matrixfree_fieldsplits_extract_same_block(mesh):
+    V = FunctionSpace(mesh, "CG", 1)
+    W = V*V
+    u, p = TrialFunctions(W)
+    v, q = TestFunctions(W)
+    a = inner(grad(u), grad(v))*dx + u*v*dx + p*q*dx
+    Amf = assemble(a, mat_type="matfree")
+    Amf.force_evaluation()
+
+    isets = W.dof_dset.field_ises
+    opts = PETSc.Options()
+    ksps = []
+    for prefix in ["first_", "second_"]:
+        opts["%sfieldsplit_pc_type" % prefix] = "none"
+        ksp = PETSc.KSP().create(comm=mesh.comm)
+        ksp.setOptionsPrefix(prefix)
+        ksp.setOperators(Amf.petscmat)
+        pc = ksp.getPC()
+        pc.setType("fieldsplit")
+        pc.setFieldSplitIS(("0", isets[0]), ("1", isets[1]))
+        ksp.setFromOptions()
+        ksp.setUp()
+        ksps.append(ksp)
+
+    for ksp, prefix in zip(ksps, ["first_", "second_"]):
+        for i, subksp in enumerate(ksp.getPC().getFieldSplitSubKSP()):
+            _, P = subksp.getOperators()
+            assert P.getOptionsPrefix() == "%sfieldsplit_%d_" % (prefix, i)
+    for prefix in ["first_", "second_"]:
+        del opts["%sfieldsplit_pc_type" % prefix]
+
+
+def test_matrixfree_action_mixed_bcs(mesh):
+    V = VectorFunctionSpace(mesh, "CG", 2)
+    Q = FunctionSpace(mesh, "CG", 1)
+    W = V*Q
+    u, p = TrialFunctions(W)
+    v, q = TestFunctions(W)
+    a = inner(grad(u), grad(v))*dx - p*div(v)*dx + div(u)*q*dx + p*q*dx
+    bcs = [DirichletBC(W.sub(0), zero((2, )), (1, 2)),
+           DirichletBC(W.sub(1), 0, 3)]
+
+    f = Function(W)
+    x = SpatialCoordinate(mesh)
+    f.sub(0).interpolate(as_vector([x[0]*sin(x[1]*2*pi), x[1]]))
+    f.sub(1).interpolate(x[0] + x[1])
+
+    A = assemble(a, bcs=bcs)
+    A.force_evaluation()
+    Amf = assemble(a, mat_type="matfree", bcs=bcs)
+    Amf.force_evaluation()
+
+    for mult in ["mult", "multTranspose"]:
+        expect = Function(W)
+        actual = Function(W)
+        with f.dat.vec_ro as x:
+            with expect.dat.vec as y:
+                getattr(A.petscmat, mult)(x, y)
+            with actual.dat.vec as y:
+                getattr(Amf.petscmat, mult)(x, y)
+        for e, a_ in zip(expect.split(), actual.split()):
+            assert np.allclose(e.dat.data_ro, a_.dat.data_ro)
+
+
 @pytest.mark.parametrize("preassembled", [False, True],
                          ids=["variational", "preassembled"])
 @pytest.mark.parametrize("parameters",
@@ -291,4 +560,5 @@ def test_get_info(a, bcs, infotype):
         A = assemble(a, mat_type="matfree", bcs=bcs)
         ctx = A.petscmat.getPythonContext()
         info = ctx.getInfo(A.petscmat, info=itype)
-        assert info["memory"] == 2*expect
+        # No extra storage for the boundary values
+        assert info["memory"] == expect
@@ -167,8 +167,30 @@ def test_mixed_argument_tensor(mesh):
     sigma, _ = TrialFunctions(W)
     tau, _ = TestFunctions(W)
     T = Tensor(sigma * tau * dx)
-    with pytest.raises(NotImplementedError):
-        assemble(T)
+    M = assemble(T)
+    ref = assemble(sigma * tau * dx)
+
+    for i in range(2):
+        for j in range(2):
+            assert np.allclose(M.M[i, j].values, ref.M[i, j].values, rtol=1e-14)
+
+
+def test_mixed_vector_tensor(mesh):
+    V = VectorFunctionSpace(mesh, "DG", 1)
+    U = FunctionSpace(mesh, "DG", 1)
+    W = V * U
+    x = SpatialCoordinate(mesh)
+    q = Function(V).project(as_vector([x[0], x[1]**2]))
+    p = Function(U).interpolate(x[0]*x[1])
+    u, phi = TrialFunctions(W)
+    v, psi = TestFunctions(W)
+
+    K = Tensor(inner(u, v)*dx + inner(phi, psi)*dx)
+    F = Tensor(inner(q, v)*dx + inner(p, psi)*dx)
+    result = assemble(K.inv * F)
+
+    for f, ref in zip(result.split(), [q, p]):
+        assert np.allclose(f.dat.data, ref.dat.data, rtol=1e-14)
 
 
 def test_vector_subblocks(mesh):
@@ -0,0 +1,109 @@
+import pytest
+import numpy as np
+from firedrake import *
+from firedrake.slate.slac import can_batch
+
+
+@pytest.fixture(scope='module', params=[False, True])
+def mesh(request):
+    return UnitSquareMesh(3, 3, quadrilateral=request.param)
+
+
+def assemble_batched(expr, batch_size=5, **kwargs):
+    parameters["slate_batch_size"] = batch_size
+    try:
+        return assemble(expr, **kwargs)
+    finally:
+        parameters["slate_batch_size"] = 0
+
+
+@pytest.mark.parametrize("degree", [1, 3])
+@pytest.mark.parametrize("batch_size", [1, 5, 64])
+def test_batched_local_solve(mesh, degree, batch_size):
+    V = FunctionSpace(mesh, "DG", degree)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    x, y = SpatialCoordinate(mesh)
+    f = Function(V).interpolate(x*y + 1)
+    A = Tensor(u*v*dx + inner(grad(u), grad(v))*dx)
+    b = AssembledVector(f)
+
+    for expr in [A.inv * b, A.solve(b), -(A.T * b)]:
+        expected = assemble(expr)
+        result = assemble_batched(expr, batch_size=batch_size)
+        assert np.allclose(result.dat.data_ro, expected.dat.data_ro)
+
+
+def test_batched_schur_complement(mesh):
+    V = FunctionSpace(mesh, "DG", 1)
+    Q = FunctionSpace(mesh, "CG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    p = TrialFunction(Q)
+    q = TestFunction(Q)
+    A = Tensor(u*v*dx + inner(grad(u), grad(v))*dx)
+    B = Tensor(p*v*dx)
+    C = Tensor(p*q*dx)
+    S = C + B.T * A.inv * B
+
+    expected = assemble(S)
+    result = assemble_batched(S)
+    assert np.allclose(result.M.values, expected.M.values)
+
+    bc = DirichletBC(Q, 0, 1)
+    expected = assemble(S, bcs=bc)
+    result = assemble_batched(S, bcs=bc)
+    assert np.allclose(result.M.values, expected.M.values)
+
+
+def test_batched_hybridisation(mesh):
+    # The Schur complement and reconstruction of HybridizationPC
+    if mesh.ufl_cell().cellname() == "quadrilateral":
+        RT = FiniteElement("RTCF", quadrilateral, 1)
+    else:
+        RT = FiniteElement("RT", triangle, 1)
+    V = FunctionSpace(mesh, BrokenElement(RT))
+    Q = FunctionSpace(mesh, "DG", 0)
+    W = V*Q
+    T = FunctionSpace(mesh, "HDiv Trace", 0)
+    sigma, u = TrialFunctions(W)
+    tau, v = TestFunctions(W)
+    gammar = TestFunction(T)
+    n = FacetNormal(mesh)
+    Atilde = Tensor(inner(sigma, tau)*dx + div(tau)*u*dx + div(sigma)*v*dx)
+    K = Tensor(gammar('+')*jump(sigma, n=n)*dS)
+    x, y = SpatialCoordinate(mesh)
+    r = Function(W)
+    r.sub(1).interpolate(x*y + 1)
+    lambdar = Function(T).assign(1)
+
+    S = K * Atilde.inv * K.T
+    assert can_batch(S)
+    expected = assemble(S)
+    result = assemble_batched(S)
+    assert np.allclose(result.M.values, expected.M.values)
+
+    reconstruct = Atilde.solve(AssembledVector(r) - K.T * AssembledVector(lambdar),
+                               decomposition="PartialPivLU")
+    assert can_batch(reconstruct)
+    expected = assemble(reconstruct)
+    result = assemble_batched(reconstruct)
+    for e, r in zip(expected.split(), result.split()):
+        assert np.allclose(r.dat.data_ro, e.dat.data_ro)
+
+    # Blocks of the mixed operator
+    block = Atilde.block(((0, ), (1, )))
+    assert can_batch(block.T * block)
+    assert np.allclose(assemble_batched(block.T * block).M.values,
+                       assemble(block.T * block).M.values)
+
+
+def test_batched_unsupported_falls_back():
+    mesh = ExtrudedMesh(UnitIntervalMesh(3), 2)
+    V = FunctionSpace(mesh, "DG", 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    A = Tensor(u*v*dx)
+    assert not can_batch(A.inv)
+    assert np.allclose(assemble_batched(A.inv).M.values,
+                       assemble(A.inv).M.values)
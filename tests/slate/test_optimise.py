@@ -0,0 +1,69 @@
+import pytest
+import numpy as np
+from firedrake import *
+from firedrake.slate.slac import optimise
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return UnitSquareMesh(2, 2)
+
+
+@pytest.fixture(scope='module')
+def A(mesh):
+    V = FunctionSpace(mesh, "DG", 2)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    return Tensor(u*v*dx + inner(grad(u), grad(v))*dx)
+
+
+@pytest.fixture(scope='module')
+def b(mesh):
+    V = FunctionSpace(mesh, "DG", 2)
+    x, y = SpatialCoordinate(mesh)
+    return AssembledVector(Function(V).interpolate(x + y))
+
+
+def test_inverse_product_to_solve(A, b):
+    assert optimise(A.inv * b) == A.solve(b)
+    assert optimise(A.inv * (A.inv * b)) == A.solve(A.solve(b))
+
+
+def test_push_transpose(A):
+    B = Tensor(2*A.form)
+    assert optimise(A.T.T) == A
+    assert optimise((A*B).T) == B.T * A.T
+    assert optimise((A + B).T) == A.T + B.T
+    assert optimise((-(A*B)).T) == B.T * -A.T
+
+
+def test_push_negative(A, b):
+    assert optimise(-(-A)) == A
+    assert optimise(-(A*b)) == (-A) * b
+    assert optimise(-(-A * b)) == A * b
+
+
+def test_common_subexpressions(A, b):
+    expr = optimise(A.inv * b + A.inv * (A * b))
+    x, y = expr.operands
+    assert isinstance(x, Solve) and isinstance(y, Solve)
+    assert x.operands[0] == y.operands[0]
+
+
+def test_optimised_kernel(mesh):
+    V = FunctionSpace(mesh, "DG", 2)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    x, y = SpatialCoordinate(mesh)
+    f = Function(V).interpolate(x + 1)
+    g = Function(V).interpolate(y + 2)
+    # Transposing the product swaps the order of the coefficients
+    A = Tensor(f*u*v*dx + inner(grad(u), grad(v))*dx)
+    B = Tensor(g*u*v*dx)
+    c = AssembledVector(Function(V).assign(1))
+
+    Am = assemble(A).M.values
+    Bm = assemble(B).M.values
+    result = assemble(-((A*B).T) * A.inv * c)
+    expected = -np.dot(np.dot(Bm.T, Am.T), np.linalg.solve(Am, np.ones(Am.shape[0])))
+    assert np.allclose(result.dat.data_ro, expected)
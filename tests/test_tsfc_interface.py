@@ -77,6 +77,30 @@ with open("{file}", "w") as f:
             key2 = f.read()
         assert key1 == key2
 
+    def test_precompile_script(self, tmpdir):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, "scripts", "firedrake-precompile")
+        example = tmpdir.join("example.py")
+        example.write("""
+import sys
+from firedrake import *
+mesh = UnitSquareMesh(int(sys.argv[1]), int(sys.argv[1]))
+V = FunctionSpace(mesh, "CG", 1)
+u = TrialFunction(V)
+v = TestFunction(V)
+uh = Function(V)
+solve(inner(grad(u), grad(v))*dx == v*dx, uh, bcs=DirichletBC(V, 0, "on_boundary"))
+# The solution is used afterwards
+assert uh.dat.data_ro.max() > 0
+""")
+        cachedir = tmpdir.join("cache")
+        env = dict(os.environ, FIREDRAKE_TSFC_KERNEL_CACHE_DIR=str(cachedir))
+        output = subprocess.check_output([sys.executable, script, str(example), "4"],
+                                         env=env, universal_newlines=True)
+        assert "Cached" in output
+        assert len([f for f in cachedir.listdir()
+                    if f.basename not in ["index.json", "index.lock"]]) > 0
+
     def test_tsfc_cache_persist_on_disk(self, cache_key):
         """TSFCKernel should be persisted on disk."""
         assert os.path.exists(
@@ -87,6 +111,19 @@ with open("{file}", "w") as f:
         assert tsfc_interface.TSFCKernel._read_from_disk(
             cache_key, COMM_WORLD).cache_key == cache_key
 
+    @pytest.mark.parametrize("compression", ["none", "fast", "gzip"])
+    def test_tsfc_cache_compression(self, mass, compression, monkeypatch):
+        """Kernels should be read back whatever their compression."""
+        monkeypatch.setattr(tsfc_interface, "_compression", compression)
+        monkeypatch.setattr(tsfc_interface.TSFCKernel, "_cache", {})
+        key = tsfc_interface.TSFCKernel(mass, 'mass_' + compression,
+                                        parameters["form_compiler"], {}).cache_key
+        with open(os.path.join(tsfc_interface.TSFCKernel._cachedir, key), "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        assert compressed == (compression != "none")
+        assert tsfc_interface.TSFCKernel._read_from_disk(
+            key, COMM_WORLD).cache_key == key
+
     def test_tsfc_same_form(self, mass):
         """Compiling the same form twice should load kernels from cache."""
         k1 = tsfc_interface.compile_form(mass, 'mass')
@@ -117,10 +154,43 @@ with open("{file}", "w") as f:
 
         assert k1[-1] is not k2[-1]
 
+    def test_tsfc_structurally_identical_forms(self, fs):
+        """Rebuilding a form from equivalent coefficients should reuse
+        the kernels."""
+        v = TestFunction(fs)
+        f = Function(fs)
+        g = Function(fs)
+        k1 = tsfc_interface.compile_form(inner(f, v)*dx, 'memo')
+        k2 = tsfc_interface.compile_form(inner(g, v)*dx, 'memo')
+        k3 = tsfc_interface.compile_form(inner(f*g, v)*dx, 'memo')
+
+        assert k1 is k2
+        assert k1 is not k3
+        assert tsfc_interface._structural_key(inner(grad(f), grad(v))*dx) == \
+            tsfc_interface._structural_key(inner(grad(g), grad(v))*dx)
+
     def test_tsfc_cell_kernel(self, mass):
         k = tsfc_interface.compile_form(mass, 'mass')
         assert len(k) == 1 and 'cell_integral' in k[0][1][0].code()
 
+    def test_tsfc_diagonal_kernel(self, mass):
+        """Diagonal kernels should not form the local tensor."""
+        k, = tsfc_interface.compile_form(mass, 'mass_diagonal',
+                                         parameters={"assemble_diagonal": True})
+        code = k[1][0].code()
+        assert 'A_diagonal[3]' in code
+        assert 'A[3][3]' not in code
+
+    def test_tsfc_block_diagonal_kernel(self, fs):
+        V = VectorFunctionSpace(fs.mesh(), 'CG', 1)
+        a = inner(grad(TrialFunction(V)), grad(TestFunction(V)))*dx
+        k, = tsfc_interface.compile_form(a, 'block_diagonal',
+                                         parameters={"assemble_diagonal": True,
+                                                     "assemble_block_diagonal": 2})
+        code = k[1][0].code()
+        assert 'A_diagonal[3][2][2]' in code
+        assert 'A[3][2][3][2]' not in code
+
     def test_tsfc_exterior_facet_kernel(self, rhs):
         k = tsfc_interface.compile_form(rhs, 'rhs')
         assert len(k) == 1 and 'exterior_facet_integral' in k[0][1][0].code()
@@ -131,6 +201,102 @@ with open("{file}", "w") as f:
         assert len(k) == 2 and 'cell_integral' in kernel_name[0] and \
             'exterior_facet_integral' in kernel_name[1]
 
+    def test_tsfc_coffee_parameters_reuse_tsfc_output(self, laplace, monkeypatch):
+        """Changing the COFFEE parameters should not rerun TSFC."""
+        calls = []
+        tsfc_compile_form = tsfc_interface.tsfc_compile_form
+
+        def counting_compile_form(*args, **kwargs):
+            calls.append(args)
+            return tsfc_compile_form(*args, **kwargs)
+
+        monkeypatch.setattr(tsfc_interface, "tsfc_compile_form", counting_compile_form)
+        monkeypatch.setitem(parameters["coffee"], "optlevel", "O0")
+        k1, = tsfc_interface.compile_form(laplace, 'coffee_sweep')
+        ncalls = len(calls)
+        monkeypatch.setitem(parameters["coffee"], "optlevel", "O2")
+        k2, = tsfc_interface.compile_form(laplace, 'coffee_sweep')
+
+        assert len(calls) == ncalls
+        assert k1[-1] is not k2[-1]
+
+    def test_tsfc_cache_statistics(self, fs):
+        u = TrialFunction(fs)
+        v = TestFunction(fs)
+        a = 3*u*v*dx
+        reset_cache_statistics()
+        tsfc_interface.compile_form(a, 'stats')
+        tsfc_interface.compile_form(a, 'stats')
+        stats = cache_statistics()["TSFCKernel"]
+        assert stats["form_misses"] == 1
+        assert stats["form_hits"] == 1
+        # Either in memory, on disk, or compiled
+        assert stats["memory_hits"] + stats["memory_misses"] == 1
+        reset_cache_statistics()
+        assert cache_statistics() == {}
+
+    def test_precompile_mixed_form(self, fs, monkeypatch):
+        """Precompiled forms should not need the form compiler again."""
+        W = fs*fs*fs
+        u = TrialFunction(W)
+        v = TestFunction(W)
+        forms = [inner(u, v)*dx, inner(grad(u), grad(v))*dx]
+        precompile(forms, nprocs=2)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("TSFC should not be called")
+
+        monkeypatch.setattr(tsfc_interface, "tsfc_compile_form", fail)
+        u = TrialFunction(W)
+        v = TestFunction(W)
+        for form in [inner(u, v)*dx, inner(grad(u), grad(v))*dx]:
+            assemble(form)
+
+    def test_precompile_uses_pool(self, fs):
+        """The form compiler output should come from the worker processes."""
+        W = fs*fs*fs
+        u = TrialFunction(W)
+        v = TestFunction(W)
+        # A unique name, so that nothing is in the disk cache.
+        name = "precompile_%d_%s" % (os.getpid(), os.urandom(4).hex())
+        reset_cache_statistics()
+        precompile([inner(grad(u), grad(v))*dx], name=name, nprocs=2)
+        stats = cache_statistics()["TSFCOutput"]
+        # The three diagonal blocks missed the caches, and were then
+        # looked up again by compile_form, but the form compiler never
+        # ran in this process.
+        assert stats["disk_misses"] >= 3
+        assert stats["memory_hits"] >= 3
+        assert stats["compile_time"] == 0
+
+    def test_precompile_rejects_non_forms(self, fs):
+        with pytest.raises(TypeError):
+            precompile([Function(fs)])
+
+
+def test_tsfc_disk_cache_lru_eviction(tmpdir):
+    cachedir = str(tmpdir)
+    for i, key in enumerate(["a", "b", "c"]):
+        filepath = os.path.join(cachedir, key)
+        with open(filepath, "wb") as f:
+            f.write(b"x"*100)
+        os.utime(filepath, (i, i))
+    with tsfc_interface._locked_index(cachedir) as index:
+        assert sorted(index) == ["a", "b", "c"]
+        tsfc_interface._evict(cachedir, index, 250)
+    # The least recently used entry went
+    assert not os.path.exists(os.path.join(cachedir, "a"))
+    assert os.path.exists(os.path.join(cachedir, "b"))
+    with tsfc_interface._locked_index(cachedir) as index:
+        assert sorted(index) == ["b", "c"]
+
+
+def test_tsfc_parse_cache_size():
+    assert tsfc_interface._parse_size(None) is None
+    assert tsfc_interface._parse_size("1000") == 1000
+    assert tsfc_interface._parse_size("2k") == 2048
+    assert tsfc_interface._parse_size("1.5G") == 3*2**29
+
 
 if __name__ == '__main__':
     pytest.main(os.path.abspath(__file__))